@@ -185,7 +185,8 @@ def generate_movement_summary(data):
     -------
     pandas.DataFrame
         Participants phenotype reduced to: age, gender, group, motion.
-        Motion is calculated through mean framewise displacement.
+        Motion is summarised by the mean, median and maximum framewise
+        displacement and the mean standardised DVARS.
 
     """
     # get motion QC related metrics from confound files
@@ -203,11 +204,18 @@ def generate_movement_summary(data):
         confounds_df = pd.read_csv(confounds, sep="\t")
         logging.debug("Confounds shape for %s: %s", subject_id, confounds_df.shape)
         if "framewise_displacement" in confounds_df.columns:
-            mean_fd = confounds_df["framewise_displacement"].mean()
+            fd = confounds_df["framewise_displacement"]
+            mean_fd = fd.mean()
             logging.debug("Mean FD for subject %s: %f", subject_id, mean_fd)
             group_mean_fd.loc[subject_id, "mean_framewise_displacement"] = mean_fd
+            group_mean_fd.loc[subject_id, "median_framewise_displacement"] = fd.median()
+            group_mean_fd.loc[subject_id, "max_framewise_displacement"] = fd.max()
         else:
             logging.warning("Framewise displacement column missing for subject %s", subject_id)
+        if "std_dvars" in confounds_df.columns:
+            group_mean_fd.loc[subject_id, "mean_std_dvars"] = confounds_df[
+                "std_dvars"
+            ].mean()
 
     # load gender and age as confounds for the developmental dataset
     participants = data.phenotypic.copy()
@@ -1,18 +1,59 @@
 from .quality_control_connectivity import (
+    QCFC_METHODS,
+    MOTION_SUMMARIES,
     qcfc,
+    qcfc_by_group,
+    qcfc_by_group_incremental,
+    qcfc_motion_summaries,
+    bootstrap_qcfc_summary,
+    QCFCAccumulator,
     partial_correlation,
+    partial_correlation_matrix,
+    permutation_test,
     significant_level,
+    significant_percentage,
     calculate_median_absolute,
 )
-from .distance_dependency import get_atlas_pairwise_distance, get_centroid
-from .network_modularity import louvain_modularity
+from .distance_dependency import (
+    get_atlas_pairwise_distance,
+    get_centroid,
+    get_roi_subset,
+)
+from .roi_subset import ROISubset
+from .network_modularity import (
+    LOUVAIN_BACKENDS,
+    louvain_modularity,
+    louvain_modularities,
+    louvain_und_sign,
+    consensus_partition,
+    save_partitions,
+    load_partitions,
+)
 
 __all__ = [
+    "QCFC_METHODS",
+    "MOTION_SUMMARIES",
     "qcfc",
+    "qcfc_by_group",
+    "qcfc_by_group_incremental",
+    "qcfc_motion_summaries",
+    "bootstrap_qcfc_summary",
+    "QCFCAccumulator",
     "significant_level",
+    "significant_percentage",
     "partial_correlation",
+    "partial_correlation_matrix",
+    "permutation_test",
     "calculate_median_absolute",
     "get_atlas_pairwise_distance",
     "get_centroid",
+    "get_roi_subset",
+    "ROISubset",
     "louvain_modularity",
+    "louvain_modularities",
+    "LOUVAIN_BACKENDS",
+    "louvain_und_sign",
+    "consensus_partition",
+    "save_partitions",
+    "load_partitions",
 ]
@@ -0,0 +1,255 @@
+"""Command line arguments and output names shared by the build_features
+entry points."""
+from pathlib import Path
+
+from fmriprep_denoise.features.derivatives import CONNECTIVITY_KINDS, PAIRWISE_KIND
+from fmriprep_denoise.features.network_modularity import LOUVAIN_BACKENDS
+from fmriprep_denoise.features.quality_control_connectivity import QCFC_METHODS
+
+
+def add_feature_arguments(parser):
+    """Add the arguments common to all build_features entry points.
+
+    Parameters
+    ----------
+
+    parser : argparse.ArgumentParser
+        Parser of the entry point, which adds its own atlas, dimension and
+        scheduling arguments.
+
+    Returns
+    -------
+
+    argparse.ArgumentParser
+        The same parser.
+    """
+    parser.add_argument(
+        "input_path",
+        action="store",
+        type=str,
+        help="Input path to the timeseries collection.",
+    )
+    parser.add_argument(
+        "output_path",
+        action="store",
+        type=str,
+        help="output path for metrics.",
+    )
+    parser.add_argument(
+        "--qc",
+        action="store",
+        default=None,
+        help="Automatic motion QC thresholds.",
+    )
+    parser.add_argument(
+        "--metric",
+        action="store",
+        default="connectomes",
+        help="Metric to build {connectome, qcfc, modularity, all}. 'all' "
+        "loads the connectomes of each strategy once and writes the three "
+        "metrics.",
+    )
+    parser.add_argument(
+        "--kind",
+        action="store",
+        default="correlation",
+        choices=CONNECTIVITY_KINDS + [PAIRWISE_KIND],
+        help="Connectivity measure, derived from cached covariances. "
+        f"'{PAIRWISE_KIND}' correlates time series with missing values over "
+        "the volumes present in both ROIs, without imputation. "
+        "Non-default kinds are saved as *_<metric>_<kind>.tsv.",
+    )
+    parser.add_argument(
+        "--qcfc_method",
+        action="store",
+        default="pearson",
+        choices=QCFC_METHODS,
+        help="Correlation of QC-FC. Non-default methods are saved as "
+        "*_qcfc_<method>.tsv.",
+    )
+    parser.add_argument(
+        "--n_permutations",
+        action="store",
+        type=int,
+        default=None,
+        help="Number of permutations for the QC-FC permutation null. "
+        "Default to parametric p-values only.",
+    )
+    parser.add_argument(
+        "--qcfc_accumulator",
+        action="store_true",
+        help="Keep QC-FC sufficient statistics on disk and only process "
+        "subjects added, changed or removed since the last run. Pearson's "
+        "correlation only, without --n_permutations or --block_size.",
+    )
+    parser.add_argument(
+        "--connectome_store",
+        action="store",
+        type=str,
+        default=None,
+        help="Root of the persistent connectome store. Default to "
+        "<output_path>/connectome_store. Covariances are estimated once per "
+        "subject and again only when the time series file changes.",
+    )
+    parser.add_argument(
+        "--no_connectome_store",
+        action="store_true",
+        help="Recompute all connectomes from the time series.",
+    )
+    parser.add_argument(
+        "--precision",
+        action="store",
+        default="float64",
+        choices=["float64", "float32"],
+        help="Floating point precision of the connectomes, QC-FC and "
+        "modularity input. float32 halves the memory; QC-FC correlations "
+        "differ from float64 by less than 1e-6.",
+    )
+    parser.add_argument(
+        "--num_opt",
+        action="store",
+        type=int,
+        default=100,
+        help="Number of Louvain optimizations averaged into the modularity "
+        "of a subject.",
+    )
+    parser.add_argument(
+        "--louvain_seed",
+        action="store",
+        type=int,
+        default=None,
+        help="Seed of the Louvain optimizations. Each optimization gets its "
+        "own seed derived from it, so the modularity does not depend on the "
+        "number of workers. Default to fresh entropy.",
+    )
+    parser.add_argument(
+        "--louvain_tol",
+        action="store",
+        type=float,
+        default=None,
+        help="Stop the Louvain optimizations of a subject once the standard "
+        "error of its mean modularity is below this tolerance. --num_opt "
+        "remains the maximum.",
+    )
+    parser.add_argument(
+        "--louvain_stable_rounds",
+        action="store",
+        type=int,
+        default=None,
+        help="Stop the Louvain optimizations of a subject once its consensus "
+        "partition is unchanged for this many rounds of 10 optimizations.",
+    )
+    parser.add_argument(
+        "--louvain_backend",
+        action="store",
+        default="bct",
+        choices=LOUVAIN_BACKENDS,
+        help="Louvain implementation: bctpy or the vectorized NumPy engine, "
+        "which gives the same partitions for the same seeds.",
+    )
+    parser.add_argument(
+        "--no_partitions",
+        action="store_true",
+        help="Do not save the community affiliations of the Louvain "
+        "optimizations. By default, they are saved with the consensus "
+        "partition of each subject in *_modularity_partitions/desc-<strategy>.npz.",
+    )
+    parser.add_argument(
+        "--modularity_jobs",
+        action="store",
+        type=int,
+        default=None,
+        help="Number of processes of the Louvain optimizations. Default to "
+        "the available CPUs, divided by the number of work units processed "
+        "in parallel.",
+    )
+    parser.add_argument(
+        "--temp_folder",
+        action="store",
+        type=str,
+        default=None,
+        help="Folder of the copy of the connectomes memory-mapped by the "
+        "Louvain processes. Default to JOBLIB_TEMP_FOLDER, then to the "
+        "system's temporary folder.",
+    )
+    parser.add_argument(
+        "--dataset",
+        type=str,
+        default=None,
+        help="Override dataset name (default: extracted from input_path)",
+    )
+    parser.add_argument(
+        "--fmriprep_ver",
+        type=str,
+        default=None,
+        help="Override fMRIPrep version (default: extracted from input_path)",
+    )
+    return parser
+
+
+def check_feature_arguments(parser, args):
+    """Reject combinations of the shared arguments that cannot be honoured,
+    with `parser.error`.
+
+    Parameters
+    ----------
+
+    parser : argparse.ArgumentParser
+        Parser of the entry point.
+
+    args : argparse.Namespace
+        Parsed arguments.
+
+    Returns
+    -------
+
+    argparse.Namespace
+        The same arguments.
+    """
+    if args.qcfc_accumulator:
+        if args.qcfc_method != "pearson":
+            parser.error("--qcfc_accumulator only supports --qcfc_method pearson.")
+        if args.n_permutations:
+            parser.error("--qcfc_accumulator cannot be used with --n_permutations.")
+        if getattr(args, "block_size", None):
+            parser.error("--qcfc_accumulator cannot be used with --block_size.")
+    return args
+
+
+def connectome_store_root(args, path_root):
+    """Root of the connectome store of the parsed arguments, None without
+    store."""
+    if args.no_connectome_store:
+        return None
+    if args.connectome_store:
+        return Path(args.connectome_store)
+    return Path(path_root) / "connectome_store"
+
+
+def output_metric_name(metric, kind="correlation", qcfc_method="pearson"):
+    """Name of a metric in the output files, "<metric>[_<method>][_<kind>]".
+
+    Parameters
+    ----------
+
+    metric : str {"connectome", "qcfc", "modularity", ...}
+        Metric built.
+
+    kind : str
+        Connectivity measure; non-default kinds are appended without spaces.
+
+    qcfc_method : str
+        Correlation of QC-FC; non-default methods are appended to "qcfc".
+
+    Returns
+    -------
+
+    str
+        E.g. "qcfc_spearman_partialcorrelation".
+    """
+    name = metric
+    if metric == "qcfc" and qcfc_method != "pearson":
+        name = f"{name}_{qcfc_method}"
+    if kind != "correlation":
+        name = f"{name}_{kind.replace(' ', '')}"
+    return name
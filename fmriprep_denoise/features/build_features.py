@@ -1,16 +1,37 @@
 import argparse
 
+import numpy as np
 import pandas as pd
 
 from pathlib import Path
-from joblib import Parallel, delayed
+from joblib import Parallel, cpu_count, delayed
 
+from fmriprep_denoise.dataset.atlas import ATLAS_METADATA
 from fmriprep_denoise.dataset.fmriprep import get_prepro_strategy
+from fmriprep_denoise.features.arguments import (
+    add_feature_arguments,
+    check_feature_arguments,
+    connectome_store_root,
+    output_metric_name,
+)
 from fmriprep_denoise.features.derivatives import (
+    PAIRWISE_KIND,
     compute_connectome,
     get_qc_criteria,
+    _index_timeseries_patterns,
+    _suffixed,
+)
+from fmriprep_denoise.visualization import tables
+from fmriprep_denoise.features import (
+    MOTION_SUMMARIES,
+    bootstrap_qcfc_summary,
+    get_atlas_pairwise_distance,
+    qcfc_by_group,
+    qcfc_by_group_incremental,
+    qcfc_motion_summaries,
+    louvain_modularities,
+    save_partitions,
 )
-from fmriprep_denoise.features import qcfc, louvain_modularity
 
 
 # another very bad special case handling
@@ -22,54 +43,57 @@ def parse_args():
         formatter_class=argparse.RawTextHelpFormatter,
         description="Generate denoise metric based on denoising strategies.",
     )
-    parser.add_argument(
-        "input_path",
-        action="store",
-        type=str,
-        help="Input path to the timeseries collection.",
-    )
-    parser.add_argument(
-        "output_path",
-        action="store",
-        type=str,
-        help="output path for metrics.",
-    )
+    add_feature_arguments(parser)
     parser.add_argument(
         "--atlas",
         action="store",
         type=str,
-        help="Atlas name (schaefer7networks, mist, difumo, gordon333)",
+        nargs="+",
+        default=None,
+        help="Atlas name(s) (schaefer7networks, mist, difumo, gordon333). "
+        "Default to all atlases in ATLAS_METADATA.",
     )
     parser.add_argument(
         "--dimension",
         action="store",
-        help="Number of ROI. See meta data of each atlas to get valid inputs.",
+        nargs="+",
+        default=None,
+        help="Number of ROI. See meta data of each atlas to get valid inputs. "
+        "Default to all dimensions of each atlas.",
     )
     parser.add_argument(
-        "--qc",
+        "--n_workers",
         action="store",
-        default=None,
-        help="Automatic motion QC thresholds.",
+        type=int,
+        default=1,
+        help="Number of strategy x atlas x dimension work units processed "
+        "in parallel.",
     )
     parser.add_argument(
-        "--metric",
+        "--n_bootstrap",
         action="store",
-        default="connectomes",
-        help="Metric to build {connectomes, qcfc, modularity}",
-    ) 
-    parser.add_argument(
-        "--dataset",
-        type=str,
+        type=int,
         default=None,
-        help="Override dataset name (default: extracted from input_path)",
+        help="Number of bootstrap resamples for confidence intervals of the "
+        "QC-FC summary metrics. Default to no bootstrap.",
     )
     parser.add_argument(
-        "--fmriprep_ver",
-        type=str,
+        "--motion_summaries",
+        action="store_true",
+        help="Also compute QC-FC of the full sample against every motion "
+        "summary available (mean, median and max FD, mean std_dvars, "
+        "proportion of excised volumes), saved as *_qcfc_motion.tsv.",
+    )
+    parser.add_argument(
+        "--block_size",
+        action="store",
+        type=int,
         default=None,
-        help="Override fMRIPrep version (default: extracted from input_path)",
+        help="Write the connectomes by batches of subjects to a memory-mapped "
+        "file and compute their average and QC-FC by blocks of edges, to "
+        "bound the memory on large atlases. Not available with permutations.",
     )
-    return parser.parse_args()
+    return check_feature_arguments(parser, parser.parse_args())
 
 
 def main():
@@ -77,8 +101,6 @@ def main():
     args = parse_args()
     print(vars(args))
     input_path = Path(args.input_path)
-    atlas = args.atlas
-    dimension = args.dimension
 
     print(input_path)
     # dataset = input_path.parents[0].name
@@ -94,88 +116,343 @@ def main():
     print(dataset)
     print(fmriprep_ver)
     print(output_path)
+    store_root = connectome_store_root(args, path_root)
     strategy_names = get_prepro_strategy(None)
     motion_qc = get_qc_criteria(args.qc)
     metric_option = str(args.metric)
+    metrics_to_run = (
+        ["connectome", "qcfc", "modularity"]
+        if metric_option == "all"
+        else [metric_option]
+    )
+    if not set(metrics_to_run) <= {"connectome", "qcfc", "modularity"}:
+        raise ValueError(f"Invalid metric option: {metric_option}")
+    output_metrics = {
+        metric: output_metric_name(metric, args.kind, args.qcfc_method)
+        for metric in metrics_to_run
+    }
 
-    collection_metric = []
-    for strategy_name in strategy_names.keys():
-        file_pattern = f"atlas-{atlas}_nroi-{dimension}_desc-{strategy_name}"
-        print(strategy_name)
-        connectome, phenotype = compute_connectome(
-            atlas,
+    # phenotype shared by all work units
+    confounds_phenotype, phenotype, _ = tables.get_descriptive_data(
+        dataset,
+        fmriprep_ver,
+        path_root,
+        motion_qc["gross_fd"],
+        motion_qc["fd_thresh"],
+        motion_qc["proportion_thresh"],
+    )
+    # time series files of the dataset, indexed in one walk
+    file_patterns = _index_timeseries_patterns(input_path)
+    atlas_dimensions = []
+    for atlas, dimension in _atlas_dimensions(args.atlas, args.dimension):
+        strategies = [
+            strategy_name
+            for strategy_name in strategy_names
+            if f"atlas-{atlas}_nroi-{dimension}_desc-{strategy_name}" in file_patterns
+        ]
+        if not strategies:
+            print(f"No time series for atlas-{atlas}_nroi-{dimension}. Skipping...")
+            continue
+        atlas_dimensions.append((atlas, dimension, strategies))
+
+    distances = {}
+    if "qcfc" in metrics_to_run and args.n_bootstrap:
+        for atlas, dimension, _ in atlas_dimensions:
+            distances[(atlas, dimension)] = get_atlas_pairwise_distance(
+                atlas, dimension
+            )["distance"].values
+
+    units = [
+        (atlas, dimension, strategy_name)
+        for atlas, dimension, strategies in atlas_dimensions
+        for strategy_name in strategies
+    ]
+    print(f"Process {len(units)} strategy x atlas x dimension units.")
+    results = Parallel(n_jobs=args.n_workers)(
+        delayed(_compute_unit)(
+            args,
             input_path,
             dataset,
             fmriprep_ver,
             path_root,
-            file_pattern,
-            gross_fd=motion_qc["gross_fd"],
-            fd_thresh=motion_qc["fd_thresh"],
-            proportion_thresh=motion_qc["proportion_thresh"],
+            output_path,
+            store_root,
+            atlas,
+            dimension,
+            strategy_name,
+            metrics_to_run,
+            motion_qc,
+            phenotype,
+            confounds_phenotype,
+            distances.get((atlas, dimension)),
         )
-        print("\tLoaded connectomes...")
+        for atlas, dimension, strategy_name in units
+    )
+    results = dict(zip(units, results))
+
+    for atlas, dimension, strategies in atlas_dimensions:
+        unit_results = [results[(atlas, dimension, s)] for s in strategies]
+        prefix = f"dataset-{dataset}_atlas-{atlas}_nroi-{dimension}"
+        for metric_name in metrics_to_run:
+            collection_metric = pd.concat(
+                [result[metric_name] for result in unit_results], axis=1
+            )
+            collection_metric.to_csv(
+                output_path / f"{prefix}_{output_metrics[metric_name]}.tsv",
+                sep="\t",
+            )
+        if "modularity" in metrics_to_run:
+            # number of optimizations and standard error of each modularity
+            collection_runs = pd.concat(
+                {s: r["modularity_runs"] for s, r in zip(strategies, unit_results)},
+                axis=1,
+            )
+            collection_runs.to_csv(
+                output_path / f"{prefix}_{output_metrics['modularity']}_runs.tsv",
+                sep="\t",
+            )
+        if args.motion_summaries and "qcfc" in metrics_to_run:
+            collection_motion = pd.concat(
+                {s: r["motion"] for s, r in zip(strategies, unit_results)}, axis=1
+            )
+            collection_motion.to_csv(
+                output_path / f"{prefix}_{output_metrics['qcfc']}_motion.tsv",
+                sep="\t",
+            )
+        if args.n_bootstrap and "qcfc" in metrics_to_run:
+            collection_bootstrap = pd.concat(
+                {s: r["bootstrap"] for s, r in zip(strategies, unit_results)},
+                names=["strategy"],
+            )
+            collection_bootstrap.to_csv(
+                output_path / f"{prefix}_qcfc_bootstrap.tsv",
+                sep="\t",
+            )
 
-        if metric_option == "connectome":
-            cur_strategy_average = connectome.mean(axis=0)
-            collection_metric.append(cur_strategy_average)
-            print("\tAverage connectomes...")
 
-        elif metric_option == "modularity":
-            # louvain_modularity
-            qs = Parallel(n_jobs=4)(
-                delayed(louvain_modularity)(vect) for vect in connectome.values.tolist()
+def _atlas_dimensions(atlases=None, dimensions=None):
+    """Atlas and dimension pairs to process.
+
+    Default to all atlases of ATLAS_METADATA and, for each atlas, to all its
+    dimensions. Requested dimensions are kept for the atlases listing them,
+    or as given for atlases missing from ATLAS_METADATA. Dimensions not
+    listed by an atlas are reported; a requested dimension that no atlas
+    lists raises a ValueError.
+    """
+    atlases = list(ATLAS_METADATA) if atlases is None else atlases
+    pairs = []
+    for atlas in atlases:
+        valid = [str(d) for d in ATLAS_METADATA.get(atlas, {}).get("dimensions", [])]
+        if dimensions is None:
+            atlas_dimensions = valid
+        elif valid:
+            atlas_dimensions = [str(d) for d in dimensions if str(d) in valid]
+            missing = [str(d) for d in dimensions if str(d) not in valid]
+            if missing:
+                print(
+                    f"Dimension(s) {missing} not available for atlas-{atlas}. "
+                    f"Select from {valid}. Skipping..."
+                )
+        else:
+            atlas_dimensions = [str(d) for d in dimensions]
+        pairs += [(atlas, dimension) for dimension in atlas_dimensions]
+    if dimensions is not None:
+        unknown = {str(d) for d in dimensions} - {d for _, d in pairs}
+        if unknown:
+            raise ValueError(
+                f"Dimension(s) {sorted(unknown)} not available for any of the "
+                f"atlases {atlases}."
             )
-            modularity = pd.DataFrame(
-                qs, columns=[strategy_name], index=connectome.index
+    return pairs
+
+
+def _average_connectome(connectome, block_size=None):
+    """Mean of each edge over subjects, read by blocks of `block_size` edges
+    when set."""
+    if not block_size:
+        return connectome.mean(axis=0)
+    return pd.concat(
+        [
+            connectome.iloc[:, start : start + block_size].mean(axis=0)
+            for start in range(0, connectome.shape[1], block_size)
+        ]
+    )
+
+
+def _compute_unit(
+    args,
+    input_path,
+    dataset,
+    fmriprep_ver,
+    path_root,
+    output_path,
+    store_root,
+    atlas,
+    dimension,
+    strategy_name,
+    metrics_to_run,
+    motion_qc,
+    phenotype,
+    confounds_phenotype,
+    distance=None,
+):
+    """Metrics of one strategy x atlas x dimension work unit.
+
+    Returns
+    -------
+    dict
+        Metric name to its table for this strategy: "connectome",
+        "modularity", "modularity_runs", "qcfc" and, if requested, "motion"
+        and "bootstrap".
+    """
+    file_pattern = f"atlas-{atlas}_nroi-{dimension}_desc-{strategy_name}"
+    print(file_pattern)
+    # connectomes written by batches to a memory-mapped file and read by
+    # blocks of edges, so the memory is bounded by --block_size
+    memmap_path = None
+    if "qcfc" in metrics_to_run and args.block_size:
+        memmap_path = output_path / "connectome_memmap" / file_pattern
+    # number of volumes behind each pairwise complete edge, saved next to
+    # the connectomes
+    valid_samples_path = None
+    if args.kind == PAIRWISE_KIND:
+        connectome_name = output_metric_name("connectome", args.kind)
+        valid_samples_path = (
+            output_path
+            / f"dataset-{dataset}_atlas-{atlas}_nroi-{dimension}_{connectome_name}_valid_samples"
+            / f"desc-{strategy_name}"
+        )
+    connectome, phenotype = compute_connectome(
+        atlas,
+        input_path,
+        dataset,
+        fmriprep_ver,
+        path_root,
+        file_pattern,
+        gross_fd=motion_qc["gross_fd"],
+        fd_thresh=motion_qc["fd_thresh"],
+        proportion_thresh=motion_qc["proportion_thresh"],
+        dtype=np.dtype(args.precision),
+        store_root=store_root,
+        kind=args.kind,
+        phenotype=phenotype,
+        memmap_path=memmap_path,
+        valid_samples_path=valid_samples_path,
+    )
+    print("\tLoaded connectomes...")
+
+    # connectomes handed to the modularity workers
+    modularity_source = None
+    if memmap_path is not None:
+        modularity_source = _suffixed(memmap_path, ".npy")
+        print("\tMemory-mapped connectomes...")
+
+    result = {}
+    if "connectome" in metrics_to_run:
+        result["connectome"] = _average_connectome(
+            connectome, args.block_size
+        ).rename(strategy_name)
+        print("\tAverage connectomes...")
+
+    if "modularity" in metrics_to_run:
+        # louvain modularity, optimizations spread across processes, also
+        # inside a --n_workers unit, which share the CPUs; the processes
+        # memory-map the connectomes and receive subject indices
+        modularity_jobs = args.modularity_jobs or max(1, cpu_count() // args.n_workers)
+        qs, runs, partitions = louvain_modularities(
+            connectome.values if modularity_source is None else modularity_source,
+            num_opt=args.num_opt,
+            n_jobs=modularity_jobs,
+            seed=args.louvain_seed,
+            tol=args.louvain_tol,
+            stable_rounds=args.louvain_stable_rounds,
+            return_info=True,
+            backend=args.louvain_backend,
+            return_partitions=True,
+            temp_folder=args.temp_folder,
+        )
+        result["modularity"] = pd.DataFrame(
+            qs, columns=[strategy_name], index=connectome.index
+        )
+        result["modularity_runs"] = pd.DataFrame(runs, index=connectome.index)
+        if not args.no_partitions:
+            modularity_name = output_metric_name("modularity", args.kind)
+            save_partitions(
+                output_path
+                / f"dataset-{dataset}_atlas-{atlas}_nroi-{dimension}_{modularity_name}_partitions"
+                / f"desc-{strategy_name}.npz",
+                connectome.index.tolist(),
+                partitions,
             )
-            collection_metric.append(modularity)
-            print("\tModularity...")
+        print(f"\tMean number of Louvain optimizations: {result['modularity_runs']['n_opt'].mean():.1f}")
+        print("\tModularity...")
 
-        elif metric_option == "qcfc":
-            metric = qcfc(
+    if "qcfc" in metrics_to_run:
+        # permutations and bootstrap share the CPUs with the other units
+        qcfc_jobs = max(1, cpu_count() // args.n_workers)
+        if args.qcfc_accumulator:
+            metric = qcfc_by_group_incremental(
+                output_path / "qcfc_accumulator",
+                f"atlas-{atlas}_nroi-{dimension}",
                 phenotype.loc[:, "mean_framewise_displacement"],
                 connectome,
                 phenotype.loc[:, ["age", "gender"]],
+                phenotype["groups"],
+                strategy_name,
             )
-            metric = pd.DataFrame(metric)
-            columns = [
-                ("full_sample", f"{strategy_name}_{col}") for col in metric.columns
-            ]
-            columns = pd.MultiIndex.from_tuples(columns)
-            metric.columns = columns
-            collection_metric.append(metric)
-            print("\tQC-FC...")
-
-            # QC-FC by group
-            groups = phenotype["groups"].unique()
-            for group in groups:
-                group_mask = phenotype["groups"] == group
-                # make sure values are numerical
-                subgroup = phenotype[group_mask].index
-                metric = qcfc(
-                    phenotype.loc[subgroup, "mean_framewise_displacement"],
-                    connectome.loc[subgroup, :],
-                    phenotype.loc[subgroup, ["age", "gender"]],
-                )
-                metric = pd.DataFrame(metric)
-                metric.columns = [
-                    (group, f"{strategy_name}_{col}") for col in metric.columns
-                ]
-                collection_metric.append(metric)
-
         else:
-            raise (ValueError)
-
-    collection_metric = pd.concat(collection_metric, axis=1)
+            # QC-FC of the full sample and by group
+            metric = qcfc_by_group(
+                phenotype.loc[:, "mean_framewise_displacement"],
+                connectome,
+                phenotype.loc[:, ["age", "gender"]],
+                phenotype["groups"],
+                strategy_name,
+                n_permutations=args.n_permutations,
+                n_jobs=qcfc_jobs,
+                method=args.qcfc_method,
+                block_size=args.block_size,
+            )
+        if "fwer_threshold" in metric.attrs:
+            print(f"\tFWER thresholds: {metric.attrs['fwer_threshold']}")
+        result["qcfc"] = metric
+        print("\tQC-FC...")
 
-    if metric_option == "connectome":
-        collection_metric.columns = strategy_names.keys()
+        if args.motion_summaries:
+            motion = phenotype.loc[
+                :, [c for c in MOTION_SUMMARIES if c in phenotype.columns]
+            ].copy()
+            motion["excised_vol_proportion"] = confounds_phenotype[
+                (strategy_name, "excised_vol_proportion")
+            ]
+            result["motion"] = qcfc_motion_summaries(
+                motion,
+                connectome,
+                phenotype.loc[:, ["age", "gender"]],
+                method=args.qcfc_method,
+                block_size=args.block_size,
+            )
+            print("\tQC-FC of motion summaries...")
 
-    collection_metric.to_csv(
-        output_path
-        / f"dataset-{dataset}_atlas-{atlas}_nroi-{dimension}_{metric_option}.tsv",
-        sep="\t",
-    )
+        if args.n_bootstrap:
+            if len(distance) != connectome.shape[1]:
+                raise ValueError(
+                    f"The node distances of atlas-{atlas}_nroi-{dimension} "
+                    f"have {len(distance)} edges, but its connectomes have "
+                    f"{connectome.shape[1]}; cannot bootstrap the distance "
+                    "dependence."
+                )
+            result["bootstrap"] = bootstrap_qcfc_summary(
+                phenotype.loc[:, "mean_framewise_displacement"],
+                connectome,
+                phenotype.loc[:, ["age", "gender"]],
+                distance=distance,
+                n_bootstrap=args.n_bootstrap,
+                block_size=args.block_size,
+                n_jobs=qcfc_jobs,
+            )
+            print("\tQC-FC bootstrap...")
+    return result
 
 
 if __name__ == "__main__":
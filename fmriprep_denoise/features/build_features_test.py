@@ -2,7 +2,7 @@ import argparse
 import logging
 import pandas as pd
 from pathlib import Path
-from joblib import Parallel, delayed
+from joblib import cpu_count
 
 from fmriprep_denoise.dataset.fmriprep import get_prepro_strategy
 from fmriprep_denoise.features.derivatives_test import (
@@ -10,7 +10,7 @@ from fmriprep_denoise.features.derivatives_test import (
     get_qc_criteria,
     load_full_roi_list, #added for roi list return
 )
-from fmriprep_denoise.features import qcfc, louvain_modularity
+from fmriprep_denoise.features import qcfc, louvain_modularities
 
 import glob  # put this at the top of your script if not already
 
@@ -168,9 +168,8 @@ def main():
 
         elif metric_option == "modularity":
             logging.info("Computing modularity using louvain_modularity for strategy %s", strategy_name)
-            qs = Parallel(n_jobs=4)(
-                delayed(louvain_modularity)(vect) for vect in connectome.values.tolist()
-            )
+            # connectomes memory-mapped by the workers, one per available CPU
+            qs = louvain_modularities(connectome.values, n_jobs=cpu_count())
             modularity = pd.DataFrame(
                 qs, columns=[strategy_name], index=connectome.index
             )
@@ -1,16 +1,28 @@
 import argparse
 import logging
+import numpy as np
 import pandas as pd
+from joblib import cpu_count
 from pathlib import Path
-from joblib import Parallel, delayed
 
 from fmriprep_denoise.dataset.fmriprep import get_prepro_strategy
+from fmriprep_denoise.features.arguments import (
+    add_feature_arguments,
+    check_feature_arguments,
+    connectome_store_root,
+    output_metric_name,
+)
 from fmriprep_denoise.features.derivatives_test import (
     compute_connectome,
     get_qc_criteria,
     load_full_roi_list, #added for roi list return
 )
-from fmriprep_denoise.features import qcfc, louvain_modularity
+from fmriprep_denoise.features import (
+    qcfc_by_group,
+    qcfc_by_group_incremental,
+    louvain_modularities,
+    save_partitions,
+)
 
 import glob  
 
@@ -34,18 +46,7 @@ def parse_args():
         formatter_class=argparse.RawTextHelpFormatter,
         description="Generate denoise metric based on denoising strategies.",
     )
-    parser.add_argument(
-        "input_path",
-        action="store",
-        type=str,
-        help="Input path to the timeseries collection.",
-    )
-    parser.add_argument(
-        "output_path",
-        action="store",
-        type=str,
-        help="output path for metrics.",
-    )
+    add_feature_arguments(parser)
     parser.add_argument(
         "--atlas",
         action="store",
@@ -57,37 +58,13 @@ def parse_args():
         action="store",
         help="Number of ROI. See meta data of each atlas to get valid inputs.",
     )
-    parser.add_argument(
-        "--qc",
-        action="store",
-        default=None,
-        help="Automatic motion QC thresholds.",
-    )
-    parser.add_argument(
-        "--metric",
-        action="store",
-        default="connectomes",
-        help="Metric to build {connectomes, qcfc, modularity}",
-    )
     parser.add_argument(
         "--strategy_index",
         type=int,
         default=None,
         help="0‑based index of the strategy (placeholder skipped).",
     )
-    parser.add_argument(
-        "--dataset",
-        type=str,
-        default=None,
-        help="Override dataset name (default: extracted from input_path)",
-    )
-    parser.add_argument(
-        "--fmriprep_ver",
-        type=str,
-        default=None,
-        help="Override fMRIPrep version (default: extracted from input_path)",
-    )
-    return parser.parse_args()
+    return check_feature_arguments(parser, parser.parse_args())
 
 def _select_strategy_by_index(idx: int):
     """Return the one‑entry dict for the real strategy at position *idx*."""
@@ -129,6 +106,9 @@ def main():
     logging.debug("Output path created: %s", output_path)
     print(output_path)
 
+    store_root = connectome_store_root(args, path_root)
+    logging.debug("Connectome store: %s", store_root)
+
     # Load the full ROI list from the atlas TSV file.
     # Get the "denoise" directory from the input path
     denoise_dir = input_path
@@ -172,10 +152,15 @@ def main():
     logging.debug("Motion QC criteria: %s", motion_qc)
     metric_option = str(args.metric)
     metrics_to_run = ["connectome", "qcfc", "modularity"] if metric_option == "all" else [metric_option]
+    if not set(metrics_to_run) <= {"connectome", "qcfc", "modularity"}:
+        logging.error("Invalid metric option: %s", metric_option)
+        raise ValueError(f"Invalid metric option: {metric_option}")
     logging.debug("Metric option selected: %s", metric_option)
 
-    collection_metric = []
-    used_strategy_names = []  
+    collection_metrics = {metric: [] for metric in metrics_to_run}
+    if "modularity" in metrics_to_run:
+        # number of optimizations and standard error of each modularity
+        collection_metrics["modularity_runs"] = []
 
     for strategy_name in strategy_names.keys():
         file_pattern = f"atlas-{atlas}_nroi-{dimension}_desc-{strategy_name}"
@@ -201,19 +186,51 @@ def main():
             gross_fd=motion_qc["gross_fd"],
             fd_thresh=motion_qc["fd_thresh"],
             proportion_thresh=motion_qc["proportion_thresh"],
+            dtype=np.dtype(args.precision),
+            store_root=store_root,
+            kind=args.kind,
         )
         logging.debug("Connectome computed for strategy %s", strategy_name)
         print("\tLoaded connectomes...")
 
-        if metric_option == "connectome":
+        if "connectome" in metrics_to_run:
             cur_strategy_average = (connectome.mean(axis=0)
                                     .to_frame(name=strategy_name))   # <── add this
-            collection_metric.append(cur_strategy_average)
-            used_strategy_names.append(strategy_name)
+            collection_metrics["connectome"].append(cur_strategy_average)
             logging.debug("Average connectome computed for strategy %s", strategy_name)
             print("\tAverage connectomes...")
 
-        elif metric_option == "modularity":
+        if "qcfc" in metrics_to_run:
+            logging.info("Computing QC-FC for strategy %s", strategy_name)
+            if args.qcfc_accumulator:
+                metric = qcfc_by_group_incremental(
+                    output_path / "qcfc_accumulator",
+                    f"atlas-{atlas}_nroi-{dimension}",
+                    phenotype.loc[:, "mean_framewise_displacement"],
+                    connectome,
+                    phenotype.loc[:, ["age", "gender"]],
+                    phenotype["groups"],
+                    strategy_name,
+                )
+            else:
+                # QC-FC of the full sample and by group in a single pass
+                metric = qcfc_by_group(
+                    phenotype.loc[:, "mean_framewise_displacement"],
+                    connectome,
+                    phenotype.loc[:, ["age", "gender"]],
+                    phenotype["groups"],
+                    strategy_name,
+                    n_permutations=args.n_permutations,
+                    n_jobs=-1,
+                    method=args.qcfc_method,
+                )
+            if "fwer_threshold" in metric.attrs:
+                print(f"\tFWER thresholds: {metric.attrs['fwer_threshold']}")
+            collection_metrics["qcfc"].append(metric)
+            logging.debug("QC-FC metric computed for strategy %s", strategy_name)
+            print("\tQC-FC...")
+
+        if "modularity" in metrics_to_run:
             logging.info("Computing modularity using louvain_modularity for strategy %s", strategy_name)
 
             # Debug log to inspect the structure of connectome
@@ -230,89 +247,83 @@ def main():
             # logging.info("Limiting modularity computation to the first 10 subjects for testing.")
             # logging.debug("Connectome shape after slicing: %s", connectome.shape)
 
-            # Fixed number of jobs for parallelization (same as original implementation)
-            n_jobs = 4
+            # Processes of the optimizations, from the available CPUs
+            n_jobs = args.modularity_jobs or cpu_count()
 
             # Log the start of the modularity computation
             logging.info("Starting modularity computation for %d subjects", len(connectome))
 
-            # Compute modularity for each subject in parallel
-            qs = Parallel(n_jobs=n_jobs)(
-                delayed(louvain_modularity)(vect) for idx, vect in enumerate(connectome.values.tolist())
+            # Compute modularity, the optimizations of all subjects in parallel
+            qs, runs, partitions = louvain_modularities(
+                connectome.values,
+                num_opt=args.num_opt,
+                n_jobs=n_jobs,
+                seed=args.louvain_seed,
+                tol=args.louvain_tol,
+                stable_rounds=args.louvain_stable_rounds,
+                return_info=True,
+                backend=args.louvain_backend,
+                return_partitions=True,
+                temp_folder=args.temp_folder,
             )
 
             # Create a DataFrame for modularity results
             modularity = pd.DataFrame(
                 qs, columns=[strategy_name], index=connectome.index
             )
-            collection_metric.append(modularity)
+            collection_metrics["modularity"].append(modularity)
+            runs = pd.DataFrame(runs, index=connectome.index)
+            runs.columns = pd.MultiIndex.from_tuples(
+                [(col, strategy_name) for col in runs.columns]
+            )
+            collection_metrics["modularity_runs"].append(runs)
+            if not args.no_partitions:
+                modularity_name = output_metric_name("modularity", args.kind)
+                save_partitions(
+                    output_path
+                    / f"dataset-{dataset}_atlas-{atlas}_nroi-{dimension}_{modularity_name}_partitions"
+                    / f"desc-{strategy_name}.npz",
+                    connectome.index.tolist(),
+                    partitions,
+                )
+            logging.info("Mean number of Louvain optimizations: %.1f", runs["n_opt"].values.mean())
 
             # Log the completion of modularity computation
             logging.info("Modularity computation completed for strategy %s", strategy_name)
             logging.debug("Modularity results: %s", modularity.head())
             print("\tModularity...")
 
-        elif metric_option == "qcfc":
-            logging.info("Computing QC-FC for strategy %s", strategy_name)
-            metric = qcfc(
-                phenotype.loc[:, "mean_framewise_displacement"],
-                connectome,
-                phenotype.loc[:, ["age", "gender"]],
-            )
-            metric = pd.DataFrame(metric)
-            columns = [
-                ("full_sample", f"{strategy_name}_{col}") for col in metric.columns
-            ]
-            columns = pd.MultiIndex.from_tuples(columns)
-            metric.columns = columns
-            collection_metric.append(metric)
-            logging.debug("QC-FC metric computed for strategy %s", strategy_name)
-            print("\tQC-FC...")
-
-            # QC-FC by group
-            groups = phenotype["groups"].unique()
-            logging.debug("Processing QC-FC by group for strategy %s, groups: %s", strategy_name, groups)
-            for group in groups:
-                group_mask = phenotype["groups"] == group
-                subgroup = phenotype[group_mask].index
-                metric = qcfc(
-                    phenotype.loc[subgroup, "mean_framewise_displacement"],
-                    connectome.loc[subgroup, :],
-                    phenotype.loc[subgroup, ["age", "gender"]],
-                )
-                metric = pd.DataFrame(metric)
-                metric.columns = [
-                    (group, f"{strategy_name}_{col}") for col in metric.columns
-                ]
-                collection_metric.append(metric)
-                logging.debug("QC-FC metric computed for group %s under strategy %s", group, strategy_name)
+    for metric_name, collection_metric in collection_metrics.items():
+        if not collection_metric:
+            logging.warning("No %s computed, nothing to save.", metric_name)
+            continue
+        output_metric = output_metric_name(metric_name, args.kind, args.qcfc_method)
+        output_file = output_path / f"dataset-{dataset}_atlas-{atlas}_nroi-{dimension}_{output_metric}.tsv"
+        _save_metric(
+            pd.concat(collection_metric, axis=1),
+            output_file,
+            header_rows=[0, 1] if metric_name in ["qcfc", "modularity_runs"] else 0,
+            order_columns=_order_columns,
+        )
 
-        else:
-            logging.error("Invalid metric option: %s", metric_option)
-            raise ValueError
 
+def _save_metric(collection_metric, output_file, header_rows, order_columns):
+    """Merge the metric of the processed strategies into `output_file`.
 
-    collection_metric = pd.concat(collection_metric, axis=1)
+    Other jobs may write the same file for other strategies; the file is
+    locked, existing columns of the processed strategies are replaced and
+    the merged table is swapped in atomically.
+    """
     logging.debug("Concatenated collection_metric with shape: %s", collection_metric.shape)
+    collection_metric = order_columns(collection_metric)
+    print("collection_metric shape:", collection_metric.shape)
 
-    collection_metric = _order_columns(collection_metric)
-
-    if metric_option == "connectome":
-        collection_metric.columns = used_strategy_names
-        logging.debug("Columns set to used strategy names for connectome metric.")
-        print("collection_metric shape:", collection_metric.shape)
-        print("collection_metric preview:")
-        print(collection_metric.head())
-
-        
-    output_file = output_path / f"dataset-{dataset}_atlas-{atlas}_nroi-{dimension}_{metric_option}.tsv"
     lock_path = output_file.with_suffix(output_file.suffix + ".lock")
 
     with open(lock_path, "w") as lock_fd:
         fcntl.flock(lock_fd, fcntl.LOCK_EX)
 
         if output_file.exists():
-            header_rows = [0, 1] if metric_option == "qcfc" else 0
             prev = pd.read_csv(output_file, sep="\t", index_col=0,
                             header=header_rows)
 
@@ -325,7 +336,7 @@ def main():
         else:
             merged = collection_metric
 
-        merged = _order_columns(merged)          # keep canonical order
+        merged = order_columns(merged)          # keep canonical order
 
         tmp = tempfile.NamedTemporaryFile(delete=False, dir=output_file.parent)
         merged.to_csv(tmp.name, sep="\t")
@@ -335,6 +346,7 @@ def main():
 
     logging.info("Final metrics saved to %s", output_file)
 
+
 if __name__ == "__main__":
     print("Logging main function called", flush=True)
-    main()
\ No newline at end of file
+    main()
@@ -1,13 +1,27 @@
+import fnmatch
 import json
+import os
 import tarfile
+import time
 from pathlib import Path
+import numpy as np
 import pandas as pd
-from nilearn.connectome import ConnectivityMeasure
+from joblib import Parallel, delayed
 
 from fmriprep_denoise.visualization import tables
 
 
 MOTION_QC_FILE = "motion_qc.json"
+# number of elements of the batched ROI by ROI matrices of the connectomes
+CONNECTOME_BATCH_SIZE = 2**25
+CONNECTIVITY_KINDS = ["correlation", "partial correlation", "tangent"]
+# correlation of time series with missing values, not derived from the cache
+PAIRWISE_KIND = "pairwise correlation"
+# members of the fMRIPrep archives used by the benchmark: time series,
+# confounds and their sidecars, but not the images
+EXTRACTION_PATTERNS = ["*.tsv", "*.json"]
+# parser of the time series files cached in the connectome store by default
+TIMESERIES_READER = "header"
 project_root = Path(__file__).parents[2]
 inputs = project_root / "data"
 group_info_column = {"ds000228": "Child_Adult", "ds000030": "diagnosis"}
@@ -57,6 +71,12 @@ def compute_connectome(
     gross_fd=None,
     fd_thresh=None,
     proportion_thresh=None,
+    dtype=np.float64,
+    store_root=None,
+    kind="correlation",
+    phenotype=None,
+    memmap_path=None,
+    valid_samples_path=None,
 ):
     """Compute connectome of all valid data.
 
@@ -78,34 +98,657 @@ def compute_connectome(
     file_pattern : str
         Details about the atlas and description of the file.
 
+    dtype : {numpy.float64, numpy.float32}
+        Precision of the connectomes. float32 halves the memory of the
+        subject by edge matrix; edges differ from float64 by less than 1e-7.
+
+    store_root : None or pathlib.Path
+        Root of the persistent connectome store. If set, the covariance of
+        each subject is read by memory-map from the store and only estimated
+        for subjects whose time series are new or changed. See
+        `load_connectome_store`.
+
+    kind : str {"correlation", "partial correlation", "tangent", \
+            "pairwise correlation"}
+        Connectivity measure, as in nilearn's `ConnectivityMeasure`. All
+        kinds are derived from the same covariance estimates, except
+        "pairwise correlation", the Pearson's correlation of the volumes
+        where both ROIs are not missing. See `pairwise_complete_connectomes`.
+
+    phenotype : None or pandas.DataFrame
+        Movement phenotype already filtered by
+        `fmriprep_denoise.visualization.tables.get_descriptive_data`, to
+        share it between calls. If None, it is loaded with the motion QC
+        thresholds.
+
+    memmap_path : None or pathlib.Path
+        If set, the connectomes are written by batches of subjects to
+        `<memmap_path>.npy` and returned memory-mapped (see
+        `load_connectome_memmap`), so the subject by edge matrix is never
+        held in memory. With the connectome store, the covariances are read
+        by memory-map as well; the tangent kind still needs the covariances
+        of all subjects at once.
+
+    valid_samples_path : None or pathlib.Path
+        With "pairwise correlation", the number of volumes behind each edge
+        is written by batches of subjects to `<valid_samples_path>.npy`,
+        with the subject ids, as in `save_connectome_memmap`. Otherwise,
+        only the number of edges with missing volumes is reported.
+
     Returns
     -------
     pandas.DataFrame, pandas.DataFrame
         Flatten connectomes and phenotypes.
     """
-    _, phenotype, _ = tables.get_descriptive_data(
-        dataset, fmriprep_version, path_root, gross_fd, fd_thresh, proportion_thresh
-    )
+    if phenotype is None:
+        _, phenotype, _ = tables.get_descriptive_data(
+            dataset, fmriprep_version, path_root, gross_fd, fd_thresh, proportion_thresh
+        )
     participant_id = phenotype.index.tolist()
-    valid_ids, valid_ts = _load_valid_timeseries(
-        atlas, extracted_path, participant_id, file_pattern
+    if kind == PAIRWISE_KIND:
+        valid_ids, valid_ts = _load_valid_timeseries(
+            atlas, extracted_path, participant_id, file_pattern
+        )
+        return _pairwise_connectome_frames(
+            valid_ids, valid_ts, phenotype, dtype, memmap_path, valid_samples_path
+        )
+    if store_root is not None:
+        sources = _find_timeseries_files(
+            atlas, extracted_path, participant_id, file_pattern
+        )
+        statistics = load_connectome_store(
+            connectome_store_path(store_root, dataset, fmriprep_version, file_pattern),
+            sources,
+            _read_timeseries,
+        )
+    else:
+        valid_ids, valid_ts = _load_valid_timeseries(
+            atlas, extracted_path, participant_id, file_pattern
+        )
+        statistics = pd.DataFrame(
+            _covariance_statistics(valid_ts), index=valid_ids, copy=False
+        )
+    idx, values = statistics.index, statistics.values
+    if statistics.shape[0] != phenotype.shape[0]:
+        print("take conjunction of the phenotype and connectome.")
+        idx = statistics.index.intersection(phenotype.index)
+        values = values[statistics.index.get_indexer(idx)]
+        phenotype = phenotype.loc[idx, :]
+    if memmap_path is None:
+        subject_conn = _connectomes_from_covariances(values, kind, dtype)
+        return pd.DataFrame(subject_conn, index=idx, copy=False), phenotype
+    n_rois = _statistics_n_rois(values)
+    out = create_connectome_memmap(
+        memmap_path, idx, n_rois * (n_rois - 1) // 2, dtype
     )
-    correlation_measure = ConnectivityMeasure(
-        kind="correlation", vectorize=True, discard_diagonal=True
+    _connectomes_from_covariances(values, kind, dtype, out=out)
+    out.flush()
+    del out
+    return load_connectome_memmap(memmap_path), phenotype
+
+
+def _correlation_connectomes(valid_ts, dtype=np.float64):
+    """Flattened correlation connectomes, filled into a single array of the
+    requested precision. Same as nilearn's
+    `ConnectivityMeasure(kind="correlation")`."""
+    return _connectomes_from_covariances(
+        _covariance_statistics(valid_ts), "correlation", dtype
     )
-    subject_conn = correlation_measure.fit_transform(valid_ts)
-    subject_conn = pd.DataFrame(subject_conn, index=valid_ids)
-    if subject_conn.shape[0] != phenotype.shape[0]:
-        print("take conjunction of the phenotype and connectome.")
-        idx = subject_conn.index.intersection(phenotype.index)
-        subject_conn, phenotype = (
-            subject_conn.loc[idx, :],
-            phenotype.loc[idx, :],
+
+
+def pairwise_complete_connectomes(
+    valid_ts, dtype=np.float64, min_samples=2, out=None, valid_samples_out=None
+):
+    """Flattened Pearson's correlation connectomes of time series with
+    missing values, without imputation.
+
+    The correlation of each pair of ROIs uses the volumes where both are
+    not NaN. Sums over the valid volumes are computed for all pairs at once
+    with masked matrix products, batched over subjects of the same length.
+    Without missing values, the result is the plain correlation, i.e.
+    `numpy.corrcoef`, with no shrinkage.
+
+    Parameters
+    ----------
+
+    valid_ts : list of numpy.ndarray
+        Time series (volume, ROI) of each subject, missing values as NaN.
+
+    dtype : {numpy.float64, numpy.float32}
+        Precision of the connectomes.
+
+    min_samples : int
+        Minimum number of valid volumes of an edge. Edges with fewer
+        volumes, or a constant signal over them, are NaN.
+
+    out : None or numpy.ndarray
+        Array, possibly memory-mapped, filled with the connectomes by
+        batches of subjects instead of allocating one.
+
+    valid_samples_out : None or numpy.ndarray
+        Integer array, possibly memory-mapped, filled with the number of
+        valid volumes of each edge.
+
+    Returns
+    -------
+
+    numpy.ndarray, numpy.ndarray
+        Connectomes and number of valid volumes of each edge, both of shape
+        (subject, edge) in the lower triangle order of nilearn's
+        `sym_matrix_to_vec` with `discard_diagonal=True`.
+    """
+    n_rois = valid_ts[0].shape[1] if valid_ts else 0
+    rows, cols = np.tril_indices(n_rois, k=-1)
+    lower = rows * n_rois + cols
+    subject_conn = (
+        np.empty((len(valid_ts), len(lower)), dtype=dtype) if out is None else out
+    )
+    valid_samples = (
+        np.empty((len(valid_ts), len(lower)), dtype=np.int32)
+        if valid_samples_out is None
+        else valid_samples_out
+    )
+    batch_size = max(1, CONNECTOME_BATCH_SIZE // max(n_rois, 1) ** 2)
+    lengths = np.array([ts.shape[0] for ts in valid_ts])
+    for length in np.unique(lengths):
+        same_length = np.flatnonzero(lengths == length)
+        for start in range(0, len(same_length), batch_size):
+            batch = same_length[start : start + batch_size]
+            timeseries = np.stack([valid_ts[i] for i in batch]).astype(np.float64)
+            observed = ~np.isnan(timeseries)
+            timeseries[~observed] = 0
+            observed = observed.astype(np.float64)
+            transpose = (0, 2, 1)
+            # sums of the ROI in row over the volumes valid for both ROIs
+            n = np.matmul(observed.transpose(transpose), observed)
+            sums = np.matmul(timeseries.transpose(transpose), observed)
+            squares = np.matmul((timeseries**2).transpose(transpose), observed)
+            products = np.matmul(timeseries.transpose(transpose), timeseries)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                covariance = products - sums * sums.transpose(transpose) / n
+                variance = squares - sums**2 / n
+                variance = np.clip(variance, 0, None)
+                connectivity = covariance / np.sqrt(
+                    variance * variance.transpose(transpose)
+                )
+            n = n.reshape(len(batch), -1)[:, lower]
+            connectivity = connectivity.reshape(len(batch), -1)[:, lower]
+            connectivity[n < min_samples] = np.nan
+            subject_conn[batch] = np.clip(connectivity, -1, 1)
+            valid_samples[batch] = n
+    return subject_conn, valid_samples
+
+
+def _pairwise_connectome_frames(
+    valid_ids,
+    valid_ts,
+    phenotype,
+    dtype=np.float64,
+    memmap_path=None,
+    valid_samples_path=None,
+):
+    """Pairwise complete connectomes of the subjects in the phenotype. See
+    `compute_connectome` for `memmap_path` and `valid_samples_path`."""
+    idx = pd.Index(valid_ids).intersection(phenotype.index, sort=False)
+    valid_ts = [valid_ts[i] for i in pd.Index(valid_ids).get_indexer(idx)]
+    n_rois = valid_ts[0].shape[1] if valid_ts else 0
+    n_edges = n_rois * (n_rois - 1) // 2
+    out = None
+    if memmap_path is not None:
+        out = create_connectome_memmap(memmap_path, idx, n_edges, dtype)
+    valid_samples_out = None
+    if valid_samples_path is not None:
+        valid_samples_out = create_connectome_memmap(
+            valid_samples_path, idx, n_edges, np.int32
+        )
+    subject_conn, valid_samples = pairwise_complete_connectomes(
+        valid_ts, dtype, out=out, valid_samples_out=valid_samples_out
+    )
+    if memmap_path is None:
+        subject_conn = pd.DataFrame(subject_conn, index=idx, copy=False)
+    else:
+        subject_conn.flush()
+        del out
+        subject_conn = load_connectome_memmap(memmap_path)
+    lengths = np.array([ts.shape[0] for ts in valid_ts], dtype=np.int32)
+    n_missing = int((valid_samples < lengths[:, np.newaxis]).sum())
+    print(f"Number of edges with missing volumes: {n_missing}")
+    if valid_samples_out is not None:
+        valid_samples_out.flush()
+    return subject_conn, phenotype.loc[idx, :]
+
+
+def _covariance_statistics(valid_ts):
+    """Covariance cache of each subject, from which all connectivity kinds
+    are derived.
+
+    Subjects with the same number of volumes are stacked and their
+    covariances computed with one batched matrix product.
+
+    Returns
+    -------
+    np.ndarray, shape (n_subjects, n_rois * (n_rois + 1) / 2 + 3)
+        Per subject, the lower triangle (with diagonal) of the empirical
+        covariance of the centered time series, the number of volumes and
+        the sums over volumes of the squared sum of squares of the raw and
+        of the standardised signals, needed by the Ledoit-Wolf shrinkage.
+    """
+    n_rois = valid_ts[0].shape[1] if valid_ts else 0
+    rows, cols = np.tril_indices(n_rois)
+    lower = rows * n_rois + cols
+    statistics = np.empty((len(valid_ts), len(lower) + 3))
+    # bound the memory of the (subject, ROI, ROI) batch
+    batch_size = max(1, CONNECTOME_BATCH_SIZE // max(n_rois, 1) ** 2)
+    lengths = np.array([ts.shape[0] for ts in valid_ts])
+    for length in np.unique(lengths):
+        same_length = np.flatnonzero(lengths == length)
+        for start in range(0, len(same_length), batch_size):
+            batch = same_length[start : start + batch_size]
+            timeseries = np.stack([valid_ts[i] for i in batch]).astype(np.float64)
+            timeseries -= timeseries.mean(axis=1, keepdims=True)
+            covariance = np.matmul(timeseries.transpose(0, 2, 1), timeseries)
+            covariance /= length
+            squared = timeseries**2
+            beta_raw = (squared.sum(axis=2) ** 2).sum(axis=1)
+            variance = squared.mean(axis=1, keepdims=True)
+            # constant signals stay at zero, as in nilearn's standardisation
+            squared /= np.where(variance == 0, 1, variance)
+            beta_standardised = (squared.sum(axis=2) ** 2).sum(axis=1)
+            statistics[batch, :-3] = covariance.reshape(len(batch), -1)[:, lower]
+            statistics[batch, -3] = length
+            statistics[batch, -2] = beta_raw
+            statistics[batch, -1] = beta_standardised
+    return statistics
+
+
+def _connectomes_from_covariances(
+    statistics, kind="correlation", dtype=np.float64, out=None
+):
+    """Flattened connectomes of the requested kind from the covariance cache
+    of `_covariance_statistics`, filled into `out` when given (e.g. an array
+    of `create_connectome_memmap`).
+
+    Same as nilearn's `ConnectivityMeasure(kind=kind, vectorize=True,
+    discard_diagonal=True)` with its default Ledoit-Wolf estimator: the
+    correlation is the shrunk covariance of the standardised signals, the
+    partial correlation takes one inverse of the shrunk covariance per
+    subject and the tangent space uses the geometric mean of the shrunk
+    covariances as reference.
+    """
+    if kind not in CONNECTIVITY_KINDS:
+        raise NotImplementedError(
+            f"Connectivity kind '{kind}' is not implemented. Select from "
+            f"{CONNECTIVITY_KINDS}."
+        )
+    n_subjects = statistics.shape[0]
+    n_rois = _statistics_n_rois(statistics)
+    rows, cols = np.tril_indices(n_rois, k=-1)
+    lower = rows * n_rois + cols
+    subject_conn = (
+        np.empty((n_subjects, len(lower)), dtype=dtype) if out is None else out
+    )
+    if n_subjects == 0:
+        return subject_conn
+
+    if kind == "tangent":
+        if n_subjects <= 1:
+            raise ValueError(
+                "Tangent space parametrization can only be applied to a "
+                "group of subjects."
+            )
+        covariances = _shrunk_covariances(statistics, standardise=False)
+        whitening = _map_eigenvalues(
+            lambda x: 1.0 / np.sqrt(x), _geometric_mean(covariances)
+        )
+        covariances = _map_eigenvalues(np.log, whitening @ covariances @ whitening)
+        subject_conn[:] = covariances.reshape(n_subjects, -1)[:, lower]
+        return subject_conn
+
+    batch_size = max(1, CONNECTOME_BATCH_SIZE // n_rois**2)
+    for start in range(0, n_subjects, batch_size):
+        batch = slice(start, start + batch_size)
+        if kind == "correlation":
+            connectivity = _cov_to_corr(
+                _shrunk_covariances(statistics[batch], standardise=True)
+            )
+        else:
+            precision = np.linalg.inv(
+                _shrunk_covariances(statistics[batch], standardise=False)
+            )
+            connectivity = -_cov_to_corr(precision)
+        subject_conn[batch] = connectivity.reshape(len(connectivity), -1)[:, lower]
+    return subject_conn
+
+
+def _shrunk_covariances(statistics, standardise=False):
+    """Ledoit-Wolf shrunk covariances, (subject, ROI, ROI), of the raw or
+    standardised signals, from the covariance cache. The shrinkage is that
+    of `sklearn.covariance.ledoit_wolf_shrinkage`."""
+    n_subjects = statistics.shape[0]
+    n_features = _statistics_n_rois(statistics)
+    rows, cols = np.tril_indices(n_features)
+    covariance = np.empty((n_subjects, n_features, n_features))
+    covariance[:, rows, cols] = statistics[:, :-3]
+    covariance[:, cols, rows] = statistics[:, :-3]
+    n_samples = statistics[:, -3]
+    beta_ = statistics[:, -1] if standardise else statistics[:, -2]
+    diagonal = np.arange(n_features)
+    if standardise:
+        # constant signals keep a zero variance, as in nilearn
+        scale = np.sqrt(covariance[:, diagonal, diagonal])
+        scale[scale == 0] = 1
+        covariance /= scale[:, :, np.newaxis]
+        covariance /= scale[:, np.newaxis, :]
+
+    emp_cov_trace = covariance[:, diagonal, diagonal].sum(axis=1)
+    mu = emp_cov_trace / n_features
+    delta_ = (covariance**2).sum(axis=(1, 2))
+    beta = (beta_ / n_samples - delta_) / (n_features * n_samples)
+    delta = (delta_ - 2.0 * mu * emp_cov_trace + n_features * mu**2) / n_features
+    beta = np.minimum(beta, delta)
+    shrinkage = np.divide(beta, delta, out=np.zeros_like(beta), where=beta != 0)
+
+    covariance *= (1 - shrinkage)[:, np.newaxis, np.newaxis]
+    covariance[:, diagonal, diagonal] += (shrinkage * mu)[:, np.newaxis]
+    return covariance
+
+
+def _statistics_n_rois(statistics):
+    """Number of ROIs of the covariance cache of `_covariance_statistics`."""
+    return int((np.sqrt(8 * (statistics.shape[1] - 3) + 1) - 1) / 2)
+
+
+def _cov_to_corr(covariance):
+    """Batched nilearn.connectome.cov_to_corr; zero variances give zero
+    correlations and a unit diagonal."""
+    diagonal = np.arange(covariance.shape[-1])
+    scale = np.sqrt(covariance[:, diagonal, diagonal])
+    scale[scale == 0] = 1
+    correlation = covariance / scale[:, :, np.newaxis] / scale[:, np.newaxis, :]
+    correlation[:, diagonal, diagonal] = 1
+    return correlation
+
+
+def _map_eigenvalues(function, symmetric):
+    """Apply a function to the eigenvalues of (a stack of) real symmetric
+    matrices."""
+    eigenvalues, eigenvectors = np.linalg.eigh(symmetric)
+    return (eigenvectors * function(eigenvalues)[..., np.newaxis, :]) @ np.swapaxes(
+        eigenvectors, -1, -2
+    )
+
+
+def _geometric_mean(matrices, max_iter=30, tol=1e-7):
+    """Geometric mean of symmetric positive definite matrices, with the
+    gradient descent of nilearn's tangent space embedding."""
+    gmean = matrices.mean(axis=0)
+    norm_old = np.inf
+    step = 1.0
+    for _ in range(max_iter):
+        vals_gmean, vecs_gmean = np.linalg.eigh(gmean)
+        gmean_inv_sqrt = (vecs_gmean / np.sqrt(vals_gmean)) @ vecs_gmean.T
+        logs_mean = _map_eigenvalues(
+            np.log, gmean_inv_sqrt @ matrices @ gmean_inv_sqrt
+        ).mean(axis=0)
+        if np.any(np.isnan(logs_mean)):
+            raise FloatingPointError("Nan value after logarithm operation.")
+        norm = np.linalg.norm(logs_mean)
+        gmean_sqrt = (vecs_gmean * np.sqrt(vals_gmean)) @ vecs_gmean.T
+        gmean = gmean_sqrt @ _map_eigenvalues(lambda x: np.exp(x * step), logs_mean)
+        gmean = gmean @ gmean_sqrt
+        if norm < norm_old:
+            norm_old = norm
+        elif norm > norm_old:
+            step = step / 2.0
+            norm = norm_old
+        if tol is not None and norm / gmean.size < tol:
+            break
+    return gmean
+
+
+def save_connectome_memmap(connectomes, path):
+    """Save flattened connectomes to be memory-mapped.
+
+    Parameters
+    ----------
+
+    connectomes : pandas.DataFrame
+        Flattened connectomes, subjects by edges.
+
+    path : pathlib.Path
+        Path without suffix. The edges are saved in `<path>.npy` and the
+        subject ids in `<path>.tsv`; the suffixes are appended to the file
+        name.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    np.save(_suffixed(path, ".npy"), connectomes.values)
+    pd.Series(connectomes.index, name="participant_id").to_csv(
+        _suffixed(path, ".tsv"), sep="\t", index=False
+    )
+
+
+def create_connectome_memmap(path, subjects, n_edges, dtype=np.float64):
+    """Create the files of `save_connectome_memmap` for connectomes filled
+    by blocks, without holding them in memory.
+
+    Parameters
+    ----------
+
+    path : pathlib.Path
+        Path without suffix.
+
+    subjects : list
+        Subject ids, in row order.
+
+    n_edges : int
+        Number of edges of the flattened connectomes.
+
+    dtype : {numpy.float64, numpy.float32}
+        Precision of the connectomes.
+
+    Returns
+    -------
+    numpy.memmap
+        Writable (subject, edge) array backed by `<path>.npy`.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    pd.Series(subjects, name="participant_id").to_csv(
+        _suffixed(path, ".tsv"), sep="\t", index=False
+    )
+    return np.lib.format.open_memmap(
+        _suffixed(path, ".npy"), mode="w+", dtype=dtype, shape=(len(subjects), n_edges)
+    )
+
+
+def load_connectome_memmap(path):
+    """Load connectomes saved by `save_connectome_memmap`.
+
+    Parameters
+    ----------
+
+    path : pathlib.Path
+        Path without suffix.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Flattened connectomes backed by a read-only memory-mapped array;
+        edges are only read from disk when accessed.
+    """
+    path = Path(path)
+    values = np.load(_suffixed(path, ".npy"), mmap_mode="r")
+    subjects = pd.read_csv(_suffixed(path, ".tsv"), sep="\t")["participant_id"]
+    return pd.DataFrame(values, index=subjects.tolist(), copy=False)
+
+
+def connectome_store_path(
+    store_root, dataset, fmriprep_version, file_pattern, reader=TIMESERIES_READER
+):
+    """Location of the covariance cache of one dataset, fMRIPrep version,
+    atlas, dimension, strategy and time series reader in the connectome
+    store.
+
+    Parameters
+    ----------
+
+    store_root : pathlib.Path
+        Root of the connectome store.
+
+    dataset : str
+        Name of the dataset.
+
+    fmriprep_version : str
+        fMRIPrep version used for preprocessing.
+
+    file_pattern : str
+        "atlas-<atlas>_nroi-<dimension>_desc-<strategy>".
+
+    reader : str
+        Name of the parser of the time series files, as the same file gives
+        different time series with and without a header row. Readers other
+        than `TIMESERIES_READER` get their own cache.
+
+    Returns
+    -------
+    pathlib.Path
+        Path without suffix, see `save_connectome_memmap`.
+    """
+    name = file_pattern
+    if reader != TIMESERIES_READER:
+        name = f"{name}_reader-{reader}"
+    return (
+        Path(store_root)
+        / f"dataset-{dataset}"
+        / fmriprep_version
+        / f"{name}_covariance"
+    )
+
+
+def load_connectome_store(
+    path, sources, load_timeseries, compute=None, reader=TIMESERIES_READER
+):
+    """Load the covariance cache from the store, updating it first if needed.
+
+    Each subject's row is kept with the modification time and size of the
+    time series file it was computed from. Subjects that are missing from
+    the store or whose file changed are recomputed and the store rewritten;
+    otherwise nothing is read but the memory-mapped array.
+
+    Parameters
+    ----------
+
+    path : pathlib.Path
+        Store location, see `connectome_store_path`.
+
+    sources : dict
+        Subject id to the path of its time series tsv file.
+
+    load_timeseries : callable
+        Read a time series file into a time by ROI array.
+
+    compute : None or callable
+        Per-subject rows of a list of time series. Default to the covariance
+        cache `_covariance_statistics`, from which connectomes of all kinds
+        are derived by `_connectomes_from_covariances`.
+
+    reader : str
+        Name of `load_timeseries`, recorded in `<path>.json`. A store
+        written by another reader, or before the reader was recorded, is
+        rebuilt.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Rows of the subjects in `sources`, in that order.
+        Backed by the memory-mapped store when all stored subjects are
+        requested in the stored order, a copy of the rows otherwise.
+    """
+    path = Path(path)
+    compute = _covariance_statistics if compute is None else compute
+    if not sources:
+        return pd.DataFrame()
+    manifest = _source_manifest(sources)
+    stored = None
+    stale = np.ones(len(manifest), dtype=bool)
+    stored_reader = None
+    if _suffixed(path, ".json").is_file():
+        with open(_suffixed(path, ".json"), "r") as file:
+            stored_reader = json.load(file).get("reader")
+    has_store = _suffixed(path, ".npy").is_file() and _suffixed(path, ".tsv").is_file()
+    if has_store and stored_reader != reader:
+        print(f"Connectome store {path} was not read with {reader}; rebuilding.")
+    elif has_store:
+        stored = load_connectome_memmap(path)
+        stored_manifest = pd.read_csv(
+            _suffixed(path, ".tsv"), sep="\t", index_col="participant_id"
+        )
+        known = manifest.index.isin(stored_manifest.index)
+        columns = ["mtime_ns", "size"]
+        stale[known] = (
+            stored_manifest.loc[manifest.index[known], columns].values
+            != manifest.loc[known, columns].values
+        ).any(axis=1)
+
+    if stale.any():
+        print(f"Update {stale.sum()} subjects in the connectome store {path}.")
+        stale_ids = manifest.index[stale].tolist()
+        computed = compute(
+            _read_timeseries_parallel(
+                {subject: sources[subject] for subject in stale_ids}, load_timeseries
+            )
+        )
+        computed = pd.DataFrame(computed, index=stale_ids, copy=False)
+        if stored is not None:
+            # keep rows of subjects not requested this time
+            kept = stored.index.difference(stale_ids, sort=False)
+            computed = pd.concat((stored.loc[kept], computed))
+            stored_manifest = stored_manifest.loc[kept]
+            manifest = pd.concat((stored_manifest, manifest.loc[stale_ids]))
+        else:
+            manifest = manifest.loc[stale_ids]
+        computed = computed.sort_index()
+        manifest = manifest.loc[computed.index]
+        del stored
+        save_connectome_memmap(computed, path)
+        manifest.to_csv(
+            _suffixed(path, ".tsv"), sep="\t", index_label="participant_id"
         )
-    return subject_conn, phenotype
+        with open(_suffixed(path, ".json"), "w") as file:
+            json.dump({"reader": reader}, file)
+        stored = load_connectome_memmap(path)
+
+    subjects = list(sources)
+    if stored.index.tolist() == subjects:
+        return stored
+    return stored.loc[subjects]
+
+
+def _suffixed(path, suffix):
+    """Append a suffix; strategy names such as "scrubbing.5" contain dots,
+    so `Path.with_suffix` cannot be used."""
+    return path.parent / f"{path.name}{suffix}"
 
 
-def check_extraction(input_path, extracted_path_root=None):
+def _source_manifest(sources):
+    """Modification time and size of the time series file of each subject."""
+    manifest = {}
+    for subject, file_path in sources.items():
+        stat = Path(file_path).stat()
+        manifest[subject] = {
+            "source": str(file_path),
+            "mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size,
+        }
+    manifest = pd.DataFrame.from_dict(
+        manifest, orient="index", columns=["source", "mtime_ns", "size"]
+    )
+    manifest.index.name = "participant_id"
+    return manifest
+
+
+def check_extraction(input_path, extracted_path_root=None, patterns=None):
     """Check if the tar.gz of a fmriprep dataset has been extracted.
 
     Parameters
@@ -117,6 +760,13 @@ def check_extraction(input_path, extracted_path_root=None):
     extracted_path_root : None, pathlib.Path
         Destination of the extraction.
 
+    patterns : None or list of str
+        Shell-style patterns of the file names to extract, such as
+        `EXTRACTION_PATTERNS` for the TSV and JSON files. Default to None,
+        the whole archive. The patterns of a partial extraction are recorded
+        in `<extracted dataset>.patterns.json`, and files matching other
+        patterns are extracted when they are requested later.
+
     Returns
     -------
 
@@ -127,32 +777,371 @@ def check_extraction(input_path, extracted_path_root=None):
     extracted_path_root = inputs if extracted_path_root is None else extracted_path_root
 
     extracted_path = extracted_path_root / dir_name
+    record_path = _suffixed(extracted_path, ".patterns.json")
 
-    if not extracted_path.is_dir() and input_path.is_file():
+    if not input_path.is_file():
+        return extracted_path
+    if not extracted_path.is_dir():
         print(f"Cannot file extracted file at {extracted_path}. " "Extracting...")
-        with tarfile.open(input_path, "r:gz") as tar:
+        extracted, missing = [], patterns
+    elif not record_path.is_file():
+        return extracted_path
+    else:
+        with open(record_path, "r") as file:
+            extracted = json.load(file)
+        if patterns is not None and set(patterns) <= set(extracted):
+            return extracted_path
+        missing = None if patterns is None else sorted(set(patterns) - set(extracted))
+        print(
+            f"{extracted_path} only contains the files matching {extracted}. "
+            f"Extracting {'all files' if missing is None else missing}..."
+        )
+
+    if missing is None:
+        with tarfile.open(input_path, "r:*") as tar:
             tar.extractall(extracted_path_root)
+        record_path.unlink(missing_ok=True)
+    else:
+        extract_tar_members(input_path, extracted_path_root, missing)
+        with open(record_path, "w") as file:
+            json.dump(sorted(set(extracted) | set(missing)), file)
     return extracted_path
 
 
+def tar_member_index(input_path):
+    """
+    Name, size and data offset of the regular files of a tar archive.
+
+    The index is built with one pass over the archive headers and saved
+    next to it as `<archive>.members.json`. It is read back until the
+    modification time or size of the archive changes.
+
+    Parameters
+    ----------
+
+    input_path : pathlib.Path
+        Location of the tar archive, compressed or not.
+
+    Returns
+    -------
+
+    list of [str, int, int]
+        Member name, size and offset of its data in the uncompressed
+        archive, in archive order.
+    """
+    members = _cached_member_index(input_path)
+    if members is not None:
+        return members
+
+    print(f"Index members of {input_path}...")
+    members = []
+    with tarfile.open(input_path, "r|*") as tar:
+        for member in tar:
+            if member.isfile():
+                members.append([member.name, member.size, member.offset_data])
+    _save_member_index(input_path, members)
+    return members
+
+
+def _cached_member_index(input_path):
+    """Members saved in `<archive>.members.json`, None if missing or stale."""
+    index_path = _suffixed(Path(input_path), ".members.json")
+    if not index_path.is_file():
+        return None
+    stat = Path(input_path).stat()
+    with open(index_path, "r") as file:
+        index = json.load(file)
+    if index["mtime_ns"] == stat.st_mtime_ns and index["size"] == stat.st_size:
+        return index["members"]
+    return None
+
+
+def _save_member_index(input_path, members):
+    """Save the member index next to the archive, if the folder is writable."""
+    index_path = _suffixed(Path(input_path), ".members.json")
+    stat = Path(input_path).stat()
+    index = {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "members": members}
+    try:
+        with open(index_path, "w") as file:
+            json.dump(index, file)
+    except OSError:
+        print(f"Cannot save the member index at {index_path}.")
+
+
+def read_tar_members(input_path, patterns):
+    """
+    Read the files of a tar archive matching the patterns, without writing
+    them to disk.
+
+    Uncompressed archives are read at the offsets of the member index.
+    Compressed archives are decompressed in a single streaming pass: the
+    members are matched as they are read, and the member index is saved on
+    the way. When a valid index already exists, the stream stops after the
+    last matching member.
+
+    Parameters
+    ----------
+
+    input_path : pathlib.Path
+        Location of the tar archive.
+
+    patterns : list of str
+        Shell-style patterns matched against the file names, such as
+        "*_timeseries.tsv".
+
+    Yields
+    ------
+
+    str, bytes
+        Member name and content.
+    """
+    if not _is_compressed(input_path):
+        wanted = [
+            (name, size, offset)
+            for name, size, offset in tar_member_index(input_path)
+            if _match_member(name, patterns)
+        ]
+        with open(input_path, "rb") as file:
+            for name, size, offset in wanted:
+                file.seek(offset)
+                yield name, file.read(size)
+        return
+
+    members = _cached_member_index(input_path)
+    if members is not None:
+        wanted = {name for name, _, _ in members if _match_member(name, patterns)}
+        if not wanted:
+            return
+    index = []
+    with tarfile.open(input_path, "r|*") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            index.append([member.name, member.size, member.offset_data])
+            if members is None:
+                if _match_member(member.name, patterns):
+                    yield member.name, tar.extractfile(member).read()
+            elif member.name in wanted:
+                yield member.name, tar.extractfile(member).read()
+                wanted.remove(member.name)
+                if not wanted:
+                    return
+    if members is None:
+        _save_member_index(input_path, index)
+
+
+def extract_tar_members(input_path, extracted_path_root, patterns):
+    """
+    Extract the files of a tar archive matching the patterns.
+
+    Parameters
+    ----------
+
+    input_path : pathlib.Path
+        Location of the tar archive.
+
+    extracted_path_root : pathlib.Path
+        Destination of the extraction.
+
+    patterns : list of str
+        Shell-style patterns matched against the file names.
+
+    Returns
+    -------
+
+    list of pathlib.Path
+        Extracted files.
+    """
+    extracted_path_root = Path(extracted_path_root)
+    root = extracted_path_root.resolve()
+    start, n_bytes, extracted = time.perf_counter(), 0, []
+    for name, content in read_tar_members(input_path, patterns):
+        file_path = extracted_path_root / name
+        if root not in file_path.resolve().parents:
+            raise ValueError(f"Member {name} is outside of {extracted_path_root}.")
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        file_path.write_bytes(content)
+        n_bytes += len(content)
+        extracted.append(file_path)
+    elapsed = time.perf_counter() - start
+    print(
+        f"Extracted {len(extracted)} files ({n_bytes / 1e6:.1f} MB) matching "
+        f"{patterns} in {elapsed:.2f} s."
+    )
+    return extracted
+
+
+def _match_member(name, patterns):
+    """Whether the file name of a member matches one of the patterns."""
+    file_name = name.rsplit("/", 1)[-1]
+    return any(fnmatch.fnmatch(file_name, pattern) for pattern in patterns)
+
+
+def _is_compressed(input_path):
+    """Whether the archive is gzip, bzip2 or xz compressed."""
+    with open(input_path, "rb") as file:
+        magic = file.read(6)
+    return magic.startswith((b"\x1f\x8b", b"BZh", b"\xfd7zXZ"))
+
+
+def load_timeseries(
+    atlas,
+    extracted_path,
+    participant_id,
+    file_pattern,
+    n_jobs=-1,
+    backend="threading",
+    dtype=np.float64,
+):
+    """Load the time series of all subjects into a single array.
+
+    The time series files are indexed with one walk of the atlas directory
+    and parsed concurrently.
+
+    Parameters
+    ----------
+
+    atlas : str
+        Atlas name matching keys in fmriprep_denoise.dataset.atlas.ATLAS_METADATA.
+
+    extracted_path : pathlib.Path
+        Path object to where the time series were saved.
+
+    participant_id : list of str
+        Subjects to load.
+
+    file_pattern : str
+        Details about the atlas and description of the file.
+
+    n_jobs : int
+        Number of concurrent readers.
+
+    backend : str {"threading", "loky"}
+        joblib backend of the readers; threads or processes.
+
+    dtype : {numpy.float64, numpy.float32}
+        Precision of the time series.
+
+    Returns
+    -------
+    list, np.ndarray, np.ndarray
+        Ids of the subjects with a valid file, time series of shape
+        (n_subjects, n_volumes, n_rois) padded with NaN to the longest
+        subject, and the (n_subjects, n_volumes) mask of valid volumes.
+    """
+    sources = _find_timeseries_files(atlas, extracted_path, participant_id, file_pattern)
+    valid_ts = _read_timeseries_parallel(sources, n_jobs=n_jobs, backend=backend)
+    timeseries, mask = stack_timeseries(valid_ts, dtype)
+    return list(sources), timeseries, mask
+
+
+def stack_timeseries(valid_ts, dtype=np.float64):
+    """Stack time series of different lengths into a NaN padded array.
+
+    Parameters
+    ----------
+
+    valid_ts : list of np.ndarray
+        Time series of shape (n_volumes, n_rois) of each subject.
+
+    dtype : {numpy.float64, numpy.float32}
+        Precision of the stacked array.
+
+    Returns
+    -------
+    np.ndarray, np.ndarray
+        Time series of shape (n_subjects, n_volumes, n_rois) and the
+        (n_subjects, n_volumes) mask of valid volumes.
+    """
+    lengths = np.array([ts.shape[0] for ts in valid_ts], dtype=int)
+    n_volumes = lengths.max() if valid_ts else 0
+    n_rois = valid_ts[0].shape[1] if valid_ts else 0
+    timeseries = np.full((len(valid_ts), n_volumes, n_rois), np.nan, dtype=dtype)
+    for i, ts in enumerate(valid_ts):
+        timeseries[i, : ts.shape[0]] = ts
+    mask = np.arange(n_volumes) < lengths[:, np.newaxis]
+    return timeseries, mask
+
+
 def _load_valid_timeseries(atlas, extracted_path, participant_id, file_pattern):
     """Load time series from tsv file."""
-    valid_ids, valid_ts = [], []
+    sources = _find_timeseries_files(atlas, extracted_path, participant_id, file_pattern)
+    valid_ids = list(sources)
+    valid_ts = _read_timeseries_parallel(sources)
+    return valid_ids, valid_ts
+
+
+def _read_timeseries_parallel(
+    sources, reader=None, n_jobs=-1, backend="threading"
+):
+    """Parse the time series files concurrently and report the throughput."""
+    reader = _read_timeseries if reader is None else reader
+    start = time.perf_counter()
+    valid_ts = Parallel(n_jobs=n_jobs, backend=backend)(
+        delayed(reader)(file_path) for file_path in sources.values()
+    )
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    n_bytes = sum(ts.nbytes for ts in valid_ts)
+    print(
+        f"Loaded {len(valid_ts)} time series ({n_bytes / 1e6:.1f} MB) in "
+        f"{elapsed:.2f} s: {len(valid_ts) / elapsed:.1f} files/s, "
+        f"{n_bytes / 1e6 / elapsed:.1f} MB/s."
+    )
+    return valid_ts
+
+
+def _find_timeseries_files(atlas, extracted_path, participant_id, file_pattern):
+    """Time series file of each subject, skipping missing and empty files."""
+    index = _index_timeseries_files(Path(extracted_path) / f"atlas-{atlas}", file_pattern)
+    sources = {}
     for subject in participant_id:
-        subject_path = extracted_path / f"atlas-{atlas}" / subject
-        file_path = list(
-            subject_path.glob(f"{subject}_*_{file_pattern}_timeseries.tsv")
-        )
+        file_path = index.get(subject, [])
         if not file_path:
             print(f"No file found for subject {subject} with pattern {file_pattern}. Skipping...")
             continue
         if len(file_path) > 1:
             raise ValueError("Found more than one valid file." f"{file_path}")
-        file_path = file_path[0]
-        if file_path.stat().st_size > 1:
-            ts = pd.read_csv(file_path, sep="\t", header=0)
-            valid_ids.append(subject)
-            valid_ts.append(ts.values)
-        else:
-            continue
-    return valid_ids, valid_ts
+        file_path, size = file_path[0]
+        if size > 1:
+            sources[subject] = file_path
+    return sources
+
+
+def _index_timeseries_files(root, file_pattern):
+    """Map each subject to its "<subject>_*_<file_pattern>_timeseries.tsv"
+    files and their size, in a single walk of the subject directories under
+    `root`."""
+    suffix = f"_{file_pattern}_timeseries.tsv"
+    index = {}
+    for dirpath, _, filenames in os.walk(root):
+        subject = os.path.basename(dirpath)
+        prefix = f"{subject}_"
+        for name in filenames:
+            if (
+                name.startswith(prefix)
+                and name.endswith(suffix)
+                and len(name) >= len(prefix) + len(suffix)
+            ):
+                file_path = Path(dirpath) / name
+                index.setdefault(subject, []).append(
+                    (file_path, os.stat(file_path).st_size)
+                )
+    return index
+
+
+def _index_timeseries_patterns(root):
+    """File patterns "atlas-<atlas>_nroi-<dimension>_desc-<strategy>" of all
+    the time series files under `root`, in a single walk."""
+    suffix = "_timeseries.tsv"
+    patterns = set()
+    for _, _, filenames in os.walk(root):
+        for name in filenames:
+            start = name.find("_atlas-")
+            if start >= 0 and name.endswith(suffix):
+                patterns.add(name[start + 1 : -len(suffix)])
+    return patterns
+
+
+def _read_timeseries(file_path):
+    """Read a time series tsv file with ROI names as header."""
+    return pd.read_csv(file_path, sep="\t", header=0).values
@@ -1,17 +1,27 @@
 import json
-import tarfile
 from pathlib import Path
 import pandas as pd
-from nilearn.connectome import ConnectivityMeasure
-from sklearn.impute import SimpleImputer
 import numpy as np
 from fmriprep_denoise.visualization import tables
+from fmriprep_denoise.features.derivatives import (
+    PAIRWISE_KIND,
+    check_extraction,
+    connectome_store_path,
+    load_connectome_store,
+    _pairwise_connectome_frames,
+    _connectomes_from_covariances,
+    _covariance_statistics,
+    _index_timeseries_files,
+    _read_timeseries_parallel,
+)
 
 
 MOTION_QC_FILE = "motion_qc.json"
 project_root = Path(__file__).parents[2]
 inputs = project_root / "data"
 group_info_column = {"ds000228": "Child_Adult", "ds000030": "diagnosis"}
+# header-less time series, see `_read_timeseries`
+TIMESERIES_READER = "headerless"
 
 
 def get_qc_criteria(strategy_name=None):
@@ -59,6 +69,9 @@ def compute_connectome(
     gross_fd=None,
     fd_thresh=None,
     proportion_thresh=None,
+    dtype=np.float64,
+    store_root=None,
+    kind="correlation",
 ):
     """Compute connectome of all valid data.
 
@@ -82,6 +95,18 @@ def compute_connectome(
         Threshold for FD (optional).
     proportion_thresh : optional
         Threshold for proportion (optional).
+    dtype : {numpy.float64, numpy.float32}
+        Precision of the connectomes. float32 halves the memory of the
+        subject by edge matrix; edges differ from float64 by less than 1e-7.
+    store_root : None or pathlib.Path
+        Root of the persistent connectome store. If set, the covariances
+        are read by memory-map from the store and only estimated for
+        subjects whose time series are new or changed.
+    kind : str {"correlation", "partial correlation", "tangent", \
+            "pairwise correlation"}
+        Connectivity measure, derived from the cached covariances.
+        "pairwise correlation" correlates ROIs with missing values over the
+        volumes where both are present, with no imputation and no store.
 
     Returns
     -------
@@ -92,21 +117,40 @@ def compute_connectome(
         dataset, fmriprep_version, path_root, gross_fd, fd_thresh, proportion_thresh
     )
     participant_id = phenotype.index.tolist()
-    valid_ids, valid_ts = _load_valid_timeseries(
-        atlas, extracted_path, participant_id, file_pattern, full_roi_list  # pass rois 
-    )
+    if kind == PAIRWISE_KIND:
+        valid_ids, valid_ts = _load_valid_timeseries(
+            atlas, extracted_path, participant_id, file_pattern, full_roi_list
+        )
+        print(f"Number of time series loaded: {len(valid_ts)}")
+        return _pairwise_connectome_frames(valid_ids, valid_ts, phenotype, dtype)
+    if store_root is not None:
+        sources = _find_timeseries_files(extracted_path, participant_id, file_pattern)
+        print(f"Number of time series found: {len(sources)}")
+        statistics = load_connectome_store(
+            connectome_store_path(
+                store_root, dataset, fmriprep_version, file_pattern, TIMESERIES_READER
+            ),
+            sources,
+            lambda file_path: _read_timeseries(file_path, full_roi_list),
+            reader=TIMESERIES_READER,
+        )
+    else:
+        valid_ids, valid_ts = _load_valid_timeseries(
+            atlas, extracted_path, participant_id, file_pattern, full_roi_list  # pass rois 
+        )
 
-    # Print the number of time series loaded
-    print(f"Number of time series loaded: {len(valid_ts)}")
-    if len(valid_ts) == 0:
-        print(f"Matching file pattern was: {file_pattern}")
-    
-    # Compute connectivity using the correlation measure
-    correlation_measure = ConnectivityMeasure(
-        kind="correlation", vectorize=True, discard_diagonal=True
-    )
-    subject_conn = correlation_measure.fit_transform(valid_ts)
-    subject_conn = pd.DataFrame(subject_conn, index=valid_ids)
+        # Print the number of time series loaded
+        print(f"Number of time series loaded: {len(valid_ts)}")
+        if len(valid_ts) == 0:
+            print(f"Matching file pattern was: {file_pattern}")
+
+        # Estimate the covariances once, all connectivity kinds derive from them
+        statistics = pd.DataFrame(
+            _covariance_statistics(valid_ts), index=valid_ids, copy=False
+        )
+
+    subject_conn = _connectomes_from_covariances(statistics.values, kind, dtype)
+    subject_conn = pd.DataFrame(subject_conn, index=statistics.index, copy=False)
     
     if subject_conn.shape[0] != phenotype.shape[0]:
         print("Taking conjunction of the phenotype and connectome.")
@@ -119,58 +163,40 @@ def compute_connectome(
     return subject_conn, phenotype
 
 
-def check_extraction(input_path, extracted_path_root=None):
-    """Check if the tar.gz of a fmriprep dataset has been extracted.
-
-    Parameters
-    ----------
-
-    input_path : pathlib.Path
-        Location of the tar.gz of the fMRIPrep output.
-
-    extracted_path_root : None, pathlib.Path
-        Destination of the extraction.
-
-    Returns
-    -------
-
-    pathlib.Path
-        Correct file path of the extracted dataset.
-    """
-    dir_name = input_path.name.split(".tar")[0]
-    extracted_path_root = inputs if extracted_path_root is None else extracted_path_root
-
-    extracted_path = extracted_path_root / dir_name
-
-    if not extracted_path.is_dir() and input_path.is_file():
-        print(f"Cannot file extracted file at {extracted_path}. " "Extracting...")
-        with tarfile.open(input_path, "r:gz") as tar:
-            tar.extractall(extracted_path_root)
-    return extracted_path
-
-
 def _load_valid_timeseries(atlas, extracted_path, participant_id, file_pattern, full_roi_list):
     """Load time series from tsv file and align the columns to the full ROI list."""
-    valid_ids, valid_ts = [], []
+    sources = _find_timeseries_files(extracted_path, participant_id, file_pattern)
+    valid_ids = list(sources)
+    valid_ts = _read_timeseries_parallel(
+        sources, lambda file_path: _read_timeseries(file_path, full_roi_list)
+    )
+    return valid_ids, valid_ts
+
+
+def _find_timeseries_files(extracted_path, participant_id, file_pattern):
+    """Time series file of each subject, skipping missing and empty files.
+    The subject directories are indexed with a single walk."""
+    index = _index_timeseries_files(extracted_path, file_pattern)  # <-- FIXED
+    sources = {}
     for subject in participant_id:
-        subject_path = extracted_path / subject  # <-- FIXED
-        file_path = list(
-            subject_path.glob(f"{subject}_*_{file_pattern}_timeseries.tsv")
-        )
-        print("Load_valid_timeseries from: " + str(file_path))
+        file_path = index.get(subject, [])
+        print("Load_valid_timeseries from: " + str([f for f, _ in file_path]))
         if len(file_path) > 1:
             raise ValueError("Found more than one valid file: " + str(file_path))
         if not file_path:
             continue
-        file_path = file_path[0]
-        if file_path.stat().st_size > 1:
-            df = pd.read_csv(file_path, sep="\t", header=None)
-            df.columns = full_roi_list
-            valid_ids.append(subject)
-            valid_ts.append(df.values)
-        else:
-            continue
-    return valid_ids, valid_ts
+        file_path, size = file_path[0]
+        if size > 1:
+            sources[subject] = file_path
+    return sources
+
+
+def _read_timeseries(file_path, full_roi_list):
+    """Read a header-less time series tsv file with one column per ROI of
+    the full ROI list."""
+    df = pd.read_csv(file_path, sep="\t", header=None)
+    df.columns = full_roi_list
+    return df.values
 
 def load_full_roi_list(atlas_tsv_path):
     """
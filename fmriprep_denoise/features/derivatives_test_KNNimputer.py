@@ -6,6 +6,8 @@ from nilearn.connectome import ConnectivityMeasure
 from sklearn.impute import SimpleImputer, KNNImputer
 import numpy as np
 from fmriprep_denoise.visualization import tables
+from fmriprep_denoise.features.derivatives import _pairwise_connectome_frames
+from fmriprep_denoise.features.roi_subset import ROISubset
 
 MOTION_QC_FILE = "motion_qc.json"
 project_root = Path(__file__).parents[2]
@@ -56,6 +58,10 @@ def compute_connectome(
         valid_ts, missing_matrix, full_roi_list, threshold=0.10, impute_strategy=impute_strategy
     )
 
+    if impute_strategy == "pairwise":
+        # correlations over the volumes where both ROIs are present
+        return _pairwise_connectome_frames(valid_ids, valid_ts, phenotype)
+
     correlation_measure = ConnectivityMeasure(
         kind="correlation", vectorize=True, discard_diagonal=True
     )
@@ -70,14 +76,13 @@ def compute_connectome(
     return subject_conn, phenotype
 
 def handle_missing_data_strategy_b(subject_ts_list, missing_matrix, roi_labels, threshold=0.10, impute_strategy="mean"):
-    roi_missing_rate = np.mean(missing_matrix, axis=0)
-    roi_mask = roi_missing_rate < threshold
-    kept_roi_labels = np.array(roi_labels)[roi_mask]
+    roi_subset = ROISubset.from_missing_rate(missing_matrix, threshold, roi_labels)
+    roi_mask = roi_subset.roi_mask
 
     cleaned_ts = []
     for subj_ts in subject_ts_list:
-        ts_filtered = subj_ts[:, roi_mask]
-        if np.isnan(ts_filtered).any():
+        ts_filtered = roi_subset.subset_rois(subj_ts)
+        if np.isnan(ts_filtered).any() and impute_strategy != "pairwise":
             if impute_strategy == "mean":
                 imputer = SimpleImputer(missing_values=np.nan, strategy="mean")
                 ts_filtered = imputer.fit_transform(ts_filtered)
@@ -88,7 +93,7 @@ def handle_missing_data_strategy_b(subject_ts_list, missing_matrix, roi_labels,
                 raise ValueError(f"Unsupported impute_strategy: {impute_strategy}")
         cleaned_ts.append(ts_filtered)
 
-    return cleaned_ts, kept_roi_labels.tolist(), roi_mask
+    return cleaned_ts, roi_subset.kept_labels, roi_mask
 
 def check_extraction(input_path, extracted_path_root=None):
     dir_name = input_path.name.split(".tar")[0]
@@ -1,3 +1,4 @@
+from functools import lru_cache
 from pathlib import Path
 
 import numpy as np
@@ -5,13 +6,16 @@ import pandas as pd
 from scipy.spatial import distance
 
 from fmriprep_denoise.dataset.atlas import fetch_atlas_path, ATLAS_METADATA
+from fmriprep_denoise.features.roi_subset import ROISubset
 from nilearn.image import index_img
 from nilearn.plotting import find_probabilistic_atlas_cut_coords
 
 from scipy.ndimage import center_of_mass
 import nibabel as nib
 
-def get_atlas_pairwise_distance(atlas_name, dimension, excluded_rois_path=None):
+def get_atlas_pairwise_distance(
+    atlas_name, dimension, excluded_rois_path=None, roi_subset=None
+):
     """
     Compute pairwise distance of nodes in the atlas.
 
@@ -26,32 +30,59 @@ def get_atlas_pairwise_distance(atlas_name, dimension, excluded_rois_path=None):
     excluded_rois_path : str or None
         Optional path to CSV containing a column 'roi_name' with ROIs to exclude.
 
+    roi_subset : None or ROISubset
+        Kept ROIs, used instead of `excluded_rois_path`.
+
     Returns
     -------
     pandas.DataFrame
-        Node ID pairs and the distance.
+        Node ID pairs and the distance. With excluded ROIs, the node IDs
+        stay those of the full atlas.
+    """
+    pairwise_distance = _full_pairwise_distance(atlas_name, str(dimension))
+    if roi_subset is None and excluded_rois_path is not None:
+        roi_subset = get_roi_subset(atlas_name, dimension, excluded_rois_path)
+    if roi_subset is not None:
+        pairwise_distance = roi_subset.subset_edges(pairwise_distance, axis=0)
+    print(f"Pairwise distance of shape: {pairwise_distance.shape}")
+    return pairwise_distance.reset_index(drop=True)
+
+
+def get_roi_subset(atlas_name, dimension, excluded_rois_path):
+    """
+    ROIs of the atlas not listed in the column 'roi_name' of
+    `excluded_rois_path`, matched to the ROI names of the centroids.
+
+    Returns
+    -------
+    ROISubset
+        Kept ROIs and edges.
     """
+    centroids_df = _load_centroids(atlas_name, dimension)
+    return ROISubset.from_csv(centroids_df["roi"], excluded_rois_path)
+
+
+@lru_cache(maxsize=None)
+def _full_pairwise_distance(atlas_name, dimension):
+    """Pairwise distance of all nodes of the atlas, computed once per atlas."""
     if atlas_name == "gordon333":
         file_dist = "atlas-gordon333_nroi-333_desc-distance.tsv"
         print(f"Loading precomputed distances for atlas '{atlas_name}' from {file_dist}")
         return pd.read_csv(Path(__file__).parent / "data" / file_dist, sep="\t")
 
     print(f"Fetching centroids for atlas: {atlas_name} with dimension: {dimension}")
-    centroids = get_centroid(atlas_name, dimension, excluded_rois_path=excluded_rois_path)
+    centroids = get_centroid(atlas_name, dimension)
 
     if centroids is None or not isinstance(centroids, np.ndarray) or centroids.ndim != 2 or centroids.shape[1] != 3:
         raise ValueError(f"Invalid centroids with shape {None if centroids is None else centroids.shape}")
 
     print("Computing pairwise distances using cdist...")
     pairwise_distance = distance.cdist(centroids, centroids)
-    # labels = range(1, pairwise_distance.shape[0] + 1)
-    labels = range(pairwise_distance.shape[0])  # 0-based indexing
-
-    pairwise_distance = pd.DataFrame(pairwise_distance, index=labels, columns=labels)
-    lower_mask = np.tril(np.ones(pairwise_distance.shape), k=-1).astype(bool)
-    pairwise_distance = pairwise_distance.where(lower_mask).stack().reset_index()
-    pairwise_distance.columns = ["row", "column", "distance"]
-
+    # lower triangle, 0-based indexing
+    rows, cols = np.tril_indices(pairwise_distance.shape[0], k=-1)
+    pairwise_distance = pd.DataFrame(
+        {"row": rows, "column": cols, "distance": pairwise_distance[rows, cols]}
+    )
     print(f"Pairwise distance computation complete. Returning distance dataframe with shape: {pairwise_distance.shape}")
     return pairwise_distance
 
@@ -78,6 +109,22 @@ def compute_roi_centroids(atlas_img_path, roi_labels):
     return pd.DataFrame(centroids)
 
 def get_centroid(atlas_name, dimension, excluded_rois_path=None):
+    centroids_df = _load_centroids(atlas_name, dimension)
+    if set(["x", "y", "z"]).issubset(centroids_df.columns):
+        centroids = centroids_df.loc[:, ["x", "y", "z"]].values
+    else:
+        raise ValueError(f"Centroid file of atlas '{atlas_name}' does not contain expected columns.")
+
+    if excluded_rois_path is not None:
+        roi_subset = ROISubset.from_csv(centroids_df["roi"], excluded_rois_path)
+        centroids = roi_subset.subset_rois(centroids, axis=0)
+
+    print(f"Centroids successfully loaded. Shape: {centroids.shape}")
+    return centroids
+
+
+def _load_centroids(atlas_name, dimension):
+    """ROI names and centroids of the atlas, generated on first use."""
     if atlas_name not in ATLAS_METADATA:
         raise NotImplementedError(f"Atlas '{atlas_name}' is not supported.")
 
@@ -103,20 +150,7 @@ def get_centroid(atlas_name, dimension, excluded_rois_path=None):
         print(f"Centroid file generated and saved to: {centroid_tsv_path}")
 
     print(f"Loading centroids from precomputed TSV: {centroid_tsv_path}")
-    centroids_df = pd.read_csv(centroid_tsv_path, sep="\t")
-
-    if excluded_rois_path is not None:
-        excluded_df = pd.read_csv(excluded_rois_path)
-        excluded_rois = excluded_df["roi_name"].astype(str).tolist()
-        centroids_df = centroids_df[~centroids_df["roi"].isin(excluded_rois)]
-
-    if set(["x", "y", "z"]).issubset(centroids_df.columns):
-        centroids = centroids_df.loc[:, ["x", "y", "z"]].values
-    else:
-        raise ValueError(f"Centroid file '{centroid_tsv_path}' does not contain expected columns.")
-
-    print(f"Centroids successfully loaded. Shape: {centroids.shape}")
-    return centroids
+    return pd.read_csv(centroid_tsv_path, sep="\t")
 
 def get_difumo_centroids(d):
     current_atlas = fetch_atlas_path("difumo", d)
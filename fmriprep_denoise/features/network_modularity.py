@@ -1,10 +1,36 @@
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+
 import numpy as np
+from joblib import Parallel, cpu_count, delayed
 from nilearn.connectome import vec_to_sym_matrix
+from scipy.sparse.csgraph import connected_components
 from bct import modularity_louvain_und_sign
 from math import sqrt
+from scipy import sparse
+
+# implementations of the signed Louvain optimization
+LOUVAIN_BACKENDS = ["bct", "numpy"]
+# joblib backend of the optimizations: always processes, as the
+# optimizations hold the GIL and joblib falls back to threads for a
+# Parallel called from a worker of another Parallel (e.g. build_features
+# --n_workers), unless a backend is given
+PARALLEL_BACKEND = "loky"
 
 
-def louvain_modularity(vect):
+def louvain_modularity(
+    vect,
+    num_opt=100,
+    n_jobs=1,
+    seed=None,
+    tol=None,
+    stable_rounds=None,
+    return_info=False,
+    backend="bct",
+):
     """
     Wrapper for `modularity_louvain_und_sign` from the Brain Connectivity
     tool box.
@@ -15,22 +41,253 @@ def louvain_modularity(vect):
     vect : np.ndarray
         Flatten connetome.
 
+    num_opt : int
+        Number of Louvain optimizations to perform.
+
+    n_jobs : int
+        Number of processes the optimizations are spread across.
+
+    seed : None, int or numpy.random.SeedSequence
+        Seed of the optimizations. See `compute_commuity`.
+
+    tol, stable_rounds : None, float or int
+        Early stopping criteria. See `compute_commuity`.
+
+    return_info : bool
+        Also return the number of optimizations and the standard error of
+        the modularity.
+
+    backend : str {"bct", "numpy"}
+        Louvain implementation. See `compute_commuity`.
+
     Returns
     -------
     np.ndarray
         modularity (qtype dependent)
 
+    dict
+        If `return_info`, see `compute_commuity`.
     """
-    vect = np.array(vect)
-    n = vect.shape[-1]
-    n_columns = int((sqrt(8 * n + 1) - 1.0) / 2) + 1  # no diagnal
-
-    full_graph = vec_to_sym_matrix(vect, diagonal=np.ones(n_columns))
-    _, modularity = compute_commuity(full_graph, num_opt=100)
+    _, modularity, info = compute_commuity(
+        _vec_to_graph(vect),
+        num_opt=num_opt,
+        n_jobs=n_jobs,
+        seed=seed,
+        tol=tol,
+        stable_rounds=stable_rounds,
+        return_info=True,
+        backend=backend,
+    )
+    if return_info:
+        return modularity, info
     return modularity
 
 
-def compute_commuity(G, num_opt=100):
+def louvain_modularities(
+    connectomes,
+    num_opt=100,
+    n_jobs=-1,
+    seed=None,
+    tol=None,
+    stable_rounds=None,
+    return_info=False,
+    backend="bct",
+    return_partitions=False,
+    temp_folder=None,
+):
+    """
+    Louvain modularity of each subject, with the optimizations of all
+    subjects spread across the same pool of processes.
+
+    The connectomes are handed to the processes once, as a `.npy` file they
+    memory-map, and each task only receives a subject index.
+
+    Parameters
+    ----------
+
+    connectomes : np.ndarray or pathlib.Path
+        Flatten connectomes, (subject, edge), or the `.npy` file holding
+        them, which is then memory-mapped without copy.
+
+    num_opt : int
+        Number of Louvain optimizations per subject.
+
+    n_jobs : int
+        Number of processes. Default to all available CPUs, as counted by
+        joblib, which follows the CPU affinity and quota of the process.
+        Processes are used even when called from a joblib worker; callers
+        running several of these in parallel should divide the CPUs between
+        them.
+
+    seed : None or int
+        Seed of the optimizations. Subject i gets the i-th child of
+        `numpy.random.SeedSequence(seed)`, so its modularity is that of
+        `louvain_modularity` with that child as seed, whatever `n_jobs`.
+
+    tol, stable_rounds : None, float or int
+        Early stopping criteria. See `compute_commuity`. With early
+        stopping, each subject is optimized by a single process.
+
+    return_info : bool
+        Also return the number of optimizations and the standard error of
+        the modularity of each subject.
+
+    backend : str {"bct", "numpy"}
+        Louvain implementation. See `compute_commuity`.
+
+    return_partitions : bool
+        Also return the community affiliation matrix of each subject.
+
+    temp_folder : None or str
+        Folder of the file shared with the processes, which holds a copy of
+        in-memory connectomes. Default to the JOBLIB_TEMP_FOLDER environment
+        variable, then to the system's temporary folder.
+
+    Returns
+    -------
+    list of float
+        Modularity of each subject.
+
+    list of dict
+        If `return_info`, see `compute_commuity`.
+
+    list of np.ndarray
+        If `return_partitions`, community affiliation matrix (node,
+        optimization) of each subject. See `save_partitions`.
+    """
+    n_workers = _n_workers(n_jobs)
+    with _shared_connectomes(connectomes, n_workers, temp_folder) as source:
+        return _louvain_modularities(
+            source,
+            num_opt,
+            n_jobs,
+            n_workers,
+            seed,
+            tol,
+            stable_rounds,
+            return_info,
+            backend,
+            return_partitions,
+        )
+
+
+def _louvain_modularities(
+    source,
+    num_opt,
+    n_jobs,
+    n_workers,
+    seed,
+    tol,
+    stable_rounds,
+    return_info,
+    backend,
+    return_partitions,
+):
+    """`louvain_modularities` of connectomes published by
+    `_shared_connectomes`."""
+    n_subjects = len(_connectome_rows(source))
+    subject_seeds = np.random.SeedSequence(seed).spawn(n_subjects)
+    if tol is not None or stable_rounds is not None:
+        results = Parallel(n_jobs=n_jobs, backend=PARALLEL_BACKEND)(
+            delayed(_compute_commuity_row)(
+                source,
+                i,
+                num_opt=num_opt,
+                seed=subject_seed,
+                tol=tol,
+                stable_rounds=stable_rounds,
+                return_info=True,
+                backend=backend,
+            )
+            for i, subject_seed in enumerate(subject_seeds)
+        )
+        CIs = [CI for CI, _, _ in results]
+        modularities = [modularity for _, modularity, _ in results]
+        infos = [info for _, _, info in results]
+        return _returned(modularities, infos, CIs, return_info, return_partitions)
+
+    # split the optimizations of a subject only when there are idle workers
+    n_chunks = -(-n_workers // max(n_subjects, 1))
+    chunks = [
+        (i, chunk)
+        for i, subject_seed in enumerate(subject_seeds)
+        for chunk in _split_seeds(_repetition_seeds(subject_seed, num_opt), n_chunks)
+    ]
+    results = Parallel(n_jobs=n_jobs, backend=PARALLEL_BACKEND)(
+        delayed(_louvain_row_runs)(source, i, chunk, backend) for i, chunk in chunks
+    )
+    CIs = [[] for _ in range(n_subjects)]
+    Qs = [[] for _ in range(n_subjects)]
+    for (i, _), (chunk_CI, chunk_Qs) in zip(chunks, results):
+        CIs[i].append(chunk_CI)
+        Qs[i].append(chunk_Qs)
+    CIs = [np.hstack(subject_CIs) for subject_CIs in CIs]
+    Qs = [np.concatenate(subject_Qs) for subject_Qs in Qs]
+    modularities = [subject_Qs.mean() for subject_Qs in Qs]
+    infos = [_run_info(subject_Qs, num_opt) for subject_Qs in Qs]
+    return _returned(modularities, infos, CIs, return_info, return_partitions)
+
+
+@contextmanager
+def _shared_connectomes(connectomes, n_workers, temp_folder=None):
+    """Connectomes as seen by the workers: the path of a `.npy` file to
+    memory-map, written once if the connectomes are in memory, or the
+    array itself without workers to hand it to."""
+    if isinstance(connectomes, (str, Path)):
+        yield Path(connectomes)
+        return
+    connectomes = np.asarray(connectomes)
+    if n_workers == 1:
+        yield connectomes
+        return
+    temp_folder = temp_folder or os.environ.get("JOBLIB_TEMP_FOLDER")
+    folder = tempfile.mkdtemp(prefix="modularity_", dir=temp_folder)
+    try:
+        path = Path(folder) / "connectomes.npy"
+        np.save(path, connectomes)
+        yield path
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def _connectome_rows(source):
+    """Connectomes of `_shared_connectomes`, memory-mapped from a path."""
+    if isinstance(source, Path):
+        return np.load(source, mmap_mode="r")
+    return source
+
+
+def _compute_commuity_row(source, row, **kwargs):
+    """`compute_commuity` of one subject of the shared connectomes."""
+    return compute_commuity(np.array(_connectome_rows(source)[row]), **kwargs)
+
+
+def _louvain_row_runs(source, row, seeds, backend="bct"):
+    """`_louvain_runs` of one subject of the shared connectomes."""
+    return _louvain_runs(np.array(_connectome_rows(source)[row]), seeds, backend)
+
+
+def _returned(modularities, infos, CIs, return_info, return_partitions):
+    """Outputs of `louvain_modularities`."""
+    returned = (modularities,)
+    if return_info:
+        returned += (infos,)
+    if return_partitions:
+        returned += (CIs,)
+    return returned if len(returned) > 1 else modularities
+
+
+def compute_commuity(
+    G,
+    num_opt=100,
+    n_jobs=1,
+    seed=None,
+    tol=None,
+    stable_rounds=None,
+    round_size=10,
+    return_info=False,
+    backend="bct",
+):
     """
     Compute community affiliation vector. Wrapper for
     `modularity_louvain_und_sign` from the Brain Connectivity tool box.
@@ -39,24 +296,378 @@ def compute_commuity(G, num_opt=100):
     ----------
 
     G : np.ndarray
-        Symmetric Graph
+        Symmetric Graph, or flatten connectome.
 
     num_opt : int
         Number of Louvain optimizations to perform
 
+    n_jobs : int
+        Number of processes the optimizations are spread across. Processes
+        are used even when called from a joblib worker, so that several
+        subjects processed in parallel each get `n_jobs` processes.
+
+    seed : None, int or numpy.random.SeedSequence
+        Seed of the optimizations. Each optimization gets its own seed drawn
+        from `numpy.random.SeedSequence(seed)`, so the results only depend
+        on `seed` and not on `n_jobs`. None draws fresh entropy.
+
+    tol : None or float
+        Stop once the standard error of the mean modularity is below `tol`.
+
+    stable_rounds : None or int
+        Stop once the consensus partition is the same for `stable_rounds`
+        consecutive rounds. The consensus groups nodes assigned to the same
+        community in more than half of the optimizations.
+
+    round_size : int
+        With early stopping, number of optimizations between two checks of
+        the criteria. `num_opt` remains the maximum.
+
+    return_info : bool
+        Also return the number of optimizations and the precision reached.
+
+    backend : str {"bct", "numpy"}
+        Louvain implementation: bctpy's `modularity_louvain_und_sign` or
+        `louvain_und_sign`, which gives the same partitions for a given
+        seed with vectorized updates and aggregation.
+
     Return
     ------
 
     np.ndarray
-        community affiliation vector
+        community affiliation vector of each optimization, (node,
+        optimization), as integers starting at 1
 
     np.ndarray
         modularity (qtype dependent)
+
+    dict
+        If `return_info`, "n_opt", the number of optimizations performed,
+        "sem", the standard error of the mean modularity, and
+        "stopped_early", whether a criterion stopped the optimizations
+        before `num_opt`.
+    """
+    if backend not in LOUVAIN_BACKENDS:
+        raise NotImplementedError(
+            f"Louvain backend '{backend}' is not implemented. Select from "
+            f"{LOUVAIN_BACKENDS}."
+        )
+    if G.ndim == 1:
+        G = _vec_to_graph(G)
+    seeds = _repetition_seeds(seed, num_opt)
+    n_workers = _n_workers(n_jobs)
+    if tol is None and stable_rounds is None:
+        rounds = [seeds]
+    else:
+        rounds = [seeds[i : i + round_size] for i in range(0, num_opt, round_size)]
+
+    results, agreement, consensus, n_stable = [], 0, None, 0
+    for round_seeds in rounds:
+        chunks = _split_seeds(round_seeds, n_workers)
+        if n_workers == 1:
+            results += [_louvain_runs(G, chunk, backend) for chunk in chunks]
+        else:
+            results += Parallel(n_jobs=n_jobs, backend=PARALLEL_BACKEND)(
+                delayed(_louvain_runs)(G, chunk, backend) for chunk in chunks
+            )
+        Qs = np.concatenate([chunk_Qs for _, chunk_Qs in results])
+        if tol is not None and len(Qs) > 1 and _sem(Qs) < tol:
+            break
+        if stable_rounds is not None:
+            for chunk_CI, _ in results[-len(chunks) :]:
+                agreement = agreement + _coassignment(chunk_CI)
+            partition = _consensus_partition(agreement, len(Qs))
+            n_stable = (
+                n_stable + 1
+                if consensus is not None and np.array_equal(partition, consensus)
+                else 0
+            )
+            consensus = partition
+            if n_stable >= stable_rounds:
+                break
+    CI = np.hstack([chunk_CI for chunk_CI, _ in results])
+    Qs = np.concatenate([chunk_Qs for _, chunk_Qs in results])
+    if return_info:
+        return CI, Qs.mean(), _run_info(Qs, num_opt)
+    return CI, Qs.mean()
+
+
+def louvain_und_sign(W, gamma=1, qtype="sta", seed=None):
+    """
+    Louvain optimization of the signed modularity of an undirected graph.
+
+    Same algorithm, modularity types and random node order as bctpy's
+    `modularity_louvain_und_sign`, so the same seed gives the same
+    partition up to floating point ties. The positive and negative
+    node-to-module degrees are kept as one rescaled matrix, stored module by
+    node so that moving a node updates two contiguous rows, and each level
+    is aggregated with one product by the module membership matrix.
+
+    Parameters
+    ----------
+
+    W : np.ndarray
+        Symmetric graph with positive and negative weights. The engine is
+        dense only: the node to module degrees are dense arrays, so a
+        scipy.sparse matrix is converted to a dense array first and gains
+        no memory or speed.
+
+    gamma : float
+        Resolution parameter.
+
+    qtype : str {"sta", "pos", "smp", "gja", "neg"}
+        Modularity type, see Rubinov and Sporns (2011).
+
+    seed : None or int
+        Seed of the random order of the nodes. None draws fresh entropy
+        from the operating system.
+
+    Returns
+    -------
+
+    np.ndarray
+        Community affiliation vector, starting at 1.
+
+    float
+        Optimized modularity.
     """
-    CI = np.empty((G.shape[0], num_opt))
-    Qs = np.empty((num_opt))
-    for i in range(num_opt):
-        P, Q = modularity_louvain_und_sign(G)
+    # RandomState, as bctpy, for the same node order from the same seed
+    rng = np.random.RandomState(seed)
+    W = W.toarray() if sparse.issparse(W) else np.asarray(W, dtype=np.float64)
+    W0 = W * (W > 0)
+    W1 = -W * (W < 0)
+    s0, s1 = W0.sum(), W1.sum()
+    d0, d1 = {
+        "smp": (1 / s0 if s0 else 0, 1 / s1 if s1 else 0),
+        "gja": (1 / (s0 + s1),) * 2,
+        "sta": (1 / s0 if s0 else 0, 1 / (s0 + s1)),
+        "pos": (1 / s0 if s0 else 0, 0),
+        "neg": (0, 1 / s1 if s1 else 0),
+    }[qtype]
+    # adjust for absent positive or negative weights
+    if not s0:
+        s0, d0 = 1, 0
+    if not s1:
+        s1, d1 = 1, 0
+
+    ci = np.arange(len(W))
+    q_previous, q = -1, 0
+    while q - q_previous > 1e-10:
+        nh = len(W0)
+        kn0, kn1 = W0.sum(axis=0), W1.sum(axis=0)
+        km0, km1 = kn0.copy(), kn1.copy()
+        # rescaled weights, node to module degrees and null model factors
+        Wc = d0 * W0 - d1 * W1
+        knm = Wc.copy()
+        null0, null1 = gamma * d0 * kn0 / s0, gamma * d1 * kn1 / s1
+        m = np.arange(nh)
+        flag, it = True, 0
+        while flag:
+            it += 1
+            if it > 1000:
+                raise ValueError(
+                    "Infinite loop in the Louvain optimization, the graph is "
+                    "probably not symmetric."
+                )
+            flag = False
+            for u in rng.permutation(nh):
+                ma = m[u]
+                dQ = (
+                    knm[:, u]
+                    + (Wc[u, u] - knm[ma, u])
+                    - null0[u] * (km0 + (kn0[u] - km0[ma]))
+                    + null1[u] * (km1 + (kn1[u] - km1[ma]))
+                )
+                dQ[ma] = 0
+                mb = np.argmax(dQ)
+                if dQ[mb] > 1e-10:
+                    flag = True
+                    knm[mb] += Wc[u]
+                    knm[ma] -= Wc[u]
+                    km0[mb] += kn0[u]
+                    km0[ma] -= kn0[u]
+                    km1[mb] += kn1[u]
+                    km1[ma] -= kn1[u]
+                    m[u] = mb
+
+        _, m = np.unique(m, return_inverse=True)
+        ci = m[ci]
+        membership = np.zeros((nh, m.max() + 1))
+        membership[np.arange(nh), m] = 1
+        W0 = membership.T @ W0 @ membership
+        W1 = membership.T @ W1 @ membership
+        q_previous = q
+        q0 = np.trace(W0) - np.sum(W0.sum(axis=0) ** 2) / s0
+        q1 = np.trace(W1) - np.sum(W1.sum(axis=0) ** 2) / s1
+        q = d0 * q0 - d1 * q1
+    return ci + 1, q
+
+
+def _louvain_runs(G, seeds, backend="bct"):
+    """One Louvain optimization per seed, on a graph or a flatten
+    connectome."""
+    if G.ndim == 1:
+        G = _vec_to_graph(G)
+    optimize = louvain_und_sign if backend == "numpy" else modularity_louvain_und_sign
+    CI = np.empty((G.shape[0], len(seeds)), dtype=np.int32)
+    Qs = np.empty((len(seeds)))
+    for i, seed in enumerate(seeds):
+        P, Q = optimize(G, seed=int(seed))
         CI[:, i] = P
         Qs[i] = Q
-    return CI, Qs.mean()
+    return CI, Qs
+
+
+def consensus_partition(CI):
+    """
+    Consensus of the community affiliations of repeated optimizations.
+
+    Nodes assigned to the same community in more than half of the
+    optimizations are grouped together.
+
+    Parameters
+    ----------
+
+    CI : np.ndarray
+        Community affiliation matrix, (node, optimization).
+
+    Returns
+    -------
+
+    np.ndarray
+        Consensus community of each node, starting at 1 and labelled in
+        order of the first node of each community.
+    """
+    return _consensus_partition(_coassignment(CI), CI.shape[1]) + 1
+
+
+def save_partitions(path, participant_id, CIs):
+    """
+    Save the community affiliations of the optimizations of each subject
+    and their consensus partition in a compressed integer store.
+
+    The affiliation matrices, which can hold a different number of
+    optimizations per subject, are concatenated along the optimizations in
+    the smallest unsigned integer type fitting the community labels.
+
+    Parameters
+    ----------
+
+    path : pathlib.Path
+        Output `.npz` file.
+
+    participant_id : list of str
+        Subject of each affiliation matrix.
+
+    CIs : list of np.ndarray
+        Community affiliation matrix (node, optimization) of each subject.
+    """
+    n_nodes = CIs[0].shape[0] if CIs else 0
+    affiliations = (
+        np.hstack(CIs) if CIs else np.empty((n_nodes, 0), dtype=np.int32)
+    )
+    consensus = (
+        np.stack([consensus_partition(CI) for CI in CIs])
+        if CIs
+        else np.empty((0, n_nodes), dtype=np.int32)
+    )
+    dtype = np.min_scalar_type(max(affiliations.max(initial=0), n_nodes))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    np.savez_compressed(
+        path,
+        participant_id=np.array(participant_id, dtype=str),
+        n_opt=np.array([CI.shape[1] for CI in CIs], dtype=np.int64),
+        affiliations=affiliations.astype(dtype),
+        consensus=consensus.astype(dtype),
+    )
+
+
+def load_partitions(path):
+    """
+    Load community affiliations saved by `save_partitions`.
+
+    Parameters
+    ----------
+
+    path : pathlib.Path
+        `.npz` file of `save_partitions`.
+
+    Returns
+    -------
+
+    dict
+        Subject to a tuple of its community affiliation matrix (node,
+        optimization) and consensus partition.
+    """
+    with np.load(path) as store:
+        offsets = np.cumsum(np.concatenate(([0], store["n_opt"])))
+        affiliations = store["affiliations"]
+        return {
+            subject: (affiliations[:, start:stop], consensus)
+            for subject, start, stop, consensus in zip(
+                store["participant_id"], offsets[:-1], offsets[1:], store["consensus"]
+            )
+        }
+
+
+def _coassignment(CI):
+    """Number of optimizations assigning each pair of nodes to the same
+    community."""
+    CI = CI.astype(np.int64)
+    return sum(
+        (CI[:, i, np.newaxis] == CI[np.newaxis, :, i]).astype(np.int32)
+        for i in range(CI.shape[1])
+    )
+
+
+def _consensus_partition(agreement, n_opt):
+    """Nodes in the same community in more than half of the optimizations,
+    labelled in order of their first node."""
+    _, labels = connected_components(agreement * 2 > n_opt, directed=False)
+    return labels
+
+
+def _sem(Qs):
+    """Standard error of the mean modularity."""
+    if len(Qs) < 2:
+        return np.nan
+    return float(Qs.std(ddof=1) / np.sqrt(len(Qs)))
+
+
+def _run_info(Qs, num_opt):
+    """Number of optimizations and precision of the modularity."""
+    return {
+        "n_opt": len(Qs),
+        "sem": _sem(Qs),
+        "stopped_early": len(Qs) < num_opt,
+    }
+
+
+def _repetition_seeds(seed, num_opt):
+    """Seed of each optimization."""
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    return seed.generate_state(num_opt)
+
+
+def _split_seeds(seeds, n_chunks):
+    """Split the seeds in contiguous chunks."""
+    n_chunks = max(1, min(n_chunks, len(seeds)))
+    return np.array_split(seeds, n_chunks)
+
+
+def _n_workers(n_jobs):
+    """Number of processes of joblib's `n_jobs`."""
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        return max(cpu_count() + 1 + n_jobs, 1)
+    return n_jobs
+
+
+def _vec_to_graph(vect):
+    """Symmetric graph with unit diagonal of a flatten connectome."""
+    vect = np.array(vect)
+    n = vect.shape[-1]
+    n_columns = int((sqrt(8 * n + 1) - 1.0) / 2) + 1  # no diagnal
+    return vec_to_sym_matrix(vect, diagonal=np.ones(n_columns))
@@ -1,9 +1,17 @@
+import hashlib
+
 import pandas as pd
 import numpy as np
-from scipy import stats, linalg
+from scipy import stats, linalg, special
+from joblib import Parallel, delayed
 
 from statsmodels.stats import multitest
 
+# size of the edge by resample block held in memory by each worker
+RESAMPLING_BLOCK_SIZE = 2**25
+
+QCFC_METHODS = ["pearson", "spearman", "winsorized"]
+
 
 def calculate_median_absolute(x):
     """Calculate Absolute median value"""
@@ -40,6 +48,53 @@ def significant_level(x, alpha=0.05, correction=None):
     return res
 
 
+def significant_percentage(pvalues, alpha=0.05, correction=None):
+    """
+    Percentage of significant p-values of every column at once.
+
+    Same decision as `significant_level` applied column by column, with a
+    single sort of the whole edge by column array for the corrections.
+
+    Parameters
+    ----------
+
+    pvalues : pandas.DataFrame or np.ndarray, shape (n_edges, n_columns)
+        Uncorrected p-values, one column per strategy / group.
+
+    alpha : float
+        Alpha threshold.
+
+    correction : None or str {"fdr_bh", "bonferroni"}
+        Default as None for no multiple comparison.
+
+    Returns
+    -------
+    pandas.Series or np.ndarray
+        Percentage of significant edges per column.
+    """
+    columns = pvalues.columns if isinstance(pvalues, pd.DataFrame) else None
+    pvalues = np.asarray(pvalues, dtype=float)
+    n_tests = pvalues.shape[0]
+    if correction is None:
+        n_significant = (pvalues < 0.05).sum(axis=0)
+    elif correction == "bonferroni":
+        n_significant = (pvalues * n_tests <= alpha).sum(axis=0)
+    elif correction == "fdr_bh":
+        pvalues = np.sort(pvalues, axis=0)
+        thresholds = alpha * np.arange(1, n_tests + 1) / n_tests
+        passed = pvalues <= thresholds[:, np.newaxis]
+        # step-up: number of tests up to the largest rank passing
+        last_passed = n_tests - np.argmax(passed[::-1], axis=0)
+        n_significant = np.where(passed.any(axis=0), last_passed, 0)
+    else:
+        raise NotImplementedError(f"Correction '{correction}' is not implemented.")
+
+    percentage = 100 * n_significant / n_tests
+    if columns is not None:
+        return pd.Series(percentage, index=columns)
+    return percentage
+
+
 def partial_correlation(x, y, cov=None):
     """A minimal implementation of partial correlation.
 
@@ -68,7 +123,626 @@ def partial_correlation(x, y, cov=None):
     return {"correlation": r, "pvalue": p_val}
 
 
-def qcfc(movement, connectomes, covarates=None):
+def partial_correlation_matrix(x, y, cov=None, copy=True):
+    """Vectorised partial correlation between many variables and one target.
+
+    Equivalent to calling `partial_correlation` on every column of `x`, but
+    the covariates are regressed out of all columns with a single
+    least-square solve and the correlations are computed in bulk.
+
+    Parameters
+    ----------
+    x : np.ndarray, shape (n_samples, n_features)
+        Variables of interest (e.g. flattened connectome edges).
+
+    y : np.ndarray, shape (n_samples,)
+        Variable to correlate each column of `x` with.
+
+    cov : None, np.ndarray
+        Variable to be removed from variable of interest.
+        If None, do a normal pearson's correlation.
+
+    copy : bool
+        If False, `x` is residualised in place to save memory.
+
+    Returns
+    -------
+    np.ndarray, np.ndarray
+        Correlation and p-value per column of `x`. Computed in the
+        precision of `x` (float32 or float64); p-values are float64.
+    """
+    x = _as_float(x, copy)
+    y = _as_float(y, True).astype(x.dtype)
+    if isinstance(cov, np.ndarray):
+        x = _residualize(x, cov)
+        y = _residualize(y, cov)
+    return _pearson_columns(x, y)
+
+
+def _as_float(x, copy):
+    """Floating point array, keeping float32 inputs in single precision."""
+    x = np.asarray(x)
+    dtype = x.dtype if x.dtype in (np.float32, np.float64) else np.float64
+    return np.array(x, dtype=dtype, copy=copy or x.dtype != dtype)
+
+
+def _residualize(x, cov, block_size=4096):
+    """Remove the least-square fit of the covariates from each column, in
+    place. The fit is removed by blocks of columns to bound the memory of
+    temporary arrays."""
+    cov = cov.astype(x.dtype)
+    beta = linalg.pinv(cov).dot(x)
+    if x.ndim == 1:
+        x -= cov.dot(beta)
+        return x
+    for start in range(0, x.shape[1], block_size):
+        block = slice(start, start + block_size)
+        x[:, block] -= cov.dot(beta[:, block])
+    return x
+
+
+def _pearson_columns(x, y):
+    """Pearson's correlation between each column of x and y. x is centered
+    in place."""
+    n = x.shape[0]
+    x -= x.mean(axis=0)
+    y = y - y.mean(axis=0)
+    x_norm = np.sqrt(np.einsum("ij,ij->j", x, x))
+    y_norm = np.sqrt(y.dot(y))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        r = y.dot(x) / (x_norm * y_norm)
+    r = np.clip(r, -1.0, 1.0)
+    return r, _pearson_pvalue(r.astype(np.float64), n)
+
+
+def _pearson_pvalue(r, n):
+    """Two-sided p-value of pearson's correlation, as scipy.stats.pearsonr."""
+    # survival function of the beta distribution on [-1, 1]
+    a = n / 2 - 1
+    return 2 * special.betainc(a, a, (1 - np.abs(r)) / 2)
+
+
+def permutation_test(
+    x,
+    y,
+    cov=None,
+    n_permutations=1000,
+    alpha=0.05,
+    chunk_size=None,
+    n_jobs=1,
+    random_state=None,
+    copy=True,
+):
+    """Permutation null of the partial correlation between many variables
+    and one target.
+
+    The covariates are regressed out once, then `y` is shuffled against the
+    residualised columns of `x`. Permutations are processed in chunks
+    distributed over a pool of worker processes; each chunk only holds a
+    (n_features, chunk_size) block of null correlations in memory.
+
+    Parameters
+    ----------
+    x : np.ndarray, shape (n_samples, n_features)
+        Variables of interest (e.g. flattened connectome edges).
+
+    y : np.ndarray, shape (n_samples,)
+        Variable to correlate each column of `x` with.
+
+    cov : None, np.ndarray
+        Variable to be removed from variable of interest.
+
+    n_permutations : int
+        Number of permutations.
+
+    alpha : float
+        Family-wise error rate of the max-statistic threshold.
+
+    chunk_size : None or int
+        Number of permutations per chunk. Default to fit a block of
+        `RESAMPLING_BLOCK_SIZE` null correlations.
+
+    n_jobs : int
+        Number of worker processes. See joblib.Parallel.
+
+    random_state : None or int
+        Seed of the permutations.
+
+    copy : bool
+        If False, `x` is residualised in place to save memory.
+
+    Returns
+    -------
+    dict
+        "correlation": observed correlation per column,
+        "permutation_p": per-column empirical p-values,
+        "fwer_p": per-column max-statistic FWER corrected p-values,
+        "fwer_threshold": absolute correlation above which a column is
+        significant at `alpha` after FWER correction.
+    """
+    x = _as_float(x, copy)
+    y = _as_float(y, True).astype(x.dtype)
+    if isinstance(cov, np.ndarray):
+        x = _residualize(x, cov)
+        y = _residualize(y, cov)
+    x = _standardize(x)
+    y = _standardize(y)
+    r = y.dot(x)
+
+    if chunk_size is None:
+        chunk_size = max(1, RESAMPLING_BLOCK_SIZE // x.shape[1])
+    chunks = [
+        min(chunk_size, n_permutations - start)
+        for start in range(0, n_permutations, chunk_size)
+    ]
+    seeds = np.random.SeedSequence(random_state).spawn(len(chunks))
+    null = Parallel(n_jobs=n_jobs)(
+        delayed(_permutation_chunk)(x, y, np.abs(r), n, seed)
+        for n, seed in zip(chunks, seeds)
+    )
+    exceed = np.sum([count for count, _ in null], axis=0)
+    max_null = np.concatenate([maximum for _, maximum in null])
+
+    abs_r = np.abs(r)
+    fwer_exceed = np.searchsorted(np.sort(max_null), abs_r, side="left")
+    fwer_exceed = n_permutations - fwer_exceed
+    return {
+        "correlation": r,
+        "permutation_p": (exceed + 1) / (n_permutations + 1),
+        "fwer_p": (fwer_exceed + 1) / (n_permutations + 1),
+        "fwer_threshold": np.quantile(max_null, 1 - alpha),
+    }
+
+
+def _standardize(x):
+    """Center and scale columns to unit norm in place, so a dot product is
+    a pearson's correlation."""
+    x -= x.mean(axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x /= np.sqrt(np.einsum("i...,i...->...", x, x))
+    return x
+
+
+def _permutation_chunk(x, y, abs_r, n_permutations, seed):
+    """Count null correlations exceeding the observed ones for a chunk of
+    permutations, and keep the maximum statistic of each permutation."""
+    rng = np.random.default_rng(seed)
+    y_perm = np.column_stack([rng.permutation(y) for _ in range(n_permutations)])
+    null = np.abs(y_perm.T.dot(x))
+    exceed = (null >= abs_r).sum(axis=0)
+    return exceed, np.fmax.reduce(null, axis=1)
+
+
+def bootstrap_qcfc_summary(
+    movement,
+    connectomes,
+    covarates=None,
+    distance=None,
+    n_bootstrap=1000,
+    correction="fdr_bh",
+    confidence=0.95,
+    batch_size=None,
+    block_size=None,
+    n_jobs=1,
+    random_state=None,
+):
+    """
+    Bootstrap confidence intervals of the QC-FC summary metrics.
+
+    Subjects are resampled with replacement. The motion and edges are
+    residualised on the full sample; each resample is expressed as a
+    vector of subject counts, so a batch of resamples is computed with a
+    few matrix products. The edges are read from the connectomes, which can
+    be memory-mapped, by blocks of `block_size` columns. Batches are
+    distributed over a pool of worker processes and hold a (batch_size,
+    n_edges) block in memory.
+
+    Duplicated subjects add noise to the resampled correlations, so the
+    resampled median absolute QC-FC and percentage of significant edges are
+    biased upward: under the null, the percentile interval can miss the
+    full sample estimate. The intervals are therefore the percentile
+    intervals shifted by the bootstrap bias, the mean of the resamples
+    minus the estimate, which is reported as well.
+
+    Parameters
+    ----------
+
+    movement, connectomes, covarates :
+        See `qcfc`.
+
+    distance : None or np.ndarray, shape (n_edges,)
+        Node distance of each edge. If None, distance dependence is skipped.
+
+    n_bootstrap : int
+        Number of bootstrap resamples.
+
+    correction : None or str
+        Multiple comparison correction of the percentage of significant
+        edges. See `significant_percentage`.
+
+    confidence : float
+        Confidence level of the intervals.
+
+    batch_size : None or int
+        Number of resamples per batch. Default to fit a block of
+        `RESAMPLING_BLOCK_SIZE` values.
+
+    block_size : None or int
+        Number of edges read from the connectomes, residualised and
+        multiplied with the subject counts at a time. Default to fit a
+        block of `RESAMPLING_BLOCK_SIZE` values.
+
+    n_jobs : int
+        Number of worker processes. See joblib.Parallel.
+
+    random_state : None or int
+        Seed of the resampling.
+
+    Returns
+    -------
+
+    pandas.DataFrame
+        Index: "qcfc_mad", "qcfc_significant" and "corr_motion_distance".
+        Columns: "estimate", "bias", "ci_lower", "ci_upper",
+        "standard_error".
+    """
+    values, rows, motion, cov, _ = _align_qcfc_inputs(
+        movement, connectomes, covarates, block_size
+    )
+    if isinstance(cov, np.ndarray):
+        motion = _residualize(motion, cov)
+    n_subjects, n_edges = len(rows), values.shape[1]
+    if block_size is None:
+        block_size = max(1, RESAMPLING_BLOCK_SIZE // n_subjects)
+    distance_rank = None
+    if distance is not None:
+        distance_rank = _standardize(stats.rankdata(distance))
+
+    estimate = _qcfc_summary(
+        np.ones((1, n_subjects), dtype=values.dtype),
+        values,
+        rows,
+        motion,
+        cov,
+        distance_rank,
+        correction,
+        block_size,
+    )
+
+    if batch_size is None:
+        batch_size = max(1, RESAMPLING_BLOCK_SIZE // n_edges)
+    batches = [
+        min(batch_size, n_bootstrap - start)
+        for start in range(0, n_bootstrap, batch_size)
+    ]
+    seeds = np.random.SeedSequence(random_state).spawn(len(batches))
+    resamples = Parallel(n_jobs=n_jobs)(
+        delayed(_bootstrap_batch)(
+            values,
+            rows,
+            motion,
+            cov,
+            distance_rank,
+            correction,
+            block_size,
+            n,
+            seed,
+        )
+        for n, seed in zip(batches, seeds)
+    )
+    resamples = np.vstack(resamples)
+
+    metrics = ["qcfc_mad", "qcfc_significant", "corr_motion_distance"]
+    # range of each metric, bounding the intervals
+    lower_bound, upper_bound = np.array([0, 0, -1]), np.array([1, 100, 1])
+    if distance is None:
+        metrics = metrics[:2]
+        estimate, resamples = estimate[:, :2], resamples[:, :2]
+        lower_bound, upper_bound = lower_bound[:2], upper_bound[:2]
+    tail = 100 * (1 - confidence) / 2
+    bias = np.nanmean(resamples, axis=0) - estimate[0]
+    return pd.DataFrame(
+        {
+            "estimate": estimate[0],
+            "bias": bias,
+            "ci_lower": np.clip(
+                np.nanpercentile(resamples, tail, axis=0) - bias,
+                lower_bound,
+                upper_bound,
+            ),
+            "ci_upper": np.clip(
+                np.nanpercentile(resamples, 100 - tail, axis=0) - bias,
+                lower_bound,
+                upper_bound,
+            ),
+            "standard_error": np.nanstd(resamples, axis=0, ddof=1),
+        },
+        index=metrics,
+    )
+
+
+def _bootstrap_batch(
+    values,
+    rows,
+    motion,
+    cov,
+    distance_rank,
+    correction,
+    block_size,
+    n_resamples,
+    seed,
+):
+    """QC-FC summary metrics of a batch of bootstrap resamples."""
+    rng = np.random.default_rng(seed)
+    n_subjects = len(rows)
+    counts = rng.multinomial(
+        n_subjects, np.full(n_subjects, 1 / n_subjects), size=n_resamples
+    )
+    return _qcfc_summary(
+        counts.astype(values.dtype),
+        values,
+        rows,
+        motion,
+        cov,
+        distance_rank,
+        correction,
+        block_size,
+    )
+
+
+def _qcfc_summary(
+    counts, values, rows, motion, cov, distance_rank, correction, block_size
+):
+    """Median absolute QC-FC, percentage of significant edges and distance
+    dependence of samples given as subject counts, shape (n_samples,
+    n_subjects). The edges of the subjects in `rows` are read and
+    residualised on the full sample one block of columns at a time."""
+    n = counts.sum(axis=1, keepdims=True)
+    sum_motion = counts.dot(motion)[:, np.newaxis]
+    var_motion = n * counts.dot(motion**2)[:, np.newaxis] - sum_motion**2
+    r = np.empty((counts.shape[0], values.shape[1]), dtype=values.dtype)
+    for start in range(0, values.shape[1], block_size):
+        block = slice(start, start + block_size)
+        edges = _as_float(values[rows, block], copy=False)
+        if isinstance(cov, np.ndarray):
+            edges = _residualize(edges, cov)
+        sum_edges = counts.dot(edges)
+        cov_edges = (
+            n * counts.dot(edges * motion[:, np.newaxis]) - sum_edges * sum_motion
+        )
+        var_edges = n * counts.dot(edges**2) - sum_edges**2
+        with np.errstate(divide="ignore", invalid="ignore"):
+            r[:, block] = cov_edges / np.sqrt(var_edges * var_motion)
+    r = np.clip(r, -1.0, 1.0, out=r)
+
+    median_absolute = np.median(np.abs(r), axis=1)
+    percentage = _significant_percentage_correlation(r, len(rows), correction)
+    if distance_rank is None:
+        corr_distance = np.full(r.shape[0], np.nan)
+    else:
+        # average ranks of tied correlations, as spearmanr
+        rank = _standardize(stats.rankdata(r, axis=1).T)
+        corr_distance = distance_rank.dot(rank)
+    return np.column_stack([median_absolute, percentage, corr_distance])
+
+
+def _significant_percentage_correlation(r, n, correction=None, alpha=0.05):
+    """Same as `significant_percentage` on the p-values of correlations
+    r, shape (n_samples, n_edges), without computing the p-values.
+
+    The p-value thresholds are turned into critical absolute correlations,
+    as the p-value decreases with the absolute correlation.
+    """
+    n_tests = r.shape[1]
+    abs_r = np.abs(r)
+    a = n / 2 - 1
+    if correction is None:
+        critical = 1 - 2 * special.betaincinv(a, a, 0.05 / 2)
+        n_significant = (abs_r > critical).sum(axis=1)
+    elif correction == "bonferroni":
+        critical = 1 - 2 * special.betaincinv(a, a, alpha / n_tests / 2)
+        n_significant = (abs_r >= critical).sum(axis=1)
+    elif correction == "fdr_bh":
+        thresholds = alpha * np.arange(1, n_tests + 1) / n_tests
+        critical = 1 - 2 * special.betaincinv(a, a, thresholds / 2)
+        abs_r = -np.sort(-abs_r, axis=1)
+        passed = abs_r >= critical
+        last_passed = n_tests - np.argmax(passed[:, ::-1], axis=1)
+        n_significant = np.where(passed.any(axis=1), last_passed, 0)
+    else:
+        raise NotImplementedError(f"Correction '{correction}' is not implemented.")
+    return 100 * n_significant / n_tests
+
+
+def _transform_columns(x, method="pearson", limits=0.05):
+    """Column-wise transform of the QC-FC variables for rank based or
+    robust correlation.
+
+    Parameters
+    ----------
+    x : np.ndarray, shape (n_samples,) or (n_samples, n_features)
+        Variables; transformed in place when possible.
+
+    method : str {"pearson", "spearman", "winsorized"}
+        "spearman" replaces values by their (average) ranks, "winsorized"
+        clips each column to its `limits` and 1 - `limits` quantiles.
+
+    Returns
+    -------
+    np.ndarray
+        Transformed variables, same shape and precision.
+    """
+    if method == "pearson":
+        return x
+    if method == "spearman":
+        return _rank_columns(x)
+    if method == "winsorized":
+        lower, upper = np.quantile(x, [limits, 1 - limits], axis=0)
+        return np.clip(x, lower.astype(x.dtype), upper.astype(x.dtype), out=x)
+    raise NotImplementedError(
+        f"QC-FC method '{method}' is not implemented. Select from {QCFC_METHODS}."
+    )
+
+
+def _rank_columns(x):
+    """Column-wise average ranks, as scipy.stats.rankdata(x, axis=0).
+
+    Ranks are read from a single sort of the transposed array; only
+    columns with ties go through rankdata.
+    """
+    if x.ndim == 1:
+        return stats.rankdata(x).astype(x.dtype)
+    n = x.shape[0]
+    # always a copy: x.T is already contiguous when x is F-ordered or has
+    # a single column, and the sort below would overwrite x
+    x_t = np.array(x.T, order="C")
+    order = np.argsort(x_t, axis=1)
+    x_t.sort(axis=1)
+    tied = (x_t[:, 1:] == x_t[:, :-1]).any(axis=1)
+    ranks = x_t  # reuse the sorted copy
+    np.put_along_axis(ranks, order, np.arange(1, n + 1, dtype=x.dtype), axis=1)
+    if tied.any():
+        ranks[tied] = stats.rankdata(x[:, tied], axis=0).T
+    return ranks.T
+
+
+def _prepare_qcfc_inputs(movement, connectomes, covarates=None):
+    """Align QC-FC inputs on subjects and drop subjects with missing data.
+
+    Mirrors the concatenate / dropna logic of the original per-edge
+    implementation. The subject by edge matrix is copied once, in the
+    precision of the connectomes. `movement` can be a data frame of
+    several motion summaries; subjects missing any of them are dropped.
+
+    Returns
+    -------
+    np.ndarray, np.ndarray, None or np.ndarray, list
+        Edges, motion, z-scored covariates and edge ids.
+    """
+    values, rows, motion, cov, edge_ids = _align_qcfc_inputs(
+        movement, connectomes, covarates
+    )
+    return values[rows], motion, cov, edge_ids
+
+
+def _align_qcfc_inputs(movement, connectomes, covarates=None, block_size=None):
+    """Subject alignment of `_prepare_qcfc_inputs`, without copying the
+    edges.
+
+    Returns
+    -------
+    np.ndarray, np.ndarray, np.ndarray, None or np.ndarray, list
+        All edges (a view of the connectomes), rows of the valid subjects,
+        motion, z-scored covariates and edge ids.
+    """
+    edge_ids = connectomes.columns.tolist()
+    subjects = connectomes.index.intersection(movement.index, sort=False)
+    if covarates is not None:
+        covarates = covarates.apply(stats.zscore)
+        subjects = subjects.intersection(covarates.index, sort=False)
+
+    values = _as_float(connectomes.values, copy=False)
+    rows = connectomes.index.get_indexer(subjects)
+    motion = movement.loc[subjects].values.astype(values.dtype)
+    missing_motion = np.isnan(motion)
+    if motion.ndim > 1:
+        missing_motion = missing_motion.any(axis=1)
+    valid = ~missing_motion & ~_missing_rows(values, block_size)[rows]
+    cov = None
+    if covarates is not None:
+        cov = covarates.loc[subjects].values.astype(values.dtype)
+        valid &= ~np.isnan(cov).any(axis=1)
+        cov = cov[valid]
+    return values, rows[valid], motion[valid], cov, edge_ids
+
+
+def _missing_rows(values, block_size=None):
+    """Subjects with any missing edge, scanned by blocks of `block_size`
+    columns when set."""
+    if block_size is None:
+        return np.isnan(values).any(axis=1)
+    missing = np.zeros(values.shape[0], dtype=bool)
+    for start in range(0, values.shape[1], block_size):
+        missing |= np.isnan(values[:, start : start + block_size]).any(axis=1)
+    return missing
+
+
+def _qcfc_blocks(values, rows, motion, cov, edge_ids, block_size, method="pearson"):
+    """QC-FC table computed by blocks of `block_size` edges.
+
+    Only the rows of one block of columns are copied from `values`, which
+    can be memory-mapped, so the peak memory is bounded by the block size.
+    All steps of `_qcfc_table` are column-wise and the result is the same.
+    """
+    n_edges = values.shape[1]
+    r = np.empty(n_edges, dtype=values.dtype)
+    p_val = np.empty(n_edges, dtype=np.float64)
+    motion = _transform_columns(motion, method)
+    if method == "spearman" and cov is not None:
+        cov = stats.zscore(stats.rankdata(cov, axis=0), axis=0).astype(cov.dtype)
+    for start in range(0, n_edges, block_size):
+        block = slice(start, start + block_size)
+        edges = _transform_columns(values[rows, block], method)
+        r[block], p_val[block] = partial_correlation_matrix(
+            edges, motion, cov, copy=False
+        )
+    return pd.DataFrame({"correlation": r, "pvalue": p_val}, index=edge_ids)
+
+
+def _qcfc_table(
+    edges,
+    motion,
+    cov,
+    edge_ids,
+    n_permutations=None,
+    n_jobs=1,
+    random_state=None,
+    method="pearson",
+):
+    """QC-FC statistics of aligned arrays as a data frame."""
+    edges = _transform_columns(edges, method)
+    motion = _transform_columns(motion, method)
+    if method == "spearman" and cov is not None:
+        cov = stats.zscore(stats.rankdata(cov, axis=0), axis=0).astype(cov.dtype)
+    if not n_permutations:
+        r, p_val = partial_correlation_matrix(edges, motion, cov, copy=False)
+        return pd.DataFrame({"correlation": r, "pvalue": p_val}, index=edge_ids)
+
+    null = permutation_test(
+        edges,
+        motion,
+        cov,
+        n_permutations=n_permutations,
+        n_jobs=n_jobs,
+        random_state=random_state,
+        copy=False,
+    )
+    metric = pd.DataFrame(
+        {
+            "correlation": null["correlation"],
+            "pvalue": _pearson_pvalue(
+                null["correlation"].astype(np.float64), edges.shape[0]
+            ),
+            "permutation_p": null["permutation_p"],
+            "fwer_p": null["fwer_p"],
+        },
+        index=edge_ids,
+    )
+    metric.attrs["fwer_threshold"] = null["fwer_threshold"]
+    return metric
+
+
+def qcfc(
+    movement,
+    connectomes,
+    covarates=None,
+    vectorize=True,
+    n_permutations=None,
+    n_jobs=1,
+    random_state=None,
+    method="pearson",
+    block_size=None,
+):
     """
     metric calculation: quality control / functional connectivity
 
@@ -80,27 +754,88 @@ def qcfc(movement, connectomes, covarates=None):
     Parameters
     ----------
 
-    movement: pandas.DataFrame
-        Containing header: ["mean_framewise_displacement"]
+    movement: pandas.Series
+        Mean framewise displacement, named "mean_framewise_displacement".
 
     connectomes: pandas.DataFrame
         Flattened connectome of a whole dataset.
         Index: subjets
         Columns: ROI-ROI pairs
+        float32 connectomes are processed in single precision, with about
+        half the peak memory. Correlations then differ from the float64
+        path by less than 1e-6, p-values by less than 1e-5 (relative).
 
     covariates: pandas.DataFrame or None
         Age", Gender
 
+    vectorize: bool
+        Residualise all edges at once and compute the correlations in bulk.
+        If False, fall back to calling `partial_correlation` per edge.
+
+    n_permutations: None or int
+        If set, also compute a permutation null by shuffling motion against
+        the residualised edges. Only available with `vectorize`.
+
+    n_jobs: int
+        Number of worker processes for the permutations.
+
+    random_state: None or int
+        Seed of the permutations.
+
+    method: str {"pearson", "spearman", "winsorized"}
+        Pearson's partial correlation, Spearman's partial correlation (on
+        column-wise ranks of edges, motion and covariates) or Pearson's
+        partial correlation on edges and motion winsorized at their 5th and
+        95th percentiles. Only available with `vectorize`.
+
+    block_size: None or int
+        Process the edges by blocks of `block_size` columns, so that only
+        one block is copied in memory at a time. Use with connectomes
+        backed by a memory-mapped array (see
+        `fmriprep_denoise.features.derivatives.load_connectome_memmap`).
+        Gives the same result as the in-memory path. Not available with
+        permutations, which need all the edges at once.
+
     Returns
     -------
 
-    List of dict
-        QC/FC per connectome edge.
+    pandas.DataFrame
+        QC/FC per connectome edge, with columns "correlation" and "pvalue".
+        With permutations, the empirical p-values "permutation_p" and the
+        max-statistic FWER corrected p-values "fwer_p" are added, and the
+        FWER absolute correlation threshold is stored in
+        `attrs["fwer_threshold"]`.
     """
+    if block_size:
+        if n_permutations or not vectorize:
+            raise ValueError(
+                "block_size is only available with vectorize=True and "
+                "without permutations."
+            )
+        values, rows, motion, cov, edge_ids = _align_qcfc_inputs(
+            movement, connectomes, covarates, block_size
+        )
+        return _qcfc_blocks(values, rows, motion, cov, edge_ids, block_size, method)
+
+    if vectorize:
+        edges, motion, cov, edge_ids = _prepare_qcfc_inputs(
+            movement, connectomes, covarates
+        )
+        return _qcfc_table(
+            edges, motion, cov, edge_ids, n_permutations, n_jobs, random_state, method
+        )
+
+    if n_permutations or method != "pearson":
+        raise ValueError(
+            "Permutations and QC-FC methods other than pearson are only "
+            "available with vectorize=True."
+        )
+
     # concatenate information to match by subject id
     edge_ids = connectomes.columns.tolist()
     connectomes = pd.concat((connectomes, movement), axis=1)
 
+    cov_names = None
     if covarates is not None:
         covarates = covarates.apply(stats.zscore)
         cov_names = covarates.columns
@@ -115,8 +850,613 @@ def qcfc(movement, connectomes, covarates=None):
         metric = partial_correlation(
             connectomes[edge_id].values,
             connectomes["mean_framewise_displacement"].values,
-            connectomes[cov_names].values,
+            connectomes[cov_names].values if cov_names is not None else None,
         )
         qcfc_edge.append(metric)
 
-    return qcfc_edge
+    return pd.DataFrame(qcfc_edge, index=edge_ids)
+
+
+def qcfc_by_group(
+    movement,
+    connectomes,
+    covarates,
+    groups,
+    strategy_name,
+    n_permutations=None,
+    n_jobs=1,
+    random_state=None,
+    method="pearson",
+    block_size=None,
+):
+    """
+    QC-FC of the full sample and of every group in a single pass.
+
+    The subject alignment, missing data mask and conversion to arrays are
+    done once and shared by the full sample and all the groups. Covariates
+    are z-scored within each subset, as when calling `qcfc` per group.
+
+    Parameters
+    ----------
+
+    movement: pandas.Series
+        Mean framewise displacement.
+
+    connectomes: pandas.DataFrame
+        Flattened connectome of a whole dataset.
+        Index: subjets
+        Columns: ROI-ROI pairs
+
+    covariates: pandas.DataFrame
+        Age", Gender
+
+    groups: pandas.Series
+        Group label of each subject.
+
+    strategy_name: str
+        Denoising strategy name, used as prefix of the output columns.
+
+    n_permutations, n_jobs, random_state:
+        Permutation null options. See `qcfc`.
+
+    method: str {"pearson", "spearman", "winsorized"}
+        Correlation method. See `qcfc`.
+
+    block_size: None or int
+        Process the edges by blocks of columns. See `qcfc`.
+
+    Returns
+    -------
+
+    pandas.DataFrame
+        QC/FC per connectome edge. Columns are a MultiIndex of
+        (group, "<strategy_name>_correlation" / "<strategy_name>_pvalue"),
+        starting with the group "full_sample". With permutations, the
+        "<strategy_name>_permutation_p" and "<strategy_name>_fwer_p" columns
+        are added and `attrs["fwer_threshold"]` maps each group to its FWER
+        absolute correlation threshold.
+    """
+    if block_size and n_permutations:
+        raise ValueError("block_size is not available with permutations.")
+    edge_ids = connectomes.columns.tolist()
+    subjects = (
+        connectomes.index.intersection(movement.index, sort=False)
+        .intersection(covarates.index, sort=False)
+        .intersection(groups.index, sort=False)
+    )
+    values = _as_float(connectomes.values, copy=False)
+    rows = connectomes.index.get_indexer(subjects)
+    motion = movement.loc[subjects].values.astype(values.dtype)
+    covarates = covarates.loc[subjects]
+    labels = groups.loc[subjects].values
+    valid = ~np.isnan(motion) & ~_missing_rows(values, block_size)[rows]
+
+    subsets = [("full_sample", np.ones(len(subjects), dtype=bool))]
+    subsets += [(group, labels == group) for group in pd.unique(labels)]
+
+    metric, fwer_threshold = {}, {}
+    for group, mask in subsets:
+        cov = covarates[mask].apply(stats.zscore).values.astype(values.dtype)
+        keep = valid[mask] & ~np.isnan(cov).any(axis=1)
+        if block_size:
+            group_metric = _qcfc_blocks(
+                values,
+                rows[mask][keep],
+                motion[mask][keep],
+                cov[keep],
+                edge_ids,
+                block_size,
+                method,
+            )
+        else:
+            group_metric = _qcfc_table(
+                values[rows[mask][keep]],
+                motion[mask][keep],
+                cov[keep],
+                edge_ids,
+                n_permutations,
+                n_jobs,
+                random_state,
+                method,
+            )
+        for col in group_metric.columns:
+            metric[(group, f"{strategy_name}_{col}")] = group_metric[col].values
+        fwer_threshold[group] = group_metric.attrs.get("fwer_threshold")
+    metric = pd.DataFrame(metric, index=edge_ids)
+    metric.columns = pd.MultiIndex.from_tuples(metric.columns)
+    if n_permutations:
+        metric.attrs["fwer_threshold"] = fwer_threshold
+    return metric
+
+
+MOTION_SUMMARIES = [
+    "mean_framewise_displacement",
+    "median_framewise_displacement",
+    "max_framewise_displacement",
+    "mean_std_dvars",
+    "excised_vol_proportion",
+]
+
+
+def qcfc_motion_summaries(
+    motion, connectomes, covarates=None, method="pearson", block_size=None
+):
+    """
+    QC-FC against several motion summaries in a single pass.
+
+    The edges are residualised on the covariates once and correlated with
+    all the (residualised) motion summaries with a single matrix product.
+    Each column gives the same result as `qcfc` on the subjects with
+    complete data for all summaries.
+
+    Parameters
+    ----------
+
+    motion: pandas.DataFrame
+        Motion summaries, one per column, such as `MOTION_SUMMARIES`.
+        Index: subjects
+
+    connectomes: pandas.DataFrame
+        Flattened connectome of a whole dataset.
+        Index: subjets
+        Columns: ROI-ROI pairs
+
+    covariates: pandas.DataFrame or None
+        Age", Gender
+
+    method: str {"pearson", "spearman", "winsorized"}
+        Correlation method. See `qcfc`.
+
+    block_size: None or int
+        Process the edges by blocks of columns. See `qcfc`.
+
+    Returns
+    -------
+
+    pandas.DataFrame
+        QC/FC per connectome edge. Columns are a MultiIndex of
+        (motion summary, "correlation" / "pvalue"), one block per motion
+        summary in the order of `motion.columns`. Summaries without
+        variance across subjects are NaN.
+    """
+    values, rows, summary, cov, edge_ids = _align_qcfc_inputs(
+        motion, connectomes, covarates, block_size
+    )
+    # constant summaries (e.g. no excised volume without scrubbing) have no
+    # QC-FC; residualising would turn them into rounding noise
+    constant = np.ptp(summary, axis=0) == 0
+    summary = _transform_columns(summary, method)
+    if method == "spearman" and cov is not None:
+        cov = stats.zscore(stats.rankdata(cov, axis=0), axis=0).astype(cov.dtype)
+    if isinstance(cov, np.ndarray):
+        summary = _residualize(summary, cov)
+
+    # all steps are column-wise: only one block of edges is copied at a time
+    n_edges = values.shape[1]
+    block_size = block_size or max(n_edges, 1)
+    r = np.empty((summary.shape[1], n_edges), dtype=values.dtype)
+    p_val = np.empty((summary.shape[1], n_edges), dtype=np.float64)
+    for start in range(0, n_edges, block_size):
+        block = slice(start, start + block_size)
+        edges = _transform_columns(values[rows, block], method)
+        if isinstance(cov, np.ndarray):
+            edges = _residualize(edges, cov)
+        r[:, block], p_val[:, block] = _pearson_matrix(edges, summary)
+    r[constant], p_val[constant] = np.nan, np.nan
+
+    metric = {}
+    for i, name in enumerate(motion.columns):
+        metric[(name, "correlation")] = r[i]
+        metric[(name, "pvalue")] = p_val[i]
+    metric = pd.DataFrame(metric, index=edge_ids)
+    metric.columns = pd.MultiIndex.from_tuples(metric.columns)
+    return metric
+
+
+def _pearson_matrix(x, y):
+    """Pearson's correlation between each column of y and each column of x,
+    shape (n_y, n_x). x is centered in place."""
+    n = x.shape[0]
+    x -= x.mean(axis=0)
+    y = y - y.mean(axis=0)
+    x_norm = np.sqrt(np.einsum("ij,ij->j", x, x))
+    y_norm = np.sqrt(np.einsum("ij,ij->j", y, y))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        r = y.T.dot(x) / np.outer(y_norm, x_norm)
+    r = np.clip(r, -1.0, 1.0)
+    return r, _pearson_pvalue(r.astype(np.float64), n)
+
+
+class QCFCAccumulator:
+    """
+    Sufficient statistics of QC-FC that can absorb or release subjects.
+
+    `qcfc` residualises the edges X and motion y on the covariates centered
+    on the mean of the sample, without intercept, and correlates the
+    centered residuals. With the design A = [1, covariates], the centered
+    covariates are A T for T = [-mean; I], so the statistics A'A, A'y, y'y,
+    A'X, y'X and diag(X'X) are enough to recover the QC-FC of every edge.
+    Adding or removing a subject updates them in O(edges) time.
+
+    `qcfc` z-scores the covariates before dropping the subjects with
+    missing data, so their mean can include subjects the accumulator does
+    not hold; give it to `QCFCAccumulator.qcfc` to reproduce `qcfc`.
+
+    Parameters
+    ----------
+
+    edge_ids : list
+        Connectome edge ids, in column order.
+
+    covariate_names : list of str
+        Names of the covariates, e.g. ["age", "gender"].
+
+    Besides the statistics, the accumulator keeps the motion and raw
+    covariates of each subject (`inputs`), and a checksum of its connectome,
+    so a subject can be removed or checked against new values.
+    """
+
+    def __init__(self, edge_ids, covariate_names):
+        self.edge_ids = list(edge_ids)
+        self.covariate_names = list(covariate_names)
+        n_design = len(self.covariate_names) + 1
+        n_edges = len(self.edge_ids)
+        self.subjects = []
+        self.checksums = []
+        self.inputs = np.zeros((0, n_design))
+        self.design_design = np.zeros((n_design, n_design))
+        self.design_motion = np.zeros(n_design)
+        self.motion_motion = 0.0
+        self.design_edges = np.zeros((n_design, n_edges))
+        self.motion_edges = np.zeros(n_edges)
+        self.edges_edges = np.zeros(n_edges)
+
+    def add(self, movement, connectomes, covarates):
+        """Add subjects to the statistics.
+
+        Parameters
+        ----------
+
+        movement: pandas.Series
+            Mean framewise displacement.
+
+        connectomes: pandas.DataFrame
+            Flattened connectome. Index: subjets, Columns: ROI-ROI pairs
+
+        covariates: pandas.DataFrame
+            Raw (not z-scored) covariates.
+
+        Returns
+        -------
+        list
+            Subjects added. Subjects with missing data are skipped, as in
+            `qcfc`.
+        """
+        subjects, design, motion, edges = self._align(
+            movement, connectomes, covarates
+        )
+        duplicated = set(subjects).intersection(self.subjects)
+        if duplicated:
+            raise ValueError(f"Subjects already accumulated: {sorted(duplicated)}")
+        self._update(design, motion, edges, sign=1)
+        self.subjects += subjects
+        self.checksums += [_checksum(row) for row in edges]
+        self.inputs = np.vstack([self.inputs, np.column_stack([motion, design[:, 1:]])])
+        return subjects
+
+    def remove(self, movement, connectomes, covarates):
+        """Remove subjects from the statistics.
+
+        The values must be the ones used when the subjects were added.
+
+        Returns
+        -------
+        list
+            Subjects removed.
+        """
+        subjects, design, motion, edges = self._align(
+            movement, connectomes, covarates
+        )
+        for subject, row in zip(subjects, edges):
+            if subject not in self.subjects:
+                raise ValueError(f"Subject {subject} has not been accumulated.")
+            if self.checksums[self.subjects.index(subject)] != _checksum(row):
+                raise ValueError(
+                    f"Connectome of {subject} differs from the accumulated one."
+                )
+        self._update(design, motion, edges, sign=-1)
+        for subject in subjects:
+            idx = self.subjects.index(subject)
+            del self.subjects[idx], self.checksums[idx]
+            self.inputs = np.delete(self.inputs, idx, axis=0)
+        return subjects
+
+    def qcfc(self, covariate_mean=None):
+        """QC-FC of the accumulated subjects.
+
+        Parameters
+        ----------
+
+        covariate_mean : None or array-like
+            Mean of each covariate over the sample, including the subjects
+            dropped for missing data, as z-scored by `qcfc`. Default to the
+            mean over the accumulated subjects, i.e. a partial correlation
+            controlling for an intercept and the covariates.
+
+        Returns
+        -------
+
+        pandas.DataFrame
+            QC/FC per connectome edge, with columns "correlation" and
+            "pvalue", as returned by `qcfc`.
+        """
+        n = len(self.subjects)
+        if covariate_mean is None:
+            covariate_mean = self.design_design[0, 1:] / n
+        # design of the centered covariates, D = A T
+        transform = np.vstack(
+            [
+                -np.asarray(covariate_mean, dtype=float),
+                np.eye(len(self.covariate_names)),
+            ]
+        )
+        design_design = transform.T.dot(self.design_design).dot(transform)
+        design_motion = transform.T.dot(self.design_motion)
+        design_edges = transform.T.dot(self.design_edges)
+        inverse = linalg.pinvh(design_design)
+        beta_edges = inverse.dot(design_edges)
+        beta_motion = inverse.dot(design_motion)
+        edges_edges = self.edges_edges - np.einsum(
+            "ij,ij->j", design_edges, beta_edges
+        )
+        motion_edges = self.motion_edges - design_motion.dot(beta_edges)
+        motion_motion = self.motion_motion - design_motion.dot(beta_motion)
+        # pearson's correlation centers the residuals, whose sums are only
+        # zero when the covariates are centered on the accumulated subjects
+        sum_design = self.design_design[0].dot(transform)
+        sum_edges = self.design_edges[0] - sum_design.dot(beta_edges)
+        sum_motion = self.design_motion[0] - sum_design.dot(beta_motion)
+        edges_edges -= sum_edges**2 / n
+        motion_edges -= sum_motion * sum_edges / n
+        motion_motion -= sum_motion**2 / n
+        with np.errstate(divide="ignore", invalid="ignore"):
+            r = motion_edges / np.sqrt(edges_edges * motion_motion)
+        r = np.clip(r, -1.0, 1.0)
+        p_val = _pearson_pvalue(r, n)
+        return pd.DataFrame({"correlation": r, "pvalue": p_val}, index=self.edge_ids)
+
+    def save(self, path):
+        """Save the statistics to a .npz file."""
+        np.savez(
+            path,
+            edge_ids=np.asarray(self.edge_ids),
+            covariate_names=np.asarray(self.covariate_names),
+            subjects=np.asarray(self.subjects, dtype=str),
+            checksums=np.asarray(self.checksums, dtype=str),
+            inputs=self.inputs,
+            design_design=self.design_design,
+            design_motion=self.design_motion,
+            motion_motion=self.motion_motion,
+            design_edges=self.design_edges,
+            motion_edges=self.motion_edges,
+            edges_edges=self.edges_edges,
+        )
+
+    @classmethod
+    def load(cls, path):
+        """Load statistics saved with `QCFCAccumulator.save`."""
+        with np.load(path) as data:
+            accumulator = cls(data["edge_ids"].tolist(), data["covariate_names"])
+            accumulator.subjects = data["subjects"].tolist()
+            accumulator.checksums = data["checksums"].tolist()
+            # accumulators saved before the inputs were kept cannot remove
+            # subjects
+            accumulator.inputs = data["inputs"] if "inputs" in data.files else None
+            for name in (
+                "design_design",
+                "design_motion",
+                "design_edges",
+                "motion_edges",
+                "edges_edges",
+            ):
+                setattr(accumulator, name, data[name])
+            accumulator.motion_motion = float(data["motion_motion"])
+        return accumulator
+
+    def _align(self, movement, connectomes, covarates):
+        """Align inputs on subjects and drop subjects with missing data."""
+        subjects = connectomes.index.intersection(movement.index, sort=False)
+        subjects = subjects.intersection(covarates.index, sort=False)
+        edges = connectomes.loc[subjects, self.edge_ids].values.astype(float)
+        motion = movement.loc[subjects].values.astype(float)
+        cov = covarates.loc[subjects, self.covariate_names].values.astype(float)
+        valid = (
+            ~np.isnan(edges).any(axis=1)
+            & ~np.isnan(motion)
+            & ~np.isnan(cov).any(axis=1)
+        )
+        design = np.column_stack([np.ones(valid.sum()), cov[valid]])
+        return subjects[valid].tolist(), design, motion[valid], edges[valid]
+
+    def _update(self, design, motion, edges, sign):
+        """Add (sign=1) or subtract (sign=-1) the subjects' cross-products."""
+        self.design_design += sign * design.T.dot(design)
+        self.design_motion += sign * design.T.dot(motion)
+        self.motion_motion += sign * motion.dot(motion)
+        self.design_edges += sign * design.T.dot(edges)
+        self.motion_edges += sign * motion.dot(edges)
+        self.edges_edges += sign * np.einsum("ij,ij->j", edges, edges)
+
+
+def update_qcfc_accumulator(path, movement, connectomes, covarates):
+    """
+    Bring the QC-FC accumulator saved at `path` up to date with a sample.
+
+    The connectome of each accumulated subject is saved in
+    `<path>.subjects/<subject>.npy`. Subjects that left the sample are
+    removed from the statistics with these values, subjects whose
+    connectome, motion or covariates changed are removed and added back
+    with the new values, and new subjects are added; the other subjects are
+    not read. The statistics are only rebuilt from the current sample when
+    the edges or covariates change, or the saved values are missing.
+
+    Parameters
+    ----------
+
+    path : pathlib.Path
+        Location of the .npz accumulator file.
+
+    movement, connectomes, covarates :
+        Current sample. See `QCFCAccumulator.add`.
+
+    Returns
+    -------
+    QCFCAccumulator
+        Updated accumulator, also saved to `path`.
+    """
+    rows_dir = path.parent / f"{path.name}.subjects"
+    accumulator = None
+    if path.is_file():
+        accumulator = QCFCAccumulator.load(path)
+        if (
+            accumulator.edge_ids != connectomes.columns.tolist()
+            or accumulator.covariate_names != covarates.columns.tolist()
+        ):
+            print(f"Edges or covariates changed since {path.name}; rebuilding.")
+            accumulator = None
+        elif accumulator.inputs is None or not all(
+            (rows_dir / f"{subject}.npy").is_file() for subject in accumulator.subjects
+        ):
+            print(f"Saved subjects of {path.name} not found; rebuilding.")
+            accumulator = None
+
+    if accumulator is None:
+        accumulator = QCFCAccumulator(connectomes.columns, covarates.columns)
+        if rows_dir.is_dir():
+            for file in rows_dir.glob("*.npy"):
+                file.unlink()
+    else:
+        stale = _stale_subjects(accumulator, movement, connectomes, covarates)
+        if stale:
+            idx = [accumulator.subjects.index(subject) for subject in stale]
+            inputs = pd.DataFrame(
+                accumulator.inputs[idx],
+                index=stale,
+                columns=["motion"] + accumulator.covariate_names,
+            )
+            rows = pd.DataFrame(
+                np.stack([np.load(rows_dir / f"{subject}.npy") for subject in stale]),
+                index=stale,
+                columns=accumulator.edge_ids,
+            )
+            accumulator.remove(
+                inputs["motion"], rows, inputs[accumulator.covariate_names]
+            )
+            for subject in stale:
+                (rows_dir / f"{subject}.npy").unlink()
+            print(f"Removed {len(stale)} changed or left subjects from {path.name}.")
+
+    new_subjects = connectomes.index.difference(accumulator.subjects, sort=False)
+    added = accumulator.add(
+        movement.loc[movement.index.intersection(new_subjects)],
+        connectomes.loc[new_subjects],
+        covarates.loc[covarates.index.intersection(new_subjects)],
+    )
+    rows_dir.mkdir(parents=True, exist_ok=True)
+    for subject in added:
+        np.save(
+            rows_dir / f"{subject}.npy",
+            connectomes.loc[subject, accumulator.edge_ids].values.astype(float),
+        )
+    print(f"Added {len(added)} subjects to {path.name}.")
+    accumulator.save(path)
+    return accumulator
+
+
+def _stale_subjects(accumulator, movement, connectomes, covarates):
+    """Accumulated subjects absent from the sample, or whose connectome,
+    motion or covariates differ from the accumulated ones."""
+    stale = []
+    for subject, checksum, inputs in zip(
+        accumulator.subjects, accumulator.checksums, accumulator.inputs
+    ):
+        if not (
+            subject in connectomes.index
+            and subject in movement.index
+            and subject in covarates.index
+        ):
+            stale.append(subject)
+            continue
+        current = np.append(
+            float(movement.loc[subject]),
+            covarates.loc[subject, accumulator.covariate_names].values.astype(float),
+        )
+        edges = connectomes.loc[subject, accumulator.edge_ids].values
+        if checksum != _checksum(edges) or not np.array_equal(current, inputs):
+            stale.append(subject)
+    return stale
+
+
+def qcfc_by_group_incremental(
+    accumulator_dir, prefix, movement, connectomes, covarates, groups, strategy_name
+):
+    """
+    Same output as `qcfc_by_group`, from accumulators saved on disk.
+
+    One accumulator per group is kept in `accumulator_dir` and updated with
+    `update_qcfc_accumulator`, so only the subjects added, changed or removed
+    since the last run are processed.
+
+    Parameters
+    ----------
+
+    accumulator_dir : pathlib.Path
+        Directory of the accumulator files.
+
+    prefix : str
+        File name prefix of the accumulators, e.g. "atlas-mist_nroi-444".
+
+    movement, connectomes, covarates, groups, strategy_name :
+        See `qcfc_by_group`.
+
+    Returns
+    -------
+
+    pandas.DataFrame
+        QC/FC per connectome edge, by group.
+    """
+    accumulator_dir.mkdir(parents=True, exist_ok=True)
+    # same subjects as `qcfc_by_group`
+    subjects = (
+        connectomes.index.intersection(movement.index, sort=False)
+        .intersection(covarates.index, sort=False)
+        .intersection(groups.index, sort=False)
+    )
+    groups = groups.loc[subjects]
+    subsets = [("full_sample", groups.index)]
+    subsets += [(group, groups.index[groups == group]) for group in groups.unique()]
+
+    metric = {}
+    for group, subjects in subsets:
+        path = accumulator_dir / f"{prefix}_desc-{strategy_name}_group-{group}.npz"
+        accumulator = update_qcfc_accumulator(
+            path,
+            movement.loc[subjects],
+            connectomes.loc[subjects],
+            covarates.loc[subjects],
+        )
+        # covariates centered as z-scored by `qcfc_by_group`, also over the
+        # subjects dropped for missing data
+        covariate_mean = covarates.loc[subjects, accumulator.covariate_names].mean()
+        group_metric = accumulator.qcfc(covariate_mean)
+        for col in group_metric.columns:
+            metric[(group, f"{strategy_name}_{col}")] = group_metric[col].values
+    metric = pd.DataFrame(metric, index=connectomes.columns.tolist())
+    metric.columns = pd.MultiIndex.from_tuples(metric.columns)
+    return metric
+
+
+def _checksum(values):
+    """Short fingerprint of a subject's connectome."""
+    values = np.ascontiguousarray(values, dtype=float)
+    return hashlib.sha1(values.tobytes()).hexdigest()[:16]
@@ -0,0 +1,103 @@
+import numpy as np
+import pandas as pd
+
+
+class ROISubset:
+    """
+    ROIs kept after exclusion, with the matching edges of the flattened
+    connectomes.
+
+    Connectomes, pairwise distances and QC-FC tables are flattened as the
+    lower triangle of the ROI by ROI matrix, without diagonal, in the order
+    of nilearn's `sym_matrix_to_vec`. The position of the edges among kept
+    ROIs in the full vector is computed once, so any of these can be subset
+    with a single positional index, in the order of the lower triangle of
+    the kept ROIs.
+
+    Parameters
+    ----------
+
+    roi_mask : array-like of bool
+        True for the ROIs to keep, in atlas order.
+
+    roi_labels : None or list
+        Names of the ROIs, in atlas order.
+    """
+
+    def __init__(self, roi_mask, roi_labels=None):
+        self.roi_mask = np.asarray(roi_mask, dtype=bool)
+        self.roi_labels = None if roi_labels is None else list(roi_labels)
+        self.roi_index = np.flatnonzero(self.roi_mask)
+        rows, cols = np.tril_indices(len(self.roi_index), k=-1)
+        rows, cols = self.roi_index[rows], self.roi_index[cols]
+        # position of the edge (row, col), row > col, in the full vector
+        self.edge_index = rows * (rows - 1) // 2 + cols
+
+    @classmethod
+    def from_excluded(cls, roi_labels, excluded_rois):
+        """Keep the ROIs whose label is not in `excluded_rois`."""
+        roi_labels = pd.Index(roi_labels).astype(str)
+        roi_mask = ~roi_labels.isin(pd.Index(excluded_rois).astype(str))
+        return cls(roi_mask, roi_labels)
+
+    @classmethod
+    def from_csv(cls, roi_labels, excluded_rois_path):
+        """Keep the ROIs not listed in the column 'roi_name' of a csv file,
+        such as the rois_dropped.csv of the HALFpipe conversion."""
+        excluded_rois = pd.read_csv(excluded_rois_path)["roi_name"]
+        return cls.from_excluded(roi_labels, excluded_rois)
+
+    @classmethod
+    def from_missing_rate(cls, missing_matrix, threshold=0.10, roi_labels=None):
+        """Keep the ROIs missing in less than `threshold` of the subjects.
+
+        Parameters
+        ----------
+
+        missing_matrix : numpy.ndarray, shape (n_subjects, n_rois)
+            True where the subject has missing values in the ROI.
+        """
+        roi_missing_rate = np.mean(missing_matrix, axis=0)
+        return cls(roi_missing_rate < threshold, roi_labels)
+
+    @property
+    def n_rois(self):
+        """Number of ROIs of the atlas."""
+        return len(self.roi_mask)
+
+    @property
+    def n_edges(self):
+        """Number of edges of the full connectome."""
+        return self.n_rois * (self.n_rois - 1) // 2
+
+    @property
+    def kept_labels(self):
+        """Names of the kept ROIs."""
+        if self.roi_labels is None:
+            return self.roi_index.tolist()
+        return [self.roi_labels[i] for i in self.roi_index]
+
+    def subset_edges(self, data, axis=-1):
+        """Edges among the kept ROIs of flattened connectomes, distances or
+        QC-FC tables, along `axis` (the edge axis).
+
+        pandas objects are subset by position and keep their full connectome
+        edge labels.
+        """
+        return self._take(data, self.edge_index, axis, self.n_edges, "edges")
+
+    def subset_rois(self, data, axis=-1):
+        """Kept ROIs of time series or centroids, along `axis` (the ROI
+        axis)."""
+        return self._take(data, self.roi_index, axis, self.n_rois, "ROIs")
+
+    @staticmethod
+    def _take(data, index, axis, expected, name):
+        if data.shape[axis] != expected:
+            raise ValueError(
+                f"Expected {expected} {name} along axis {axis}, got "
+                f"{data.shape[axis]}."
+            )
+        if isinstance(data, (pd.DataFrame, pd.Series)):
+            return data.take(index, axis=axis % data.ndim)
+        return np.take(data, index, axis=axis)
@@ -0,0 +1,53 @@
+"""Test the arguments shared by the build_features entry points."""
+import argparse
+
+import pytest
+
+from fmriprep_denoise.features.arguments import (
+    add_feature_arguments,
+    check_feature_arguments,
+    connectome_store_root,
+    output_metric_name,
+)
+
+
+def test_add_feature_arguments(tmp_path):
+    """Shared arguments parse with their defaults."""
+    parser = add_feature_arguments(argparse.ArgumentParser())
+    args = parser.parse_args(["inputs", str(tmp_path), "--kind", "tangent"])
+    assert args.kind == "tangent"
+    assert args.num_opt == 100
+    assert connectome_store_root(args, tmp_path) == tmp_path / "connectome_store"
+    args = parser.parse_args(["inputs", str(tmp_path), "--no_connectome_store"])
+    assert connectome_store_root(args, tmp_path) is None
+
+
+@pytest.mark.parametrize(
+    "metric,kind,qcfc_method,expected",
+    [
+        ("qcfc", "correlation", "pearson", "qcfc"),
+        ("qcfc", "partial correlation", "spearman", "qcfc_spearman_partialcorrelation"),
+        ("modularity", "tangent", "spearman", "modularity_tangent"),
+    ],
+)
+def test_output_metric_name(metric, kind, qcfc_method, expected):
+    assert output_metric_name(metric, kind, qcfc_method) == expected
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        ["--qcfc_method", "spearman"],
+        ["--n_permutations", "100"],
+        ["--block_size", "1000"],
+    ],
+)
+def test_check_feature_arguments(tmp_path, options):
+    """Options the QC-FC accumulator would ignore are rejected."""
+    parser = add_feature_arguments(argparse.ArgumentParser())
+    parser.add_argument("--block_size", type=int, default=None)
+    args = parser.parse_args(["inputs", str(tmp_path)] + options)
+    assert check_feature_arguments(parser, args) is args
+    args = parser.parse_args(["inputs", str(tmp_path), "--qcfc_accumulator"] + options)
+    with pytest.raises(SystemExit):
+        check_feature_arguments(parser, args)
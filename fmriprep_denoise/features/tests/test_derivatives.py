@@ -1,4 +1,5 @@
 """Test some private functions."""
+import json
 from pathlib import Path
 from fmriprep_denoise.features import derivatives
 import pandas as pd
@@ -55,3 +56,272 @@ def test_get_qc_criteria(strategy_name, fd_thresh):
     motion_qc = derivatives.get_qc_criteria(strategy_name)
     assert type(motion_qc) is dict
     assert motion_qc["fd_thresh"] == fd_thresh
+
+
+def test_correlation_connectomes_float32():
+    """Single precision connectomes match nilearn's float64 output."""
+    from nilearn.connectome import ConnectivityMeasure
+
+    valid_ts = [np.random.uniform(0, 1, size=(200, 20)) for _ in range(5)]
+    expected = ConnectivityMeasure(
+        kind="correlation", vectorize=True, discard_diagonal=True
+    ).fit_transform(valid_ts)
+    subject_conn = derivatives._correlation_connectomes(valid_ts, np.float32)
+    assert subject_conn.dtype == np.float32
+    np.testing.assert_allclose(subject_conn, expected, atol=1e-6)
+
+
+def test_connectome_store(tmp_path):
+    """Covariances are stored once and updated when a time series changes."""
+    extracted_path, subjects = _make_fake_timeseries_collection(
+        tmp_path / "timeseries", empty_file=True
+    )
+    sources = derivatives._find_timeseries_files(
+        "test", extracted_path, subjects, "desc-test"
+    )
+    store = derivatives.connectome_store_path(
+        tmp_path / "store", "ds", "fmriprep", "atlas-test_desc-scrubbing.5"
+    )
+    stored = derivatives.load_connectome_store(
+        store, sources, derivatives._read_timeseries
+    )
+    valid_ids, valid_ts = derivatives._load_valid_timeseries(
+        "test", extracted_path, subjects, "desc-test"
+    )
+    expected = derivatives._covariance_statistics(valid_ts)
+    assert stored.index.tolist() == valid_ids
+    np.testing.assert_array_equal(stored.values, expected)
+    assert (store.parent / f"{store.name}.npy").is_file()
+
+    # new time series for one subject invalidates its row only
+    df = pd.DataFrame(np.random.uniform(0, 1, size=(150, 100)))
+    df.to_csv(sources["sub-002"], sep="\t", index=False)
+    updated = derivatives.load_connectome_store(
+        store, sources, derivatives._read_timeseries
+    )
+    expected[1] = derivatives._covariance_statistics([df.values])[0]
+    np.testing.assert_allclose(updated.values, expected, atol=1e-12)
+
+    # subset of the stored subjects
+    subset = {k: sources[k] for k in ["sub-003", "sub-001"]}
+    subset = derivatives.load_connectome_store(
+        store, subset, derivatives._read_timeseries
+    )
+    np.testing.assert_allclose(subset.values, expected[[2, 0]], atol=1e-12)
+
+    # another parser of the same files does not reuse the covariances
+    assert derivatives.connectome_store_path(
+        tmp_path / "store", "ds", "fmriprep", "atlas-test_desc-scrubbing.5",
+        reader="headerless",
+    ) != store
+
+    def read_headerless(file_path):
+        return pd.read_csv(file_path, sep="\t", header=None).values.astype(float)
+
+    subset_sources = {k: sources[k] for k in ["sub-003", "sub-001"]}
+    rebuilt = derivatives.load_connectome_store(
+        store, subset_sources, read_headerless, reader="headerless"
+    )
+    headerless = derivatives._covariance_statistics(
+        [read_headerless(path) for path in subset_sources.values()]
+    )
+    np.testing.assert_allclose(rebuilt.values, headerless, atol=1e-12)
+    assert not np.allclose(rebuilt.values, subset.values)
+    assert json.loads((store.parent / f"{store.name}.json").read_text()) == {
+        "reader": "headerless"
+    }
+
+
+def test_load_timeseries(tmp_path):
+    """Parallel loader stacks the valid time series with a volume mask."""
+    extracted_path, subjects = _make_fake_timeseries_collection(
+        tmp_path, empty_file=True
+    )
+    valid_ids, valid_ts = derivatives._load_valid_timeseries(
+        "test", extracted_path, subjects, "desc-test"
+    )
+    ids, timeseries, mask = derivatives.load_timeseries(
+        "test", extracted_path, subjects + ["sub-011"], "desc-test", n_jobs=2
+    )
+    assert ids == valid_ids
+    assert derivatives._index_timeseries_patterns(extracted_path) == {
+        "atlas-test_nroi-100_desc-test"
+    }
+    assert timeseries.shape == (9, 200, 100)
+    assert mask.all()
+    np.testing.assert_array_equal(timeseries, np.stack(valid_ts))
+
+    short = [np.ones((3, 2)), np.ones((5, 2))]
+    timeseries, mask = derivatives.stack_timeseries(short, np.float32)
+    assert timeseries.dtype == np.float32
+    assert mask.sum(axis=1).tolist() == [3, 5]
+    assert np.isnan(timeseries[0, 3:]).all()
+
+
+def test_correlation_connectomes_batched():
+    """Batches of subjects with different lengths match nilearn."""
+    from nilearn.connectome import ConnectivityMeasure
+
+    rng = np.random.default_rng(0)
+    valid_ts = [
+        rng.normal(size=(length, 20)) * rng.uniform(1, 3, size=20)
+        for length in [200, 150, 200, 120, 150]
+    ]
+    valid_ts[1][:, 4] = 1.0  # constant signal
+    correlation_measure = ConnectivityMeasure(
+        kind="correlation", vectorize=True, discard_diagonal=True
+    )
+    expected = np.stack([correlation_measure.fit_transform([ts])[0] for ts in valid_ts])
+    subject_conn = derivatives._correlation_connectomes(valid_ts)
+    np.testing.assert_allclose(subject_conn, expected, atol=1e-12)
+
+
+@pytest.mark.parametrize("kind", ["correlation", "partial correlation", "tangent"])
+def test_connectomes_from_covariances(tmp_path, kind):
+    """All connectivity kinds derived from the covariance cache match nilearn."""
+    from nilearn.connectome import ConnectivityMeasure
+
+    rng = np.random.default_rng(0)
+    valid_ts = [
+        rng.normal(size=(length, 15)) * rng.uniform(1, 3, size=15)
+        for length in [200, 150, 200, 120, 150, 200]
+    ]
+    expected = ConnectivityMeasure(
+        kind=kind, vectorize=True, discard_diagonal=True
+    ).fit_transform(valid_ts)
+    statistics = derivatives._covariance_statistics(valid_ts)
+    subject_conn = derivatives._connectomes_from_covariances(statistics, kind)
+    np.testing.assert_allclose(subject_conn, expected, atol=1e-10)
+
+    # filled by batches into a memory-mapped file
+    subjects = [f"sub-{i+1:03d}" for i in range(len(valid_ts))]
+    out = derivatives.create_connectome_memmap(
+        tmp_path / "connectomes", subjects, expected.shape[1]
+    )
+    derivatives._connectomes_from_covariances(statistics, kind, out=out)
+    out.flush()
+    stored = derivatives.load_connectome_memmap(tmp_path / "connectomes")
+    assert stored.index.tolist() == subjects
+    np.testing.assert_array_equal(stored.values, subject_conn)
+
+
+def test_pairwise_complete_connectomes():
+    """Pairwise complete correlations match pandas and count valid volumes."""
+    rng = np.random.default_rng(0)
+    valid_ts = [rng.normal(size=(length, 8)) for length in [50, 40, 50]]
+    valid_ts[0][:10, 2] = np.nan
+    valid_ts[0][5:20, 6] = np.nan
+    valid_ts[2][:, 3] = np.nan  # ROI missing for the whole scan
+    subject_conn, valid_samples = derivatives.pairwise_complete_connectomes(
+        valid_ts
+    )
+    rows, cols = np.tril_indices(8, k=-1)
+    for i, ts in enumerate(valid_ts):
+        expected = pd.DataFrame(ts).corr().values[rows, cols]
+        np.testing.assert_allclose(subject_conn[i], expected, atol=1e-12)
+        observed = ~np.isnan(ts)
+        counts = (observed.T.astype(int) @ observed.astype(int))[rows, cols]
+        np.testing.assert_array_equal(valid_samples[i], counts)
+    assert np.isnan(subject_conn[2][(rows == 3) | (cols == 3)]).all()
+
+
+def test_pairwise_connectome_frames(tmp_path):
+    """Valid volume counts are saved next to the connectomes of the
+    phenotype subjects."""
+    rng = np.random.default_rng(0)
+    valid_ts = [rng.normal(size=(30, 5)) for _ in range(3)]
+    valid_ts[1][:4, 0] = np.nan
+    phenotype = pd.DataFrame({"age": [10, 20]}, index=["sub-3", "sub-2"])
+    path = tmp_path / "valid_samples" / "desc-simple"
+    subject_conn, subset = derivatives._pairwise_connectome_frames(
+        ["sub-1", "sub-2", "sub-3"],
+        valid_ts,
+        phenotype,
+        valid_samples_path=path,
+    )
+    assert subject_conn.index.tolist() == ["sub-2", "sub-3"]
+    assert subset.index.tolist() == ["sub-2", "sub-3"]
+    assert not subject_conn.attrs
+    valid_samples = derivatives.load_connectome_memmap(path)
+    _, expected = derivatives.pairwise_complete_connectomes(valid_ts[1:])
+    assert valid_samples.index.tolist() == ["sub-2", "sub-3"]
+    np.testing.assert_array_equal(valid_samples.values, expected)
+
+
+def test_roi_subset():
+    """Edges of the kept ROIs match the connectome of the kept time series."""
+    from fmriprep_denoise.features import ROISubset
+
+    rng = np.random.default_rng(0)
+    valid_ts = [rng.normal(size=(60, 10)) for _ in range(3)]
+    roi_labels = [f"roi{i}" for i in range(10)]
+    roi_subset = ROISubset.from_excluded(roi_labels, ["roi0", "roi4", "roi7"])
+    assert roi_subset.kept_labels == [
+        label for label in roi_labels if label not in ["roi0", "roi4", "roi7"]
+    ]
+
+    full_conn = derivatives._correlation_connectomes(valid_ts)
+    subset_ts = [roi_subset.subset_rois(ts) for ts in valid_ts]
+    subset_conn = derivatives._correlation_connectomes(subset_ts)
+    # the correlation does not depend on other ROIs without shrinkage
+    full_pairwise, _ = derivatives.pairwise_complete_connectomes(valid_ts)
+    subset_pairwise, _ = derivatives.pairwise_complete_connectomes(subset_ts)
+    np.testing.assert_allclose(
+        roi_subset.subset_edges(full_pairwise), subset_pairwise, atol=1e-12
+    )
+    qcfc_table = pd.DataFrame(full_conn.T, columns=["a", "b", "c"])
+    subset_table = roi_subset.subset_edges(qcfc_table, axis=0)
+    assert subset_table.shape == (subset_conn.shape[1], 3)
+    np.testing.assert_array_equal(subset_table.index, roi_subset.edge_index)
+    with pytest.raises(ValueError):
+        roi_subset.subset_edges(subset_conn)
+
+
+@pytest.mark.parametrize("mode", ["w:gz", "w"])
+def test_check_extraction_patterns(tmp_path, mode):
+    """Only the members matching the patterns are extracted or read."""
+    import tarfile
+
+    source = tmp_path / "source" / "fmriprep-20.2.1lts" / "sub-1" / "func"
+    source.mkdir(parents=True)
+    (source / "sub-1_desc-confounds_timeseries.tsv").write_text("a\tb\n1\t2\n")
+    (source / "sub-1_desc-confounds_timeseries.json").write_text("{}")
+    (source / "sub-1_desc-preproc_bold.nii.gz").write_bytes(b"0" * 2048)
+    archive = tmp_path / "fmriprep-20.2.1lts.tar.gz"
+    with tarfile.open(archive, mode) as tar:
+        tar.add(tmp_path / "source" / "fmriprep-20.2.1lts", "fmriprep-20.2.1lts")
+
+    members = dict(derivatives.read_tar_members(archive, ["*_timeseries.tsv"]))
+    assert members == {
+        "fmriprep-20.2.1lts/sub-1/func/sub-1_desc-confounds_timeseries.tsv": (
+            b"a\tb\n1\t2\n"
+        )
+    }
+    assert derivatives._suffixed(archive, ".members.json").is_file()
+
+    # a valid index stops compressed streams after the last match
+    members = dict(derivatives.read_tar_members(archive, ["*.json"]))
+    assert list(members) == [
+        "fmriprep-20.2.1lts/sub-1/func/sub-1_desc-confounds_timeseries.json"
+    ]
+
+    extracted_root = tmp_path / "extracted"
+    extracted_path = derivatives.check_extraction(
+        archive, extracted_root, derivatives.EXTRACTION_PATTERNS
+    )
+    extracted = sorted(p.name for p in extracted_path.rglob("*") if p.is_file())
+    assert extracted == [
+        "sub-1_desc-confounds_timeseries.json",
+        "sub-1_desc-confounds_timeseries.tsv",
+    ]
+    record_path = extracted_root / "fmriprep-20.2.1lts.patterns.json"
+    assert json.loads(record_path.read_text()) == ["*.json", "*.tsv"]
+    # files not matching the recorded patterns are extracted on request
+    derivatives.check_extraction(archive, extracted_root, ["*.nii.gz"])
+    assert (extracted_path / "sub-1" / "func" / "sub-1_desc-preproc_bold.nii.gz").is_file()
+    assert json.loads(record_path.read_text()) == ["*.json", "*.nii.gz", "*.tsv"]
+    # the default extracts the whole archive
+    derivatives.check_extraction(archive, extracted_root)
+    assert not record_path.exists()
+    full_path = derivatives.check_extraction(archive, tmp_path / "full")
+    assert len([p for p in full_path.rglob("*") if p.is_file()]) == 3
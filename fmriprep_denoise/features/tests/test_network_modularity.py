@@ -0,0 +1,118 @@
+import numpy as np
+
+from fmriprep_denoise.features.network_modularity import (
+    compute_commuity,
+    louvain_modularities,
+    louvain_modularity,
+    louvain_und_sign,
+)
+
+
+def _connectome(n_rois=30, seed=0):
+    rng = np.random.default_rng(seed)
+    networks = rng.integers(3, size=n_rois)
+    timeseries = rng.normal(size=(100, 3))[:, networks]
+    timeseries += rng.normal(size=(100, n_rois))
+    return np.corrcoef(timeseries.T)
+
+
+def test_compute_commuity_seed():
+    """Seeded optimizations do not depend on the number of workers."""
+    G = _connectome()
+    CI, Q = compute_commuity(G, num_opt=8, n_jobs=1, seed=0)
+    CI_parallel, Q_parallel = compute_commuity(G, num_opt=8, n_jobs=2, seed=0)
+    assert CI.shape == (30, 8)
+    np.testing.assert_array_equal(CI, CI_parallel)
+    assert Q == Q_parallel
+
+
+def test_louvain_modularities(tmp_path):
+    """Batched modularities match the subject-level wrapper."""
+    rows, cols = np.tril_indices(30, k=-1)
+    connectomes = np.stack([_connectome(seed=i)[rows, cols] for i in range(3)])
+    modularities = louvain_modularities(connectomes, num_opt=4, n_jobs=2, seed=1)
+    subject_seeds = np.random.SeedSequence(1).spawn(3)
+    expected = [
+        louvain_modularity(vect, num_opt=4, seed=subject_seed)
+        for vect, subject_seed in zip(connectomes, subject_seeds)
+    ]
+    np.testing.assert_allclose(modularities, expected)
+    # connectomes memory-mapped from a file by the workers
+    np.save(tmp_path / "connectomes.npy", connectomes)
+    modularities = louvain_modularities(
+        tmp_path / "connectomes.npy", num_opt=4, n_jobs=2, seed=1
+    )
+    np.testing.assert_allclose(modularities, expected)
+
+
+def test_compute_commuity_early_stopping():
+    """Early stopping records the optimizations performed."""
+    G = _connectome()
+    CI, Q, info = compute_commuity(G, num_opt=40, seed=0, return_info=True)
+    assert info == {"n_opt": 40, "sem": info["sem"], "stopped_early": False}
+    CI_tol, Q_tol, info = compute_commuity(
+        G, num_opt=40, seed=0, tol=1.0, return_info=True
+    )
+    # the first round is the same optimizations
+    assert info["n_opt"] == 10 and info["stopped_early"]
+    np.testing.assert_array_equal(CI_tol, CI[:, :10])
+    _, _, info = compute_commuity(
+        G, num_opt=40, seed=0, stable_rounds=1, return_info=True
+    )
+    assert info["n_opt"] in [20, 30, 40]
+
+
+def test_louvain_und_sign():
+    """The NumPy engine matches bct's partitions and modularity per seed."""
+    from bct import modularity_louvain_und_sign
+
+    G = _connectome(n_rois=60)
+    for seed in range(5):
+        ci, q = louvain_und_sign(G, seed=seed)
+        ci_bct, q_bct = modularity_louvain_und_sign(G, seed=seed)
+        np.testing.assert_array_equal(ci, ci_bct)
+        np.testing.assert_allclose(q, q_bct, atol=1e-12)
+    _, Q = compute_commuity(G, num_opt=4, seed=0, backend="numpy")
+    _, Q_bct = compute_commuity(G, num_opt=4, seed=0, backend="bct")
+    np.testing.assert_allclose(Q, Q_bct, atol=1e-12)
+
+
+def test_save_partitions(tmp_path):
+    """Affiliations round-trip through the integer store with consensus."""
+    from fmriprep_denoise.features import load_partitions, save_partitions
+
+    rows, cols = np.tril_indices(30, k=-1)
+    connectomes = np.stack([_connectome(seed=i)[rows, cols] for i in range(2)])
+    _, runs, CIs = louvain_modularities(
+        connectomes, num_opt=20, n_jobs=1, seed=0, tol=1.0,
+        return_info=True, return_partitions=True,
+    )
+    assert [CI.shape for CI in CIs] == [(30, run["n_opt"]) for run in runs]
+    path = tmp_path / "partitions" / "desc-simple.npz"
+    save_partitions(path, ["sub-1", "sub-2"], CIs)
+    partitions = load_partitions(path)
+    assert list(partitions) == ["sub-1", "sub-2"]
+    for CI, (affiliations, consensus) in zip(CIs, partitions.values()):
+        assert affiliations.dtype == np.uint8
+        np.testing.assert_array_equal(affiliations, CI)
+        assert consensus.shape == (30,) and consensus.min() == 1
+
+
+def test_louvain_modularities_nested(tmp_path, monkeypatch):
+    """Called from a joblib worker, the optimizations still run in processes
+    sharing the connectomes through JOBLIB_TEMP_FOLDER."""
+    from joblib import Parallel, delayed
+
+    from fmriprep_denoise.features.network_modularity import _shared_connectomes
+
+    rows, cols = np.tril_indices(30, k=-1)
+    connectomes = np.stack([_connectome(seed=i)[rows, cols] for i in range(2)])
+    monkeypatch.setenv("JOBLIB_TEMP_FOLDER", str(tmp_path))
+    with _shared_connectomes(connectomes, n_workers=2) as path:
+        assert path.parent.parent == tmp_path
+    expected = louvain_modularities(connectomes, num_opt=4, n_jobs=1, seed=1)
+    nested = Parallel(n_jobs=2)(
+        delayed(louvain_modularities)(connectomes, num_opt=4, n_jobs=2, seed=1)
+        for _ in range(2)
+    )
+    np.testing.assert_allclose(nested, [expected] * 2)
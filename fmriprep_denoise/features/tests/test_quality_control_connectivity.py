@@ -0,0 +1,381 @@
+"""Test QC-FC calculation."""
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import stats
+
+from fmriprep_denoise.features import quality_control_connectivity as qc
+
+
+def _make_fake_qcfc_data(n_subjects=50, n_edges=30, seed=42):
+    """Make test data."""
+    rng = np.random.default_rng(seed)
+    subjects = [f"sub-{i+1:03d}" for i in range(n_subjects)]
+    motion = rng.gamma(2, 0.1, size=n_subjects)
+    covariates = pd.DataFrame(
+        {
+            "age": rng.uniform(4, 40, size=n_subjects),
+            "gender": rng.integers(0, 2, size=n_subjects),
+        },
+        index=subjects,
+    )
+    connectomes = rng.normal(size=(n_subjects, n_edges)) + 0.5 * motion[:, None]
+    connectomes = pd.DataFrame(connectomes, index=subjects)
+    connectomes.iloc[3, 5] = np.nan  # one subject with missing edge
+    movement = pd.Series(motion, index=subjects, name="mean_framewise_displacement")
+    groups = pd.Series(
+        np.where(covariates["age"] > 18, "adult", "child"), index=subjects
+    )
+    return movement, connectomes, covariates, groups
+
+
+def test_qcfc_vectorize_matches_loop():
+    """Vectorised QC-FC gives the same table as the per-edge loop."""
+    movement, connectomes, covariates, _ = _make_fake_qcfc_data()
+    expected = qc.qcfc(movement, connectomes, covariates, vectorize=False)
+    result = qc.qcfc(movement, connectomes, covariates)
+    assert result.shape == (30, 2)
+    assert list(result.columns) == ["correlation", "pvalue"]
+    np.testing.assert_allclose(result.values, expected.values, rtol=1e-8)
+
+
+def test_partial_correlation_matrix():
+    """Without covariates, it is a plain pearson's correlation."""
+    movement, connectomes, _, _ = _make_fake_qcfc_data()
+    x = connectomes.dropna().values
+    y = movement[connectomes.dropna().index].values
+    r, p_val = qc.partial_correlation_matrix(x, y)
+    expected = qc.partial_correlation(x[:, 0], y)
+    assert r[0] == pytest.approx(expected["correlation"])
+    assert p_val[0] == pytest.approx(expected["pvalue"])
+
+
+def test_qcfc_by_group():
+    """Grouped QC-FC matches calling qcfc on each subset."""
+    movement, connectomes, covariates, groups = _make_fake_qcfc_data()
+    result = qc.qcfc_by_group(movement, connectomes, covariates, groups, "simple")
+    assert result.columns[0] == ("full_sample", "simple_correlation")
+    assert set(result.columns.get_level_values(0)) == {
+        "full_sample",
+        "adult",
+        "child",
+    }
+    expected = qc.qcfc(movement, connectomes, covariates)
+    np.testing.assert_allclose(
+        result["full_sample"].values, expected.values, rtol=1e-8
+    )
+    mask = groups == "child"
+    expected = qc.qcfc(movement[mask], connectomes[mask], covariates[mask])
+    np.testing.assert_allclose(result["child"].values, expected.values, rtol=1e-8)
+
+
+def test_qcfc_permutation():
+    """Permutation null adds empirical and FWER corrected p-values."""
+    movement, connectomes, covariates, _ = _make_fake_qcfc_data()
+    result = qc.qcfc(
+        movement, connectomes, covariates, n_permutations=200, random_state=0
+    )
+    assert list(result.columns) == [
+        "correlation",
+        "pvalue",
+        "permutation_p",
+        "fwer_p",
+    ]
+    assert (result["permutation_p"] <= result["fwer_p"]).all()
+    assert result["permutation_p"].min() >= 1 / 201
+    threshold = result.attrs["fwer_threshold"]
+    significant = result["correlation"].abs() > threshold
+    assert (result.loc[significant, "fwer_p"] <= 0.05).all()
+    # seeded permutations are reproducible across chunks and workers
+    x = np.random.default_rng(0).normal(size=(40, 10))
+    y = np.arange(40.0)
+    first = qc.permutation_test(x, y, n_permutations=50, chunk_size=7, random_state=1)
+    second = qc.permutation_test(
+        x, y, n_permutations=50, chunk_size=7, n_jobs=2, random_state=1
+    )
+    np.testing.assert_array_equal(first["fwer_p"], second["fwer_p"])
+
+
+def test_qcfc_accumulator(tmp_path):
+    """Accumulated statistics give the same QC-FC as a full recomputation."""
+    movement, connectomes, covariates, _ = _make_fake_qcfc_data()
+    accumulator = qc.QCFCAccumulator(connectomes.columns, ["age", "gender"])
+    added = accumulator.add(movement[:30], connectomes[:30], covariates[:30])
+    assert "sub-004" not in added  # missing edge
+    accumulator.save(tmp_path / "qcfc.npz")
+
+    accumulator = qc.QCFCAccumulator.load(tmp_path / "qcfc.npz")
+    accumulator.add(movement[30:], connectomes[30:], covariates[30:])
+    # covariates are z-scored on the subjects used in the accumulator
+    kept = connectomes.dropna().index
+    expected = qc.qcfc(movement[kept], connectomes.loc[kept], covariates.loc[kept])
+    np.testing.assert_allclose(accumulator.qcfc().values, expected.values, rtol=1e-6)
+
+    accumulator.remove(movement[:5], connectomes[:5], covariates[:5])
+    kept = kept[4:]
+    expected = qc.qcfc(movement[kept], connectomes.loc[kept], covariates.loc[kept])
+    np.testing.assert_allclose(accumulator.qcfc().values, expected.values, rtol=1e-6)
+
+    with pytest.raises(ValueError):
+        accumulator.add(movement[5:6], connectomes[5:6], covariates[5:6])
+
+
+def test_qcfc_by_group_incremental(tmp_path):
+    """Incremental runs only add new subjects and match qcfc_by_group."""
+    movement, connectomes, covariates, groups = _make_fake_qcfc_data()
+    connectomes = connectomes.dropna()
+    args = (movement, connectomes, covariates, groups, "simple")
+    qc.qcfc_by_group_incremental(tmp_path, "atlas-test", *args)
+    # second run with the same sample reuses the saved statistics
+    result = qc.qcfc_by_group_incremental(tmp_path, "atlas-test", *args)
+    expected = qc.qcfc_by_group(*args)
+    assert (tmp_path / "atlas-test_desc-simple_group-child.npz").is_file()
+    pd.testing.assert_index_equal(result.columns, expected.columns)
+    np.testing.assert_allclose(result.values, expected.values, rtol=1e-6)
+
+
+def test_qcfc_by_group_incremental_dropped(tmp_path):
+    """With subjects dropped for missing data, the accumulators reproduce the
+    covariates z-scored by qcfc_by_group."""
+    movement, connectomes, covariates, groups = _make_fake_qcfc_data()
+    movement = movement.copy()
+    movement.iloc[[10, 30]] = np.nan  # sub-004 also has a missing edge
+    args = (movement, connectomes, covariates, groups, "simple")
+    result = qc.qcfc_by_group_incremental(tmp_path, "atlas-test", *args)
+    expected = qc.qcfc_by_group(*args)
+    np.testing.assert_allclose(result.values, expected.values, rtol=1e-9)
+
+
+def test_update_qcfc_accumulator(tmp_path, capsys):
+    """Left and changed subjects are removed and added back, not rebuilt."""
+    movement, connectomes, covariates, _ = _make_fake_qcfc_data()
+    connectomes = connectomes.dropna()
+    path = tmp_path / "qcfc.npz"
+    qc.update_qcfc_accumulator(
+        path, movement[:40], connectomes.iloc[:40], covariates[:40]
+    )
+    movement, connectomes = movement.copy(), connectomes.copy()
+    movement.iloc[10] += 0.1
+    connectomes.iloc[11] += 0.5
+    sample = connectomes.index[3:]
+    capsys.readouterr()
+    accumulator = qc.update_qcfc_accumulator(
+        path, movement[sample], connectomes.loc[sample], covariates.loc[sample]
+    )
+    out = capsys.readouterr().out
+    assert "rebuilding" not in out
+    assert "Removed 5 changed or left subjects" in out
+    assert sorted(accumulator.subjects) == sorted(sample)
+    assert not (tmp_path / "qcfc.npz.subjects" / "sub-001.npy").exists()
+    expected = qc.qcfc(movement[sample], connectomes.loc[sample], covariates.loc[sample])
+    np.testing.assert_allclose(accumulator.qcfc().values, expected.values, rtol=1e-6)
+
+    # new covariates change the statistics themselves
+    qc.update_qcfc_accumulator(
+        path, movement[sample], connectomes.loc[sample], covariates.loc[sample, ["age"]]
+    )
+    assert "rebuilding" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize("correction", [None, "fdr_bh", "bonferroni"])
+def test_significant_percentage(correction):
+    """Bulk significance matches significant_level column by column."""
+    rng = np.random.default_rng(0)
+    pvalues = pd.DataFrame(rng.uniform(size=(500, 4)) ** np.array([1, 3, 6, 12]))
+    result = qc.significant_percentage(pvalues, correction=correction)
+    expected = pvalues.apply(
+        lambda x: 100 * qc.significant_level(x, correction=correction).mean()
+    )
+    pd.testing.assert_series_equal(result, expected)
+
+
+def test_bootstrap_qcfc_summary():
+    """Bootstrap estimates are the full sample QC-FC summary metrics."""
+    movement, connectomes, covariates, _ = _make_fake_qcfc_data()
+    distance = np.random.default_rng(1).uniform(size=connectomes.shape[1])
+    summary = qc.bootstrap_qcfc_summary(
+        movement,
+        connectomes,
+        covariates,
+        distance=distance,
+        n_bootstrap=100,
+        batch_size=30,
+        random_state=0,
+    )
+    metric = qc.qcfc(movement, connectomes, covariates)
+    assert summary.loc["qcfc_mad", "estimate"] == pytest.approx(
+        qc.calculate_median_absolute(metric["correlation"])
+    )
+    assert summary.loc["qcfc_significant", "estimate"] == pytest.approx(
+        qc.significant_percentage(metric[["pvalue"]], correction="fdr_bh")["pvalue"]
+    )
+    assert summary.loc["corr_motion_distance", "estimate"] == pytest.approx(
+        stats.spearmanr(distance, metric["correlation"])[0]
+    )
+    assert (summary["ci_lower"] <= summary["ci_upper"]).all()
+    # products of the edges by blocks give the same resamples
+    blocked = qc.bootstrap_qcfc_summary(
+        movement,
+        connectomes,
+        covariates,
+        distance=distance,
+        n_bootstrap=100,
+        batch_size=30,
+        block_size=7,
+        random_state=0,
+    )
+    pd.testing.assert_frame_equal(blocked, summary, rtol=1e-10)
+
+
+def test_bootstrap_qcfc_summary_null(tmp_path):
+    """Bias-corrected intervals contain the estimate on null data, also
+    with memory-mapped connectomes read by blocks."""
+    from fmriprep_denoise.features.derivatives import (
+        load_connectome_memmap,
+        save_connectome_memmap,
+    )
+
+    rng = np.random.default_rng(0)
+    subjects = [f"sub-{i + 1:03d}" for i in range(50)]
+    movement = pd.Series(rng.gamma(2, 0.1, size=50), index=subjects)
+    connectomes = pd.DataFrame(rng.normal(size=(50, 200)), index=subjects)
+    covariates = pd.DataFrame(
+        {"age": rng.uniform(4, 40, size=50), "gender": rng.integers(0, 2, size=50)},
+        index=subjects,
+    )
+    kwargs = dict(n_bootstrap=200, random_state=0)
+    summary = qc.bootstrap_qcfc_summary(movement, connectomes, covariates, **kwargs)
+    assert (summary["bias"] > 0).all()
+    assert (summary["ci_lower"] <= summary["estimate"]).all()
+    assert (summary["estimate"] <= summary["ci_upper"]).all()
+
+    save_connectome_memmap(connectomes, tmp_path / "connectomes")
+    memmapped = qc.bootstrap_qcfc_summary(
+        movement,
+        load_connectome_memmap(tmp_path / "connectomes"),
+        covariates,
+        block_size=16,
+        **kwargs,
+    )
+    pd.testing.assert_frame_equal(memmapped, summary, rtol=1e-10)
+
+
+def test_qcfc_summary_ties():
+    """Tied QC-FC correlations get average ranks in the distance dependence."""
+    rng = np.random.default_rng(0)
+    motion = rng.normal(size=20)
+    edges = rng.normal(size=(20, 6))
+    edges[:, 1] = edges[:, 0]
+    edges[:, 4] = edges[:, 3]
+    distance = rng.uniform(size=6)
+    distance_rank = qc._standardize(stats.rankdata(distance))
+    counts = np.ones((1, 20))
+    summary = qc._qcfc_summary(
+        counts, edges, np.arange(20), motion, None, distance_rank, None, 2
+    )
+    r = [stats.pearsonr(motion, edge)[0] for edge in edges.T]
+    assert summary[0, 2] == pytest.approx(stats.spearmanr(distance, r)[0])
+
+
+def test_qcfc_float32():
+    """Single precision QC-FC is within the documented tolerance."""
+    movement, connectomes, covariates, _ = _make_fake_qcfc_data()
+    expected = qc.qcfc(movement, connectomes, covariates)
+    result = qc.qcfc(movement, connectomes.astype(np.float32), covariates)
+    assert result["correlation"].dtype == np.float32
+    np.testing.assert_allclose(
+        result["correlation"], expected["correlation"], atol=1e-6
+    )
+    np.testing.assert_allclose(result["pvalue"], expected["pvalue"], rtol=1e-5)
+
+
+def test_qcfc_spearman():
+    """Rank based QC-FC matches scipy's spearman's correlation per edge."""
+    movement, connectomes, _, _ = _make_fake_qcfc_data()
+    connectomes = connectomes.dropna()
+    result = qc.qcfc(movement, connectomes, None, method="spearman")
+    for edge in [0, 7, 29]:
+        r, p_val = stats.spearmanr(connectomes[edge], movement[connectomes.index])
+        assert result.loc[edge, "correlation"] == pytest.approx(r)
+        assert result.loc[edge, "pvalue"] == pytest.approx(p_val)
+
+
+def test_qcfc_winsorized():
+    """Winsorized QC-FC is robust to a subject with extreme motion."""
+    movement, connectomes, covariates, _ = _make_fake_qcfc_data()
+    clean = qc.qcfc(movement, connectomes, covariates, method="winsorized")
+    movement.iloc[0] = 50.0
+    outlier = qc.qcfc(movement, connectomes, covariates, method="winsorized")
+    np.testing.assert_allclose(clean["correlation"], outlier["correlation"], atol=0.1)
+    with pytest.raises(NotImplementedError):
+        qc.qcfc(movement, connectomes, covariates, method="kendall")
+
+
+@pytest.mark.parametrize("method", ["pearson", "spearman"])
+def test_qcfc_motion_summaries(method):
+    """One block of QC-FC per motion summary, each matching qcfc."""
+    movement, connectomes, covariates, _ = _make_fake_qcfc_data()
+    rng = np.random.default_rng(0)
+    motion = pd.DataFrame(
+        {
+            "mean_framewise_displacement": movement,
+            "max_framewise_displacement": movement * 3
+            + rng.gamma(2, 0.1, size=len(movement)),
+        }
+    )
+    motion.iloc[7, 1] = np.nan  # subject dropped from all summaries
+    result = qc.qcfc_motion_summaries(motion, connectomes, covariates, method)
+    assert result.shape == (30, 4)
+    assert result.columns.get_level_values(0).unique().tolist() == list(
+        motion.columns
+    )
+    for name in motion.columns:
+        expected = qc.qcfc(
+            motion[name].drop(motion.index[7]), connectomes, covariates, method=method
+        )
+        np.testing.assert_allclose(result[name].values, expected.values, rtol=1e-8)
+
+
+@pytest.mark.parametrize("block_size", [1, 7])
+@pytest.mark.parametrize("method", ["pearson", "spearman", "winsorized"])
+def test_qcfc_block_size(tmp_path, method, block_size):
+    """QC-FC by blocks of memory-mapped edges matches the in-memory path."""
+    from fmriprep_denoise.features.derivatives import (
+        load_connectome_memmap,
+        save_connectome_memmap,
+    )
+
+    movement, connectomes, covariates, groups = _make_fake_qcfc_data()
+    save_connectome_memmap(connectomes, tmp_path / "connectomes")
+    memmap = load_connectome_memmap(tmp_path / "connectomes")
+    pd.testing.assert_frame_equal(
+        qc.qcfc(movement, memmap, covariates, method=method, block_size=block_size),
+        qc.qcfc(movement, connectomes, covariates, method=method),
+    )
+    pd.testing.assert_frame_equal(
+        qc.qcfc_by_group(
+            movement, memmap, covariates, groups, "test", block_size=block_size
+        ),
+        qc.qcfc_by_group(movement, connectomes, covariates, groups, "test"),
+    )
+    motion = movement.to_frame().assign(squared=movement**2)
+    pd.testing.assert_frame_equal(
+        qc.qcfc_motion_summaries(
+            motion, memmap, covariates, method, block_size=block_size
+        ),
+        qc.qcfc_motion_summaries(motion, connectomes, covariates, method),
+    )
+
+
+@pytest.mark.parametrize("order", ["C", "F"])
+@pytest.mark.parametrize("n_columns", [1, 4])
+def test_rank_columns(order, n_columns):
+    """Average ranks of tied columns match rankdata, whatever the layout."""
+    rng = np.random.default_rng(0)
+    x = rng.integers(0, 5, size=(20, n_columns)).astype(float)
+    x[:, -1] = rng.normal(size=20)  # one column without ties
+    x[:, 0] = rng.integers(0, 5, size=20)  # tied column
+    x = np.array(x, order=order)
+    expected = stats.rankdata(x, axis=0)
+    result = qc._rank_columns(x)
+    np.testing.assert_array_equal(result, expected)
@@ -1,3 +1,5 @@
+from pathlib import Path
+
 import pandas as pd
 
 # changed to match json 
@@ -17,6 +19,8 @@ group_order = {
     "ds000228": ["adult", "child"],
     "ds000030": ["control", "ADHD", "bipolar", "schizophrenia"],
 }
+# parsed phenotypes and QC subject masks, per pair of phenotype files
+_phenotype_cache = {}
 
 
 def lazy_demographic(
@@ -123,24 +127,57 @@ def get_descriptive_data(
             "We did not generate metric with scrubbing threshold set at "
             f"framewise displacement = {fd_thresh} mm."
         )
-    # load basic data
-    movements = (
-        path_root
-        / dataset
-        / fmriprep_version
-        / f"dataset-{dataset}_desc-movement_phenotype.tsv"
+    phenotypes = _load_phenotypes(dataset, fmriprep_version, path_root)
+    mask_motion = _qc_mask(phenotypes, gross_fd, fd_thresh, proportion_thresh)
+
+    movements = phenotypes["movements"]
+    if dataset not in group_order:
+        groups = movements["groups"].unique().tolist()
+    else:
+        groups = group_order[dataset]
+    movements = movements.loc[mask_motion, :]
+    confounds_phenotype = phenotypes["confounds_phenotype"].loc[mask_motion, :]
+    return confounds_phenotype, movements, list(groups)
+
+
+def _load_phenotypes(dataset, fmriprep_version, path_root):
+    """Movement and confounds phenotypes of a dataset, parsed again only
+    when the path, modification time or size of one of the files changes."""
+    path_root = Path(path_root) / dataset / fmriprep_version
+    path_movement = path_root / f"dataset-{dataset}_desc-movement_phenotype.tsv"
+    path_dof = path_root / f"dataset-{dataset}_desc-confounds_phenotype.tsv"
+    paths = (str(path_movement.resolve()), str(path_dof.resolve()))
+    stats = tuple(
+        (stat.st_mtime_ns, stat.st_size)
+        for stat in (path_movement.stat(), path_dof.stat())
     )
-    movements = pd.read_csv(movements, index_col=[0, -1], sep="\t")
+    cached = _phenotype_cache.get(paths)
+    if cached is not None and cached["stats"] == stats:
+        return cached
+
+    # load basic data
+    movements = pd.read_csv(path_movement, index_col=[0, -1], sep="\t")
     movements = movements.rename(index=group_name_rename)
     movements = movements.reset_index(level="groups")
-
-    path_dof = (
-        path_root
-        / dataset
-        / fmriprep_version
-        / f"dataset-{dataset}_desc-confounds_phenotype.tsv"
-    )
     confounds_phenotype = pd.read_csv(path_dof, header=[0, 1], index_col=0, sep="\t")
+    phenotypes = {
+        "stats": stats,
+        "movements": movements,
+        "confounds_phenotype": confounds_phenotype,
+        "masks": {},
+    }
+    _phenotype_cache[paths] = phenotypes
+    return phenotypes
+
+
+def _qc_mask(phenotypes, gross_fd=None, fd_thresh=None, proportion_thresh=None):
+    """Subjects passing the motion QC thresholds, computed on first request
+    and memoized per thresholds."""
+    thresholds = (gross_fd, fd_thresh, proportion_thresh)
+    if thresholds in phenotypes["masks"]:
+        return phenotypes["masks"][thresholds]
+    movements = phenotypes["movements"]
+    confounds_phenotype = phenotypes["confounds_phenotype"]
 
     # filter data by gross fd
     if gross_fd is not None:
@@ -157,11 +194,5 @@ def get_descriptive_data(
     else:
         keep_scrub = confounds_phenotype.index
     mask_motion = keep_gross_fd.intersection(keep_scrub)
-
-    if dataset not in group_order:
-        groups = movements["groups"].unique().tolist()
-    else:
-        groups = group_order[dataset]
-    movements = movements.loc[mask_motion, :]
-    confounds_phenotype = confounds_phenotype.loc[mask_motion, :]
-    return confounds_phenotype, movements, groups
+    phenotypes["masks"][thresholds] = mask_motion
+    return mask_motion
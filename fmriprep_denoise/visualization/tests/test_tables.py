@@ -0,0 +1,76 @@
+"""Test the descriptive data loader."""
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from fmriprep_denoise.visualization import tables
+
+
+def _make_fake_phenotypes(path_root, dataset="ds-test", scrubbing=True):
+    """Make test data."""
+    rng = np.random.default_rng(0)
+    subjects = [f"sub-{i+1:03d}" for i in range(20)]
+    output_path = path_root / dataset / "fmriprep-test"
+    output_path.mkdir(parents=True)
+    movements = pd.DataFrame(
+        {
+            "mean_framewise_displacement": rng.uniform(0, 0.6, size=20),
+            "age": rng.uniform(4, 40, size=20),
+            "gender": rng.integers(0, 2, size=20),
+            "groups": rng.choice(["CONTROL", "SCHZ"], size=20),
+        },
+        index=pd.Index(subjects, name="participant_id"),
+    )
+    movements.to_csv(
+        output_path / f"dataset-{dataset}_desc-movement_phenotype.tsv", sep="\t"
+    )
+    strategy = "scrubbing.5" if scrubbing else "simple"
+    confounds = pd.DataFrame(
+        {
+            (strategy, "excised_vol"): rng.integers(0, 100, size=20),
+            (strategy, "excised_vol_proportion"): rng.uniform(size=20),
+        },
+        index=subjects,
+    )
+    confounds.to_csv(
+        output_path / f"dataset-{dataset}_desc-confounds_phenotype.tsv", sep="\t"
+    )
+    return output_path, movements, confounds
+
+
+def test_get_descriptive_data(tmp_path):
+    """QC masks match the thresholds and phenotypes are parsed once."""
+    output_path, movements, confounds = _make_fake_phenotypes(tmp_path)
+    args = ("ds-test", "fmriprep-test", tmp_path)
+    _, movement, groups = tables.get_descriptive_data(*args)
+    assert movement.index.tolist() == movements.index.tolist()
+    assert sorted(groups) == ["control", "schizophrenia"]
+
+    _, movement, _ = tables.get_descriptive_data(*args, 0.4, 0.5, 0.5)
+    keep = (movements["mean_framewise_displacement"] <= 0.4) & (
+        confounds[("scrubbing.5", "excised_vol_proportion")] <= 0.5
+    )
+    assert movement.index.tolist() == movements.index[keep].tolist()
+
+    # cached per file version, masks per thresholds
+    phenotypes = tables._load_phenotypes(*args)
+    assert tables._load_phenotypes(*args) is phenotypes
+    assert set(phenotypes["masks"]) == {(None, None, None), (0.4, 0.5, 0.5)}
+    path_movement = output_path / "dataset-ds-test_desc-movement_phenotype.tsv"
+    movements.iloc[:10].to_csv(path_movement, sep="\t")
+    os.utime(path_movement, ns=(0, 0))
+    _, movement, _ = tables.get_descriptive_data(*args)
+    assert len(movement) == 10
+
+
+def test_get_descriptive_data_without_scrubbing(tmp_path):
+    """Only the requested QC is computed: no scrubbing column is needed
+    without scrubbing thresholds."""
+    _make_fake_phenotypes(tmp_path, scrubbing=False)
+    args = ("ds-test", "fmriprep-test", tmp_path)
+    _, movement, _ = tables.get_descriptive_data(*args, gross_fd=0.3)
+    assert (movement["mean_framewise_displacement"] <= 0.3).all()
+    with pytest.raises(KeyError):
+        tables.get_descriptive_data(*args, 0.3, 0.5, 0.5)
@@ -9,9 +9,10 @@ from repo2data.repo2data import Repo2Data
 
 from fmriprep_denoise.features import (
     partial_correlation,
-    significant_level,
+    significant_percentage,
     calculate_median_absolute,
     get_atlas_pairwise_distance,
+    get_roi_subset,
 )
 from fmriprep_denoise.visualization.tables import (
     get_descriptive_data,
@@ -190,44 +191,48 @@ def prepare_qcfc_plotting(dataset, fmriprep_version, atlas_name, dimension, path
     "fmriprep-20.2.7": "/home/seann/scratch/halfpipe_test/25-04-17_ds228_halfpipe-1.2.3_fmriprep-20.2.7/derivatives/denoise/rois_dropped.csv",
     }
     excluded_rois_path = excluded_rois_paths.get(fmriprep_version, None)
-
-
+    # kept ROIs and distances per atlas, shared by all strategies
+    roi_subsets, pairwise_distances = {}, {}
 
     for p, label in zip(file_qcfc, qcfc_labels):
         label = label.replace(f"dataset-{dataset}_", "")
+        cur_atlas_name = label.split("atlas-")[-1].split("_")[0]
+        cur_dimension = label.split("nroi-")[-1].split("_")[0]
+        key = (cur_atlas_name, cur_dimension)
+        if key not in pairwise_distances:
+            roi_subsets[key] = (
+                get_roi_subset(cur_atlas_name, cur_dimension, excluded_rois_path)
+                if excluded_rois_path is not None
+                else None
+            )
+            pairwise_distances[key] = get_atlas_pairwise_distance(
+                cur_atlas_name, cur_dimension, roi_subset=roi_subsets[key]
+            )
+        roi_subset = roi_subsets[key]
+
         # significant correlation between motion and edges
         qcfc_pvalue = _qcfc_bygroup("pvalue", p)
-        qcfc_pvalue = qcfc_pvalue.melt(var_name=["groups", "strategy"])
+        if roi_subset is not None and qcfc_pvalue.shape[0] == roi_subset.n_edges:
+            # QC-FC of the full atlas, keep the edges of the kept ROIs
+            qcfc_pvalue = roi_subset.subset_edges(qcfc_pvalue, axis=0)
 
         # fdr correction
-        qcfc_pvalue["fdr"] = qcfc_pvalue.groupby(["groups", "strategy"])[
-            "value"
-        ].transform(significant_level, correction="fdr_bh")
-        qcfc_sig = qcfc_pvalue.groupby(["groups", "strategy"]).apply(
-            lambda x: 100 * x.fdr.sum() / x.fdr.shape[0]
-        )
-        qcfc_sig = pd.DataFrame(qcfc_sig, columns=[label])
-        ds_qcfc_sig_fdr.append(qcfc_sig)
+        qcfc_sig = significant_percentage(qcfc_pvalue, correction="fdr_bh")
+        ds_qcfc_sig_fdr.append(qcfc_sig.sort_index().to_frame(label))
 
         # uncorrected p values
-        qcfc_pvalue["p_value"] = qcfc_pvalue.groupby(["groups", "strategy"])[
-            "value"
-        ].transform(significant_level)
-        qcfc_sig = qcfc_pvalue.groupby(["groups", "strategy"]).apply(
-            lambda x: 100 * x.p_value.sum() / x.p_value.shape[0]
-        )
-        qcfc_sig = pd.DataFrame(qcfc_sig, columns=[label])
-        ds_qcfc_sig.append(qcfc_sig)
+        qcfc_sig = significant_percentage(qcfc_pvalue)
+        ds_qcfc_sig.append(qcfc_sig.sort_index().to_frame(label))
 
         # median absolute of correlation between motion and edges
         qcfc = _qcfc_bygroup("correlation", p)
+        if roi_subset is not None and qcfc.shape[0] == roi_subset.n_edges:
+            qcfc = roi_subset.subset_edges(qcfc, axis=0)
         mad_qcfc = qcfc.apply(calculate_median_absolute)
         mad_qcfc.name = label
         ds_qcfc_median_absolute.append(mad_qcfc)
 
         # distance dependency
-        cur_atlas_name = label.split("atlas-")[-1].split("_")[0]
-        cur_dimension = label.split("nroi-")[-1].split("_")[0]
         # pairwise_distance = get_atlas_pairwise_distance(cur_atlas_name, cur_dimension)
         # pairwise_distance = get_atlas_pairwise_distance(
         #     cur_atlas_name,
@@ -235,11 +240,7 @@ def prepare_qcfc_plotting(dataset, fmriprep_version, atlas_name, dimension, path
         #     excluded_rois_path="/home/seann/scratch/halfpipe_test/test14/derivatives/denoise_0.9subjectthreshold/rois_dropped.csv"
         # )
 
-        pairwise_distance = get_atlas_pairwise_distance(
-            cur_atlas_name,
-            cur_dimension,
-            excluded_rois_path=excluded_rois_path
-        )
+        pairwise_distance = pairwise_distances[key]
         cols = qcfc.columns
         # corr_distance_qcfc, _ = spearmanr(pairwise_distance.iloc[:, -1], qcfc)
         condensed_distances = pairwise_distance["distance"].values
@@ -653,21 +654,10 @@ def _qcfc_pvalue(file_qcfc, labels, group, fdr):
 
     long_qcfc_sig = []
 
+    correction = "fdr_bh" if fdr else None
     for df, label in zip(sig_per_edge, labels):
-        df = df.melt()
-        if fdr:
-            df["fdr"] = df.groupby("variable")["value"].transform(
-                significant_level, correction="fdr_bh"
-            )
-            df = df.groupby("variable").apply(
-                lambda x: 100 * x.fdr.sum() / x.fdr.shape[0]
-            )
-        else:
-            df["p_value"] = df.groupby("variable")["value"].transform(significant_level)
-            df = df.groupby("variable").apply(
-                lambda x: 100 * x.p_value.sum() / x.p_value.shape[0]
-            )
-        df = pd.DataFrame(df, columns=[label])
+        df = significant_percentage(df, correction=correction)
+        df = df.sort_index().to_frame(label)
         long_qcfc_sig.append(df)
 
     if len(long_qcfc_sig) == 1:
@@ -0,0 +1,123 @@
+"""Wall time of the Louvain modularity of one subject by atlas size.
+
+Connectomes are correlations of random time series. With --n_units, that
+many subjects are processed concurrently by joblib workers, each spreading
+its optimizations across --n_jobs processes, as build_features does with
+--n_workers, i.e. up to n_units x n_jobs processes. "wall_seconds" is the
+wall time of all the concurrent subjects and "seconds_per_subject" that
+time divided by n_units. Example:
+
+    python scripts/benchmark_louvain.py --num_opt 100 --n_jobs 1 4 --backend bct numpy
+"""
+import argparse
+import time
+from itertools import product
+
+import numpy as np
+from joblib import Parallel, delayed
+
+from fmriprep_denoise.features.network_modularity import (
+    LOUVAIN_BACKENDS,
+    louvain_modularity,
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description="Benchmark the Louvain modularity of one subject.",
+    )
+    parser.add_argument(
+        "--n_rois",
+        nargs="+",
+        type=int,
+        default=[100, 200, 434, 1024],
+        help="Atlas sizes.",
+    )
+    parser.add_argument(
+        "--n_jobs",
+        nargs="+",
+        type=int,
+        default=[1, 4],
+        help="Numbers of processes the optimizations are spread across.",
+    )
+    parser.add_argument(
+        "--n_units",
+        nargs="+",
+        type=int,
+        default=[1],
+        help="Numbers of subjects processed concurrently.",
+    )
+    parser.add_argument(
+        "--backend",
+        nargs="+",
+        default=["bct"],
+        choices=LOUVAIN_BACKENDS,
+        help="Louvain implementations.",
+    )
+    parser.add_argument(
+        "--num_opt", type=int, default=100, help="Number of optimizations."
+    )
+    parser.add_argument(
+        "--n_volumes", type=int, default=200, help="Length of the time series."
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+    return parser.parse_args()
+
+
+def simulate_connectome(n_rois, n_volumes, rng):
+    """Flatten correlation connectome of random time series with a few
+    correlated networks."""
+    n_networks = max(2, n_rois // 50)
+    networks = rng.integers(n_networks, size=n_rois)
+    signals = rng.normal(size=(n_volumes, n_networks))
+    timeseries = signals[:, networks] + rng.normal(size=(n_volumes, n_rois)) * 2
+    correlation = np.corrcoef(timeseries.T)
+    return correlation[np.tril_indices(n_rois, k=-1)]
+
+
+def main():
+    args = parse_args()
+    rng = np.random.default_rng(args.seed)
+    # start the worker pools before timing
+    warmup = simulate_connectome(20, args.n_volumes, rng)
+    for n_units, n_jobs in product(args.n_units, args.n_jobs):
+        Parallel(n_jobs=n_units)(
+            delayed(louvain_modularity)(warmup, num_opt=n_jobs, n_jobs=n_jobs)
+            for _ in range(n_units)
+        )
+    print(
+        "# n_units subjects run concurrently, each over n_jobs processes "
+        "(n_units x n_jobs processes in total)"
+    )
+    print(
+        "n_rois\tbackend\tn_units\tn_jobs\tn_processes\tnum_opt\t"
+        "wall_seconds\tseconds_per_subject\tmodularity"
+    )
+    for n_rois in args.n_rois:
+        vect = simulate_connectome(n_rois, args.n_volumes, rng)
+        for backend, n_units, n_jobs in product(
+            args.backend, args.n_units, args.n_jobs
+        ):
+            kwargs = dict(
+                num_opt=args.num_opt, n_jobs=n_jobs, seed=args.seed, backend=backend
+            )
+            start = time.perf_counter()
+            if n_units == 1:
+                modularity = louvain_modularity(vect, **kwargs)
+            else:
+                modularity = Parallel(n_jobs=n_units)(
+                    delayed(louvain_modularity)(vect, **kwargs)
+                    for _ in range(n_units)
+                )[0]
+            elapsed = time.perf_counter() - start
+            print(
+                f"{n_rois}\t{backend}\t{n_units}\t{n_jobs}\t{n_units * n_jobs}\t"
+                f"{args.num_opt}\t{elapsed:.2f}\t{elapsed / n_units:.2f}\t"
+                f"{modularity:.4f}",
+                flush=True,
+            )
+
+
+if __name__ == "__main__":
+    main()